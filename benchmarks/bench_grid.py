@@ -0,0 +1,73 @@
+"""Сравнение векторной генерации сетки с исходной реализацией.
+
+Запуск из корня проекта:
+
+    python -m benchmarks.bench_grid
+    python -m benchmarks.bench_grid --sizes 10000 100000
+"""
+import argparse
+import time
+
+import geopandas as gpd
+import numpy as np
+import shapely
+from shapely.geometry import Point, Polygon
+
+from routing import generate_flight_grid, grid_step
+
+SPRAY_WIDTH = 10  # шаг сетки grid_step - 50 м
+FLIGHT_RADIUS = 2.5
+
+
+def legacy_generate_flight_grid(field_polygon, spray_width, drone_flight_radius):
+    """Исходная реализация: двойной цикл по np.arange и gpd.overlay (шаг - тот же grid_step)."""
+    field_gdf = gpd.GeoDataFrame([1], geometry=[field_polygon], crs="EPSG:4326")
+
+    minx, miny, maxx, maxy = field_polygon.bounds
+    x_step = grid_step(spray_width, drone_flight_radius)
+    y_step = grid_step(spray_width, drone_flight_radius)
+
+    grid_squares = []
+    for x in np.arange(minx, maxx, x_step):
+        for y in np.arange(miny, maxy, y_step):
+            grid_squares.append(Polygon([(x, y), (x + x_step, y), (x + x_step, y + y_step), (x, y + y_step)]))
+
+    grid_gdf = gpd.GeoDataFrame(geometry=grid_squares, crs="EPSG:4326")
+    return gpd.overlay(grid_gdf, field_gdf, how='intersection')
+
+
+def make_field(num_cells, spray_width=SPRAY_WIDTH):
+    """Круглое поле, bbox которого содержит примерно num_cells квадратов."""
+    step = grid_step(spray_width, FLIGHT_RADIUS)
+    side = np.sqrt(num_cells) * step
+    return Point(side / 2, side / 2).buffer(side / 2, quad_segs=32)
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10_000, 100_000, 1_000_000])
+    parser.add_argument('--no-legacy', action='store_true', help="не запускать исходную реализацию")
+    args = parser.parse_args()
+
+    print(f"{'клеток':>10} {'квадратов':>10} {'вектор, с':>10} {'исходная, с':>12} {'ускорение':>10}")
+    for size in args.sizes:
+        field = make_field(size)
+        grid, fast = timed(generate_flight_grid, field, SPRAY_WIDTH, FLIGHT_RADIUS)
+
+        if args.no_legacy:
+            print(f"{size:>10} {len(grid):>10} {fast:>10.3f} {'-':>12} {'-':>10}")
+            continue
+
+        legacy_grid, slow = timed(legacy_generate_flight_grid, field, SPRAY_WIDTH, FLIGHT_RADIUS)
+        assert np.isclose(shapely.area(grid.geometry.values).sum(), shapely.area(legacy_grid.geometry.values).sum()), "площади сеток не совпадают"
+        print(f"{size:>10} {len(grid):>10} {fast:>10.3f} {slow:>12.3f} {slow / fast:>9.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,225 @@
+"""Бенчмарк всего конвейера планирования на синтетических полях разного размера.
+
+Для каждого сценария (форма поля x площадь x число запретных зон) замеряются
+этапы generate_flight_grid, remove_restricted_areas, построение маршрутов и
+вылетов, export_flight_paths_to_geojson и метрики: время, пропускная
+способность и пик памяти. Каждый сценарий считается в отдельном процессе,
+чтобы пик памяти одного не влиял на другой, и повторяется --repeat раз:
+время этапа - наименьшее из повторов, пик памяти - медиана. Результаты можно
+сохранить как базовые и сравнивать с ними следующие запуски: этапы, ставшие
+медленнее больше чем на --tolerance и на MIN_SECONDS (или тяжелее на
+MIN_MEMORY_MB), помечаются как регрессии (код выхода 1).
+
+Запуск из корня проекта:
+
+    python -m benchmarks.bench_pipeline
+    python -m benchmarks.bench_pipeline --sizes 10 1000 100000 --zones 1 1000 --shapes concave
+    python -m benchmarks.bench_pipeline --save-baseline benchmarks/baseline.json
+    python -m benchmarks.bench_pipeline --baseline benchmarks/baseline.json
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import statistics
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import redirect_stdout
+from multiprocessing import get_context
+
+from benchmarks.synthetic import FIELD_SHAPES, UTM_CRS, make_scenario
+from drones import drones
+from geojson_export import export_flight_paths_to_geojson
+from main import calculate_flight_metrics
+from routing import CellSizing, calculate_flight_path, generate_flight_grid, remove_restricted_areas
+from sorties import schedule_sorties
+from time_class import PipelineRun, stage
+from transit import reroute_transit
+
+# Сценарии с большим числом квадратов пропускаются
+MAX_CELLS = 500_000
+# Повторов каждого сценария: единичный замер слишком зависит от нагрузки на машину
+REPEAT = 3
+# Допустимое замедление (доля) и порог шума по времени (с) и памяти (МБ)
+TOLERANCE = 0.25
+MIN_SECONDS = 0.05
+MIN_MEMORY_MB = 20.0
+# Этапы в таблице результатов и счетчик, по которому считается пропускная способность
+STAGES = {
+    'generate_flight_grid': 'cells_generated',
+    'remove_restricted_areas': 'cells_generated',
+    'routes': 'cells',
+    'export_geojson': 'vertices_exported',
+    'metrics': None,
+}
+
+
+def scenario_name(shape, area_ha, num_zones):
+    return f"{shape}-{area_ha:g}ha-{num_zones}z"
+
+
+def run_scenario(shape, area_ha, num_zones, drone_name, cell_size, workers, seed=0):
+    """Весь конвейер на одном синтетическом поле; возвращает словарь результатов сценария."""
+    field, zones, start = make_scenario(area_ha, shape, num_zones, seed)
+    drone = drones[drone_name].get_properties()
+    step = cell_size or CellSizing(drone, start)
+
+    run = PipelineRun(scenario_name(shape, area_ha, num_zones))
+    with tempfile.TemporaryDirectory() as folder, redirect_stdout(io.StringIO()), run:
+        grid = generate_flight_grid(field, drone['spray_width'], drone['flight_radius'], UTM_CRS, step=step)
+        valid_grid = remove_restricted_areas(grid, zones)
+        run.count('cells', len(valid_grid))
+        with stage('routes'):
+            cell_paths = calculate_flight_path(valid_grid, start, drone['spray_width'], zones, workers=workers)
+            sorties = schedule_sorties(cell_paths, valid_grid.area.values, drone)
+            run.count('infeasible_sorties', int((~sorties.feasible).sum()))
+            flight_paths = reroute_transit(sorties.to_flight_plan(cell_paths), zones, start)
+        export_flight_paths_to_geojson(flight_paths, os.path.join(folder, 'flight_paths.geojson'), UTM_CRS,
+                                       stream=True)
+        with stage('metrics'):
+            calculate_flight_metrics(drone, field.area / 10_000, sorties)
+
+    report = run.to_dict()
+    stages = {}
+    for record in report['stages'][:-1]:
+        path = record['stage'].split('/', 1)[1]
+        stages[path] = {'seconds': record['seconds'], 'peak_rss_mb': record.get('peak_rss_mb')}
+        counter = STAGES.get(path)
+        if counter and record['seconds'] > 0:
+            stages[path]['per_second'] = round(report['counters'].get(counter, 0) / record['seconds'], 1)
+
+    return {'shape': shape, 'area_ha': area_ha, 'zones': num_zones, 'seconds': report['seconds'],
+            'peak_rss_mb': report['stages'][-1].get('peak_rss_mb'), 'counters': report['counters'],
+            'stages': stages}
+
+
+def run_isolated(*args):
+    """run_scenario в новом процессе: пик памяти сценария не зависит от предыдущих."""
+    with ProcessPoolExecutor(max_workers=1, mp_context=get_context('spawn')) as executor:
+        return executor.submit(run_scenario, *args).result()
+
+
+def best_of(runs):
+    """Результат нескольких повторов сценария: время - наименьшее, пик памяти - медиана.
+
+    Наименьшее время меньше всего зависит от посторонней нагрузки на
+    машину; счетчики у повторов одинаковые (те же поле и seed).
+    """
+    result = dict(runs[0], seconds=min(run['seconds'] for run in runs),
+                  peak_rss_mb=_median(run['peak_rss_mb'] for run in runs), runs=len(runs))
+    result['stages'] = {}
+    for path in runs[0]['stages']:
+        records = [run['stages'][path] for run in runs if path in run['stages']]
+        record = dict(min(records, key=lambda record: record['seconds']))
+        record['peak_rss_mb'] = _median(record['peak_rss_mb'] for record in records)
+        result['stages'][path] = record
+    return result
+
+
+def _median(values):
+    values = [value for value in values if value is not None]
+    return statistics.median(values) if values else None
+
+
+def compare(results, baseline, tolerance=TOLERANCE):
+    """Регрессии относительно baseline: этапы, ставшие медленнее или тяжелее больше чем на tolerance.
+
+    Изменения меньше MIN_SECONDS и MIN_MEMORY_MB считаются шумом. Если в
+    сценарии изменилось число квадратов или вершин, сравнение времени
+    неточно, и об этом тоже сообщается.
+    """
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        for counter in ('cells', 'sorties', 'infeasible_sorties'):
+            if result['counters'].get(counter) != base['counters'].get(counter):
+                regressions.append(f"{name}: {counter} {base['counters'].get(counter)} -> "
+                                   f"{result['counters'].get(counter)} (результат планирования изменился)")
+        for path, record in result['stages'].items():
+            before = base['stages'].get(path)
+            if before is None:
+                continue
+            now, was = record['seconds'], before['seconds']
+            if now > was * (1 + tolerance) and now - was > MIN_SECONDS:
+                regressions.append(f"{name}: {path} {was:.3f} -> {now:.3f} с")
+        now, was = result['peak_rss_mb'], base['peak_rss_mb']
+        if now and was and now > was * (1 + tolerance) and now - was > MIN_MEMORY_MB:
+            regressions.append(f"{name}: пик памяти {was:.0f} -> {now:.0f} МБ")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=float, nargs='+', default=[10, 100, 1000], help="площади полей, га")
+    parser.add_argument('--zones', type=int, nargs='+', default=[1, 10, 100], help="числа запретных зон")
+    parser.add_argument('--shapes', nargs='+', default=list(FIELD_SHAPES), choices=FIELD_SHAPES)
+    parser.add_argument('--drone', default="DJI Agras T30", choices=list(drones))
+    parser.add_argument('--cell-size', type=float,
+                        help="сторона квадрата сетки, м (по умолчанию - по запасу хода дрона, CellSizing)")
+    parser.add_argument('--workers', type=int, default=1, help="процессов для расчета маршрутов")
+    parser.add_argument('--repeat', type=int, default=REPEAT, help="повторов каждого сценария")
+    parser.add_argument('--max-cells', type=int, default=MAX_CELLS)
+    parser.add_argument('--in-process', action='store_true', help="не запускать сценарии в отдельных процессах")
+    parser.add_argument('--output', metavar='PATH', help="сохранить результаты в JSON")
+    parser.add_argument('--save-baseline', metavar='PATH', help="сохранить результаты как базовые")
+    parser.add_argument('--baseline', metavar='PATH', help="сравнить с базовыми результатами")
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE)
+    args = parser.parse_args()
+
+    results = {}
+    print(f"{'сценарий':<24} {'квадратов':>9} {'вылетов':>8} {'сетка, с':>9} {'зоны, с':>8} {'маршруты, с':>11} "
+          f"{'экспорт, с':>10} {'метрики, с':>10} {'пик, МБ':>8}")
+    for shape in args.shapes:
+        for area_ha in args.sizes:
+            for num_zones in args.zones:
+                name = scenario_name(shape, area_ha, num_zones)
+                # Оценка снизу для CellSizing: все квадраты наибольшего размера
+                side = args.cell_size or CellSizing(drones[args.drone].get_properties(), (0, 0)).max_side
+                estimate = area_ha * 10_000 / side ** 2
+                if estimate > args.max_cells:
+                    print(f"{name:<24} пропущен: ~{estimate:.0f} квадратов больше --max-cells")
+                    continue
+                run = run_scenario if args.in_process else run_isolated
+                result = best_of([run(shape, area_ha, num_zones, args.drone, args.cell_size, args.workers)
+                                  for _ in range(max(args.repeat, 1))])
+                results[name] = result
+                seconds = [result['stages'].get(path, {}).get('seconds', 0.0) for path in STAGES]
+                counters = result['counters']
+                print(f"{name:<24} {counters.get('cells', 0):>9} {counters.get('sorties', 0):>8} "
+                      f"{seconds[0]:>9.3f} {seconds[1]:>8.3f} {seconds[2]:>11.3f} {seconds[3]:>10.3f} "
+                      f"{seconds[4]:>10.4f} {result['peak_rss_mb'] or 0:>8.0f}")
+
+    report = {'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'python': platform.python_version(),
+              'machine': platform.platform(),
+              'cpu_count': os.cpu_count(),
+              'repeat': max(args.repeat, 1),
+              'parameters': {'drone': args.drone, 'cell_size': args.cell_size, 'workers': args.workers},
+              'scenarios': results}
+    for path in (args.output, args.save_baseline):
+        if path:
+            with open(path, 'w', encoding='utf-8') as f:
+                json.dump(report, f, ensure_ascii=False, indent=2)
+            print("Результаты сохранены в файл:", path)
+
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+        if baseline.get('parameters') != report['parameters']:
+            print(f"Параметры отличаются от базовых: {baseline.get('parameters')}")
+        regressions = compare(results, baseline['scenarios'], args.tolerance)
+        compared = len(results.keys() & baseline['scenarios'].keys())
+        if regressions:
+            print(f"Регрессии относительно {args.baseline} (сценариев сравнено: {compared}):")
+            for line in regressions:
+                print("  " + line)
+            raise SystemExit(1)
+        print(f"Регрессий относительно {args.baseline} нет (сценариев сравнено: {compared})")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+"""Время экспорта и пиковый RSS для каждого табличного формата.
+
+Каждый формат запускается в отдельном процессе, чтобы пиковый RSS
+(ru_maxrss) относился только к нему. Запуск из корня проекта:
+
+    python -m benchmarks.bench_table_export
+    python -m benchmarks.bench_table_export --vertices 100000 --formats csv parquet
+"""
+import argparse
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+
+from flight_plan import FlightPlan
+from table_export import save_flight_paths_to_table
+from time_class import RU_MAXRSS_UNIT
+
+FORMATS = {
+    'csv': '.csv',
+    'parquet': '.parquet',
+    'excel': '.xlsx',
+    'excel-legacy': '.xlsx',
+}
+UTM_CRS = "EPSG:32640"
+
+
+def make_plan(num_vertices, seed=0):
+    """План "старт -> центр -> старт" с num_vertices вершинами (4 на квадрат)."""
+    rng = np.random.default_rng(seed)
+    num_cells = num_vertices // 4
+    centers = shapely.points(rng.uniform(360000, 370000, num_cells), rng.uniform(6360000, 6370000, num_cells))
+    grid = gpd.GeoDataFrame(geometry=shapely.buffer(centers, 25, quad_segs=1))
+    return FlightPlan.from_grid(grid, (365000, 6365000))
+
+
+def legacy_save_to_excel(plan, output_path):
+    """Исходный подход: словарь на каждую вершину, затем DataFrame и .xlsx."""
+    data = []
+    for i, leg_type in enumerate(plan.leg_type_names()):
+        for x, y in plan.leg(i):
+            data.append({'type': leg_type, 'x': x, 'y': y})
+    pd.DataFrame(data).to_excel(output_path, index=False)
+
+
+def run_one(fmt, num_vertices):
+    """Экспорт в одном формате; печатает время, пиковый RSS (МБ) и размер файла."""
+    plan = make_plan(num_vertices)
+    with tempfile.TemporaryDirectory() as folder:
+        output_path = os.path.join(folder, 'flight_paths' + FORMATS[fmt])
+        start = time.perf_counter()
+        if fmt == 'excel-legacy':
+            legacy_save_to_excel(plan, output_path)
+        else:
+            save_flight_paths_to_table(plan, output_path, UTM_CRS, fmt=fmt)
+        elapsed = time.perf_counter() - start
+        size = os.path.getsize(output_path)
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * RU_MAXRSS_UNIT / 2 ** 20
+    print(f"{elapsed:.3f} {peak_rss:.1f} {size / 2 ** 20:.1f}", file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--vertices', type=int, default=1_000_000)
+    parser.add_argument('--formats', nargs='+', choices=list(FORMATS), default=list(FORMATS))
+    parser.add_argument('--one', choices=list(FORMATS), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.one:
+        run_one(args.one, args.vertices)
+        return
+
+    print(f"{'формат':>13} {'вершин':>9} {'время, с':>9} {'пик RSS, МБ':>12} {'файл, МБ':>9}")
+    for fmt in args.formats:
+        result = subprocess.run([sys.executable, '-m', 'benchmarks.bench_table_export',
+                                 '--one', fmt, '--vertices', str(args.vertices)],
+                                stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True, check=True)
+        elapsed, peak_rss, size = result.stderr.split()[-3:]
+        print(f"{fmt:>13} {args.vertices:>9} {float(elapsed):>9.3f} {float(peak_rss):>12.1f} {float(size):>9.1f}")
+
+
+if __name__ == '__main__':
+    main()
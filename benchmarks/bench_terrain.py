@@ -0,0 +1,128 @@
+"""Учет рельефа: чтение окна ЦМР через memmap и планирование вылетов с ЦМР и без.
+
+Запуск из корня проекта:
+
+    python -m benchmarks.bench_terrain
+    python -m benchmarks.bench_terrain --cells 10000 --raster 8000
+"""
+import argparse
+import os
+import tempfile
+
+import geopandas as gpd
+import numpy as np
+
+from benchmarks.bench_grid import FLIGHT_RADIUS, SPRAY_WIDTH, make_field, timed
+from drones import drones
+from routing import calculate_flight_path, generate_flight_grid
+from simulation import simulate_route
+from sorties import schedule_sorties
+from terrain import ElevationModel, open_dem, save_dem, terrain_profile
+
+
+def make_dem(path, bounds, size, resolution, num_hills=20, seed=0):
+    """Синтетическая ЦМР size x size ячеек с центром в центре bounds.
+
+    Рельеф - наклонная плоскость и холмы, разбросанные по bounds, с
+    шириной в долю их стороны. Растр формируется и сохраняется через
+    save_dem построчными блоками, чтобы не держать в памяти больше одного
+    блока промежуточных массивов.
+    """
+    rng = np.random.default_rng(seed)
+    minx, miny, maxx, maxy = bounds
+    center = ((minx + maxx) / 2, (miny + maxy) / 2)
+    side = max(maxx - minx, maxy - miny)
+    extent = size * resolution
+    origin = (center[0] - extent / 2, center[1] + extent / 2)
+    hills = rng.uniform((minx, miny), (maxx, maxy), (num_hills, 2))
+    heights = rng.uniform(2, 15, num_hills)
+    widths = rng.uniform(0.1, 0.4, num_hills) * side
+
+    data = np.empty((size, size), dtype=np.float32)
+    x = origin[0] + (np.arange(size) + 0.5) * resolution
+    for first in range(0, size, 512):
+        y = origin[1] - (np.arange(first, min(first + 512, size)) + 0.5) * resolution
+        gx, gy = np.meshgrid(x, y)
+        block = 150 + 0.01 * (gx - center[0])
+        for (hx, hy), height, width in zip(hills, heights, widths):
+            block += height * np.exp(-((gx - hx) ** 2 + (gy - hy) ** 2) / (2 * width ** 2))
+        data[first:first + len(y)] = block
+    save_dem(path, data, origin, resolution)
+
+
+def check_flat_outside():
+    """Проверка terrain_profile: вне ЦМР рельеф ровный, высоты соседних отрезков не используются.
+
+    ЦМР 10 x 10 ячеек по 1 м с высотой, равной x. Отрезки: целиком вне
+    ЦМР, выходящий из нее, целиком внутри и входящий в нее.
+    """
+    dem = ElevationModel(np.tile(np.arange(10) + 0.5, (10, 1)), (0, 10), 1.0)
+    origins = np.array([[20, 5], [5, 5], [2, 5], [12, 5]], dtype=float)
+    targets = np.array([[30, 5], [15, 5], [8, 5], [-3, 5]], dtype=float)
+    ascent, descent = terrain_profile(origins, targets, dem)
+    assert np.allclose(ascent, [0, 4.5, 6, 0]), f"подъем вне ЦМР: {ascent}"
+    assert np.allclose(descent, [0, 0, 0, 9]), f"спуск вне ЦМР: {descent}"
+
+
+def load_full(path, bounds):
+    """Исходный вариант: весь растр читается в память, затем выбирается окно."""
+    dem = open_dem(path)
+    return ElevationModel(np.array(dem.data), dem.origin, dem.resolution).window(bounds)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--cells', type=int, default=2000)
+    parser.add_argument('--raster', type=int, default=4000, help="размер ЦМР в ячейках по стороне")
+    parser.add_argument('--resolution', type=float,
+                        help="размер ячейки ЦМР, м (по умолчанию растр покрывает поле и точку старта)")
+    parser.add_argument('--drone', default="DJI Agras T30", choices=list(drones))
+    args = parser.parse_args()
+    check_flat_outside()
+
+    field = make_field(args.cells)
+    grid = gpd.GeoDataFrame(geometry=generate_flight_grid(field, SPRAY_WIDTH, FLIGHT_RADIUS).geometry.values)
+    minx, miny, maxx, maxy = field.bounds
+    start = (minx - (maxx - minx) / 10, (miny + maxy) / 2)
+    bounds = (start[0], miny, maxx, maxy)
+    resolution = args.resolution or max(maxx - start[0], maxy - miny) / args.raster
+
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, 'dem.npy')
+        make_dem(path, bounds, args.raster, resolution)
+        size_mb = os.path.getsize(path) / 2 ** 20
+
+        flight_paths = calculate_flight_path(grid, start, SPRAY_WIDTH, [], workers=1)
+        vertices = flight_paths.vertices
+
+        print(f"ЦМР {args.raster} x {args.raster} по {resolution:.2f} м ({size_mb:.0f} МБ), квадратов {len(grid)}, "
+              f"вершин маршрута {len(vertices)}")
+        print(f"{'этап':<34} {'время, с':>10}")
+        full, slow = timed(load_full, path, bounds)
+        window, fast = timed(open_dem, path, bounds)
+        print(f"{'чтение ЦМР целиком':<34} {slow:>10.3f}")
+        print(f"{'окно ЦМР через memmap':<34} {fast:>10.3f}")
+
+        (ascent, descent), profile = timed(terrain_profile, vertices[:-1], vertices[1:], window)
+        full_ascent, _ = terrain_profile(vertices[:-1], vertices[1:], full)
+        assert np.allclose(ascent, full_ascent), "профили по окну и по всему растру не совпадают"
+        print(f"{'профиль рельефа маршрута':<34} {profile:>10.3f}")
+
+        drone = drones[args.drone].get_properties()
+        flat, flat_time = timed(schedule_sorties, flight_paths, grid.area.values, drone)
+        hilly, hilly_time = timed(lambda: schedule_sorties(flight_paths, grid.area.values, drone,
+                                                           terrain=window))
+        print(f"{'вылеты без рельефа':<34} {flat_time:>10.3f}")
+        print(f"{'вылеты с рельефом':<34} {hilly_time:>10.3f}")
+
+        timeline, simulation = timed(lambda: simulate_route(drone, hilly.to_flight_plan(flight_paths),
+                                                            start, terrain=window))
+        print(f"{'моделирование с рельефом':<34} {simulation:>10.3f}")
+        print(f"Подъем по маршруту {ascent.sum():.0f} м, спуск {descent.sum():.0f} м")
+        print(f"Вылетов: без рельефа {len(flat)} ({flat.durations.sum() / 3600:.2f} ч), "
+              f"с рельефом {len(hilly)} ({hilly.durations.sum() / 3600:.2f} ч, "
+              f"по модели {timeline['time'][-1] / 3600:.2f} ч)")
+
+
+if __name__ == '__main__':
+    main()
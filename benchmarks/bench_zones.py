@@ -0,0 +1,70 @@
+"""Сравнение фильтрации запретных зон через STRtree с исходным перебором.
+
+Запуск из корня проекта:
+
+    python -m benchmarks.bench_zones
+    python -m benchmarks.bench_zones --cells 100000 --zones 100 500
+"""
+import argparse
+
+import geopandas as gpd
+import numpy as np
+import shapely
+
+from benchmarks.bench_grid import FLIGHT_RADIUS, SPRAY_WIDTH, make_field, timed
+from routing import generate_flight_grid, remove_restricted_areas
+
+
+def legacy_remove_restricted_areas(grid, restricted_areas):
+    """Исходная реализация: предварительная проверка и фильтр двойным перебором."""
+    has_intersections = any(
+        any(square.intersects(restricted_area) for restricted_area in restricted_areas)
+        for square in grid.geometry
+    )
+    if not has_intersections:
+        return grid
+
+    valid_grid = []
+    for square in grid.geometry:
+        if square.is_valid:
+            if not any(square.intersects(restricted_area) for restricted_area in restricted_areas):
+                valid_grid.append(square)
+    return gpd.GeoDataFrame(geometry=valid_grid)
+
+
+def make_zones(field, num_zones, seed=0):
+    """Случайные круглые запретные зоны внутри bbox поля."""
+    rng = np.random.default_rng(seed)
+    minx, miny, maxx, maxy = field.bounds
+    radius = (maxx - minx) / (4 * np.sqrt(num_zones))
+    x = rng.uniform(minx, maxx, num_zones)
+    y = rng.uniform(miny, maxy, num_zones)
+    return list(shapely.buffer(shapely.points(x, y), rng.uniform(0.2, 1.0, num_zones) * radius))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--cells', type=int, default=100_000)
+    parser.add_argument('--zones', type=int, nargs='+', default=[10, 100, 500])
+    parser.add_argument('--no-legacy', action='store_true', help="не запускать исходную реализацию")
+    args = parser.parse_args()
+
+    field = make_field(args.cells)
+    grid = generate_flight_grid(field, SPRAY_WIDTH, FLIGHT_RADIUS)
+
+    print(f"{'квадратов':>10} {'зон':>6} {'осталось':>10} {'STRtree, с':>11} {'исходная, с':>12} {'ускорение':>10}")
+    for num_zones in args.zones:
+        zones = make_zones(field, num_zones)
+        valid_grid, fast = timed(remove_restricted_areas, grid, zones)
+
+        if args.no_legacy:
+            print(f"{len(grid):>10} {num_zones:>6} {len(valid_grid):>10} {fast:>11.3f} {'-':>12} {'-':>10}")
+            continue
+
+        legacy_grid, slow = timed(legacy_remove_restricted_areas, grid, zones)
+        assert len(valid_grid) == len(legacy_grid), "число оставшихся квадратов не совпадает"
+        print(f"{len(grid):>10} {num_zones:>6} {len(valid_grid):>10} {fast:>11.3f} {slow:>12.3f} {slow / fast:>9.1f}x")
+
+
+if __name__ == '__main__':
+    main()
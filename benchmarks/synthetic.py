@@ -0,0 +1,93 @@
+"""Синтетические поля и запретные зоны заданного размера для бенчмарков.
+
+Поля строятся в метрах зоны UTM (UTM_CRS) вокруг точки ORIGIN, поэтому их
+можно передавать во все этапы конвейера, включая экспорт в GeoJSON. Все
+генераторы детерминированы: одинаковые параметры и seed дают одинаковую
+геометрию.
+"""
+import numpy as np
+import shapely
+from shapely import affinity
+from shapely.geometry import Polygon
+
+# Зона UTM синтетических полей (39N - Удмуртия) и центр поля в ней
+UTM_CRS = "EPSG:32639"
+ORIGIN = (500_000.0, 6_300_000.0)
+
+# Формы полей: выпуклое, невыпуклое (с заливами), выпуклое с дырами
+FIELD_SHAPES = ('convex', 'concave', 'holes')
+# Доля площади поля под запретными зонами
+ZONE_COVERAGE = 0.05
+# Число вершин контура поля
+FIELD_VERTICES = 96
+
+
+def make_field(area_ha, shape='convex', seed=0):
+    """Поле площадью area_ha га формы shape (см. FIELD_SHAPES) с центром в ORIGIN.
+
+    convex - эллипс со случайными вытянутостью и поворотом, concave -
+    контур с волнистым радиусом (заливы и мысы), holes - эллипс с
+    несколькими внутренними дырами (пруды, постройки).
+    """
+    if shape not in FIELD_SHAPES:
+        raise ValueError(f"Неизвестная форма поля: {shape}")
+    rng = np.random.default_rng(seed)
+    angles = np.linspace(0, 2 * np.pi, FIELD_VERTICES, endpoint=False)
+    aspect = rng.uniform(1, 2)
+
+    if shape == 'concave':
+        waves = rng.integers(3, 6)
+        radius = 1 + 0.35 * np.sin(waves * angles + rng.uniform(0, 2 * np.pi))
+        radius *= rng.uniform(0.9, 1.1, len(angles))
+    else:
+        radius = np.ones(len(angles))
+    field = Polygon(np.column_stack((aspect * radius * np.cos(angles), radius * np.sin(angles))))
+
+    if shape == 'holes':
+        num_holes = rng.integers(3, 9)
+        centers = rng.uniform(-0.6, 0.6, (num_holes, 2)) * (aspect, 1)
+        holes = shapely.buffer(shapely.points(centers), rng.uniform(0.05, 0.15, num_holes), quad_segs=4)
+        field = field.difference(shapely.union_all(holes))
+        # Дыры у края могут разрезать поле - оставляем самую большую часть
+        if field.geom_type == 'MultiPolygon':
+            field = max(field.geoms, key=lambda part: part.area)
+
+    field = affinity.rotate(field, rng.uniform(0, 180), origin=(0, 0))
+    field = affinity.scale(field, *(2 * [np.sqrt(area_ha * 10_000 / field.area)]), origin=(0, 0))
+    return affinity.translate(field, *ORIGIN)
+
+
+def make_zones(field, count, coverage=ZONE_COVERAGE, seed=0):
+    """count запретных зон (многоугольников) с центрами внутри поля, вместе ~coverage его площади.
+
+    Размеры зон различаются в 3 раза, зоны могут пересекаться между собой
+    и выходить за границу поля, как в реальных данных.
+    """
+    if not count:
+        return []
+    rng = np.random.default_rng(seed)
+    minx, miny, maxx, maxy = field.bounds
+    shapely.prepare(field)
+
+    centers = np.empty((0, 2))
+    while len(centers) < count:
+        candidates = rng.uniform((minx, miny), (maxx, maxy), (2 * count, 2))
+        centers = np.vstack((centers, candidates[shapely.contains_xy(field, *candidates.T)]))
+    centers = centers[:count]
+
+    radius = np.sqrt(coverage * field.area / (count * np.pi))
+    radii = radius * rng.uniform(0.5, 1.5, count)
+    return list(shapely.buffer(shapely.points(centers), radii, quad_segs=2))
+
+
+def make_start_point(field, offset=0.05):
+    """Точка старта слева от поля на расстоянии offset его ширины."""
+    minx, miny, maxx, maxy = field.bounds
+    return minx - offset * (maxx - minx), (miny + maxy) / 2
+
+
+def make_scenario(area_ha, shape='convex', num_zones=1, seed=0):
+    """Поле, запретные зоны и точка старта одного сценария."""
+    field = make_field(area_ha, shape, seed)
+    return field, make_zones(field, num_zones, seed=seed + 1), make_start_point(field)
+
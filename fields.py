@@ -1,51 +1,211 @@
-from pyproj import Proj, Transformer
+import json
+from functools import cached_property, lru_cache
+
+import numpy as np
+from pyproj import Transformer
 import geojson
+import shapely
 from shapely.geometry import Polygon
 
-def convert_to_utm(lon, lat):
+WGS84 = "EPSG:4326"
+# Знаков после запятой в координатах, как при чтении через geojson.load
+GEOJSON_PRECISION = 6
+
+
+@lru_cache(maxsize=None)
+def get_transformer(src_crs, dst_crs):
+    """Возвращает общий для процесса Transformer для пары систем координат."""
+    return Transformer.from_crs(src_crs, dst_crs, always_xy=True)
+
+
+def transform_coords(x, y, src_crs, dst_crs):
+    """Преобразует массивы координат из src_crs в dst_crs одним вызовом."""
+    return get_transformer(src_crs, dst_crs).transform(np.asarray(x, dtype=float),
+                                                       np.asarray(y, dtype=float))
+
+
+def utm_crs_for(lon, lat):
+    """Подбирает зону UTM по центру переданных координат (в градусах)."""
+    lon = np.asarray(lon, dtype=float)
+    lat = np.asarray(lat, dtype=float)
+    center_lon = (lon.min() + lon.max()) / 2
+    center_lat = (lat.min() + lat.max()) / 2
+    zone = int((center_lon + 180) // 6) % 60 + 1
+    return f"EPSG:{32600 + zone if center_lat >= 0 else 32700 + zone}"
+
+
+def convert_to_utm(lon, lat, utm_crs=None):
+    """Преобразует долготу/широту (числа или массивы) в метры UTM.
+
+    Если зона не задана, она определяется по самим координатам.
+    """
+    if utm_crs is None:
+        utm_crs = utm_crs_for(lon, lat)
+    return transform_coords(lon, lat, WGS84, utm_crs)
+
+
+def convert_from_utm(x, y, utm_crs):
+    """Преобразует метры UTM (числа или массивы) обратно в долготу/широту."""
+    return transform_coords(x, y, utm_crs, WGS84)
+
+
+def load_fields(geojson_path, utm_crs=None):
+    """Загружает все поля (полигоны и мультиполигоны, с дырами) из файла GeoJSON.
+
+    Файл разбирается модулем json: для сотен полей это в несколько раз
+    быстрее geojson.load, который создает объект на каждую геометрию.
+    Координаты округляются так же, как в geojson.load.
+
+    Возвращает словарь fields_from_geojson; при ошибке чтения - None.
+    """
+    try:
+        with open(geojson_path) as f:
+            return fields_from_geojson(json.load(f), utm_crs)
+
+    except (FileNotFoundError, KeyError, IndexError, ValueError) as e:
+        print(f"Ошибка при загрузке полей из {geojson_path}: {e}")
+        return None
+
+
+def fields_from_geojson(data, utm_crs=None):
+    """Поля FeatureCollection в метрах UTM: геометрии и площади массивами.
+
+    Кольца всех объектов собираются в один массив координат и переводятся
+    в UTM одним вызовом, а геометрии строятся из него пакетно
+    (shapely.from_ragged_array). Зона UTM по умолчанию - по центру всех
+    полей. Объекты без площадной геометрии пропускаются. Возвращает
+    словарь: 'geometries' (массив Polygon/MultiPolygon), 'areas' (га),
+    'features' (номера объектов в файле), 'properties', 'utm_crs'.
+    """
+    rings, ring_counts, part_counts, features, properties = [], [], [], [], []
+    for i, feature in enumerate(data['features']):
+        geometry = feature.get('geometry') or {}
+        if geometry.get('type') == 'Polygon':
+            polygons = [geometry['coordinates']]
+        elif geometry.get('type') == 'MultiPolygon':
+            polygons = geometry['coordinates']
+        else:
+            continue
+        for polygon in polygons:
+            rings.extend(np.asarray(ring, dtype=float)[:, :2] for ring in polygon)
+            ring_counts.append(len(polygon))
+        part_counts.append(len(polygons))
+        features.append(i)
+        properties.append(feature.get('properties') or {})
+
+    if not rings:
+        return {'geometries': np.empty(0, dtype=object), 'areas': np.zeros(0),
+                'features': np.zeros(0, dtype=np.int64), 'properties': [], 'utm_crs': utm_crs}
 
-    wgs84 = Proj("EPSG:4326")  # WGS84
-    utm = Proj("EPSG:32640")  # UTM зона 40 - северная широта
-    transformer = Transformer.from_proj(wgs84, utm)
-    x, y = transformer.transform(lon, lat)
+    lonlat = np.concatenate(rings).round(GEOJSON_PRECISION)
+    if utm_crs is None:
+        utm_crs = utm_crs_for(lonlat[:, 0], lonlat[:, 1])
+    x, y = convert_to_utm(lonlat[:, 0], lonlat[:, 1], utm_crs)
+
+    offsets = tuple(np.concatenate(([0], np.cumsum(counts, dtype=np.int64)))
+                    for counts in ([len(ring) for ring in rings], ring_counts, part_counts))
+    geometries = shapely.from_ragged_array(shapely.GeometryType.MULTIPOLYGON, np.column_stack((x, y)), offsets)
+    # Мультиполигоны из одной части возвращаются полигонами
+    single = shapely.get_num_geometries(geometries) == 1
+    geometries[single] = shapely.get_geometry(geometries[single], 0)
+    return {'geometries': geometries,
+            'areas': shapely.area(geometries) / 10000,
+            'features': np.asarray(features, dtype=np.int64),
+            'properties': properties,
+            'utm_crs': utm_crs}
 
-    return x, y
 
 class FieldProcessor:
+    """Данные поля из файлов GeoJSON в метрах UTM: поле, запретные зоны, точки старта.
+
+    Конструктор только запоминает пути. Каждый файл читается один раз при
+    первом обращении к зависящему от него свойству, а вычисленные свойства
+    (field_coords, restricted_zones, start_point, launch_points, utm_crs,
+    field_area, fields) запоминаются.
+    """
 
     def __init__(self, field_geojson_path, restricted_geojson_path, start_point_geojson_path):
         self.field_geojson_path = field_geojson_path
         self.restricted_geojson_path = restricted_geojson_path
         self.start_point_geojson_path = start_point_geojson_path
-        self.field_coords = self.load_field_coords()
-        self.restricted_zones = self.load_restricted_zones()
-        self.start_point = self.load_start_point()
+        self._geojson = {}
+
+    @cached_property
+    def utm_crs(self):
+        """Зона UTM поля (если файл поля не читается - по запретным зонам или точкам старта)."""
+        for path in (self.field_geojson_path, self.restricted_geojson_path, self.start_point_geojson_path):
+            try:
+                lonlat = np.asarray([c[:2] for c in geojson.utils.coords(self.read_geojson(path))], dtype=float)
+            except (FileNotFoundError, ValueError):
+                continue
+            if len(lonlat):
+                return utm_crs_for(lonlat[:, 0], lonlat[:, 1])
+        return None
+
+    @cached_property
+    def field_coords(self):
+        """Координаты внешнего контура первого поля в метрах."""
+        return self.load_field_coords()
+
+    @cached_property
+    def restricted_zones(self):
+        """Запретные зоны (полигоны в метрах)."""
+        return self.load_restricted_zones()
+
+    @cached_property
+    def start_point(self):
+        """Начальная точка [x, y] в метрах."""
+        return self.load_start_point()
+
+    @cached_property
+    def launch_points(self):
+        """Все точки старта [[x, y], ...] в метрах."""
+        return self.load_launch_points()
+
+    @cached_property
+    def field_area(self):
+        """Площадь поля в гектарах."""
+        return self.calculate_field_area()
+
+    @cached_property
+    def fields(self):
+        """Все поля файла поля (словарь fields_from_geojson) в зоне UTM поля."""
+        try:
+            return fields_from_geojson(self.read_geojson(self.field_geojson_path), self.utm_crs)
+
+        except (FileNotFoundError, KeyError, IndexError, ValueError) as e:
+            print(f"Ошибка при загрузке полей: {e}")
+            return None
+
+    def read_geojson(self, path):
+        """Содержимое файла GeoJSON; файл читается один раз на объект."""
+        if path not in self._geojson:
+            with open(path) as f:
+                self._geojson[path] = geojson.load(f)
+        return self._geojson[path]
 
     def load_field_coords(self):
         """Загружает координаты поля из файла GeoJSON и преобразует их в метры."""
         try:
-            with open(self.field_geojson_path) as f:
-                field_data = geojson.load(f)
-            field_coords = field_data['features'][0]['geometry']['coordinates'][0]
+            field_data = self.read_geojson(self.field_geojson_path)
+            field_coords = np.asarray(field_data['features'][0]['geometry']['coordinates'][0])[:, :2]
 
             # Преобразуем координаты из градусов в метры
-            transformed_coords = [convert_to_utm(lon, lat) for lon, lat in field_coords]
-            return transformed_coords
+            x, y = self.to_utm(field_coords[:, 0], field_coords[:, 1])
+            return list(zip(x, y))
 
         except (FileNotFoundError, KeyError, IndexError) as e:
             print(f"Ошибка при загрузке координат поля: {e}")
             return []
 
     def load_restricted_zones(self):
-        """Загружает координаты запретных зон из файла GeoJSON."""
+        """Загружает запретные зоны из файла GeoJSON (все объекты, с дырами) в метрах."""
 
         try:
-            with open(self.restricted_geojson_path) as f:
-                restricted_data = geojson.load(f)
-            restricted_zones = [Polygon(zone['geometry']['coordinates'][0]) for zone in restricted_data['features']]
-            return restricted_zones
+            zones = fields_from_geojson(self.read_geojson(self.restricted_geojson_path), self.utm_crs)
+            return list(zones['geometries'])
 
-        except (FileNotFoundError, KeyError, IndexError) as e:
+        except (FileNotFoundError, KeyError, IndexError, ValueError) as e:
             print(f"Ошибка при загрузке запретных зон: {e}")
             return []
 
@@ -53,15 +213,34 @@ class FieldProcessor:
         """Загружает координаты начальной точки из файла GeoJSON."""
 
         try:
-            with open(self.start_point_geojson_path) as f:
-                start_data = geojson.load(f)
-            start_point = start_data['features'][0]['geometry']['coordinates']
-            return start_point
+            start_data = self.read_geojson(self.start_point_geojson_path)
+            lon, lat = start_data['features'][0]['geometry']['coordinates'][:2]
+            x, y = self.to_utm(lon, lat)
+            return [float(x), float(y)]
 
         except (FileNotFoundError, KeyError, IndexError) as e:
             print(f"Ошибка при загрузке начальной точки: {e}")
             return []
 
+    def load_launch_points(self):
+        """Загружает все точки старта из файла GeoJSON (для нескольких дронов) в метрах."""
+
+        try:
+            start_data = self.read_geojson(self.start_point_geojson_path)
+            lonlat = np.array([feature['geometry']['coordinates'][:2] for feature in start_data['features']])
+            if not len(lonlat):
+                return []
+            x, y = self.to_utm(lonlat[:, 0], lonlat[:, 1])
+            return np.column_stack((x, y)).tolist()
+
+        except (FileNotFoundError, KeyError, IndexError) as e:
+            print(f"Ошибка при загрузке точек старта: {e}")
+            return []
+
+    def to_utm(self, lon, lat):
+        """Преобразует координаты в зону UTM поля."""
+        return convert_to_utm(lon, lat, self.utm_crs)
+
     def calculate_field_area(self):
         """Вычисляет площадь поля в гектарах."""
         polygon = Polygon(self.field_coords)
@@ -69,19 +248,21 @@ class FieldProcessor:
 
     def process_field(self):
         """Обрабатывает поле и возвращает необходимые данные для дальнейшего использования."""
-        field_area = self.calculate_field_area()
         processed_data = {
             'field_coords': self.field_coords,
             'restricted_zones': self.restricted_zones,
             'start_point': self.start_point,
-            'field_area': field_area
+            'launch_points': self.launch_points,
+            'utm_crs': self.utm_crs,
+            'field_area': self.field_area
         }
         return processed_data
 
 
-field_processor = FieldProcessor('field.geojson',
-                                 'restrict_area.geojson',
-                                 'point_start.geojson'
-                                 )
-processed_data = field_processor.process_field()
-print(f"Площадь поля: {processed_data['field_area']} га")
\ No newline at end of file
+if __name__ == '__main__':
+    field_processor = FieldProcessor('field.geojson',
+                                     'restrict_area.geojson',
+                                     'point_start.geojson'
+                                     )
+    processed_data = field_processor.process_field()
+    print(f"Площадь поля: {processed_data['field_area']} га")
@@ -0,0 +1,221 @@
+import json
+import os
+
+import numpy as np
+from fields import convert_from_utm
+from flight_plan import FlightPlan, LEG_TO, LEG_BACK
+from geojson_export import stream_flight_paths_to_geojson
+from sorties import cell_entry_exit, cell_transit_lengths, schedule_sorties
+from transit import reroute_transit
+
+
+class FleetAllocation:
+    """Распределение вылетов между несколькими дронами.
+
+    Для дрона k: модель drones[k] (словарь свойств Drone), точка старта
+    launch_points[k], вылеты sorties_of(k) в порядке выполнения и время
+    окончания работы finish_times[k] (с). Вылеты хранятся одним SortiePlan
+    на точку старта: sortie_plans[launch_of[k]], а их маршруты (в обход
+    запретных зон) - одним FlightPlan routes[launch_of[k]] в порядке
+    вылетов, каждый вылет начинается с подлета.
+    """
+
+    __slots__ = ('drones', 'launch_points', 'launch_of', 'sortie_plans', 'routes',
+                 'sortie_ids', 'offsets', 'finish_times', 'solution')
+
+    def __init__(self, drones, launch_points, launch_of, sortie_plans, routes, sortie_ids, offsets, finish_times,
+                 solution):
+        self.drones = drones
+        self.launch_points = np.asarray(launch_points, dtype=float).reshape(-1, 2)
+        self.launch_of = np.asarray(launch_of, dtype=np.int64)
+        self.sortie_plans = sortie_plans
+        self.routes = routes
+        self.sortie_ids = np.asarray(sortie_ids, dtype=np.int64)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.finish_times = np.asarray(finish_times, dtype=float)
+        self.solution = np.asarray(solution, dtype=float)
+
+    def __len__(self):
+        return len(self.drones)
+
+    @property
+    def makespan(self):
+        """Время до окончания работы последнего дрона (с)."""
+        return float(self.finish_times.max()) if len(self) else 0.0
+
+    def sorties_of(self, k):
+        """Номера вылетов дрона k (в SortiePlan его точки старта) в порядке выполнения."""
+        return self.sortie_ids[self.offsets[k]:self.offsets[k + 1]]
+
+    def flight_plan_of(self, k):
+        """FlightPlan дрона k: все его вылеты от его точки старта в обход запретных зон."""
+        routes = self.routes[self.launch_of[k]]
+        bounds = np.append(np.flatnonzero(routes.leg_types == LEG_TO), len(routes))
+        sorties = self.sorties_of(k)
+        legs = [np.arange(bounds[i], bounds[i + 1]) for i in sorties]
+        return routes.take(np.concatenate(legs) if legs else np.empty(0, dtype=np.int64))
+
+    def export_geojson(self, output_folder, utm_crs):
+        """Сохраняет точки старта дронов (launch_points.geojson) и маршрут каждого дрона (routes_drone_<k>.geojson)."""
+        os.makedirs(output_folder, exist_ok=True)
+
+        lon, lat = convert_from_utm(self.launch_points[:, 0], self.launch_points[:, 1], utm_crs)
+        features = [{
+            "type": "Feature",
+            "geometry": {"type": "Point", "coordinates": [round(lon[k], 6), round(lat[k], 6)]},
+            "properties": {"drone": k,
+                           "model": self.drones[k]['name'],
+                           "sorties": len(self.sorties_of(k)),
+                           "finish_time_min": round(self.finish_times[k] / 60, 2),
+                           "solution_l": round(self.solution[k], 2)}
+        } for k in range(len(self))]
+        launch_path = os.path.join(output_folder, "launch_points.geojson")
+        with open(launch_path, 'w') as f:
+            json.dump({"type": "FeatureCollection", "features": features}, f, ensure_ascii=False)
+        print("Точки старта дронов сохранены в:", launch_path)
+
+        for k in range(len(self)):
+            stream_flight_paths_to_geojson(self.flight_plan_of(k),
+                                           os.path.join(output_folder, f"routes_drone_{k}.geojson"),
+                                           utm_crs)
+
+
+def allocate_drones(flight_plan, cell_areas, drones, launch_points, launch_of=None, turnaround_time=0.0,
+                    restricted_zones=None):
+    """Распределяет квадраты сетки между несколькими дронами, минимизируя время работы последнего.
+
+    drones - список словарей свойств дронов (модели можно смешивать),
+    launch_points - точки старта в метрах, launch_of[k] - номер точки
+    старта дрона k (по умолчанию дроны распределяются по точкам по кругу),
+    turnaround_time - время на замену батареи и заправку между вылетами (с),
+    restricted_zones - запретные зоны, которые облетают все транзитные
+    участки (подлеты, возвраты и перелеты между квадратами).
+
+    1. Для каждой точки старта подлеты и возвраты всех квадратов строятся
+       от нее в обход зон (reroute_transit). Каждый квадрат относится к
+       одной из точек: к ближайшей по длине подлета, с поправочными весами
+       точек, которые выравнивают оценку времени работы команд точек
+       (взвешенная диаграмма Вороного).
+    2. Квадраты каждой точки группируются в вылеты schedule_sorties с самыми
+       жесткими ограничениями среди дронов этой точки (дальность полета за
+       заряд и площадь на бак), поэтому любой вылет по силам любому из них.
+       Запас хода расходуется по длинам подлетов и возвратов в обход зон;
+       длины вылетов берутся по итоговому маршруту, где в обход зон идут и
+       перелеты между квадратами.
+    3. Вылеты по убыванию длины раздаются дронам жадно: вылет получает дрон,
+       который закончит его раньше всех (с учетом своей скорости).
+    """
+    launch_points = np.asarray(launch_points, dtype=float).reshape(-1, 2)
+    if launch_of is None:
+        launch_of = np.arange(len(drones)) % len(launch_points)
+    launch_of = np.asarray(launch_of, dtype=np.int64)
+
+    speeds = np.array([drone['speed'] for drone in drones], dtype=float)
+    ranges = np.array([drone['flight_time'] * 60 * drone['speed'] for drone in drones])
+    hectares_per_tank = np.array([drone['efficiency'] for drone in drones], dtype=float)
+    liters_per_ha = np.array([drone['tank_capacity'] / drone['efficiency'] for drone in drones])
+    areas_ha = np.asarray(cell_areas, dtype=float) / 10000
+    zones = [] if restricted_zones is None else list(restricted_zones)
+
+    # 1. Квадраты - к точкам старта (взвешенно по ближайшей, с балансировкой нагрузки)
+    _, _, spray_length = cell_entry_exit(flight_plan)
+    used = np.unique(launch_of)
+    launch_plans = {launch: _launch_cell_plan(flight_plan, launch_points[launch], zones) for launch in used}
+    distances = np.column_stack([cell_transit_lengths(launch_plans[launch])[0] for launch in used])
+    crew_speed = np.array([speeds[launch_of == launch].sum() for launch in used])
+    nearest = used[_balance_launch_areas(distances, spray_length, areas_ha[:len(spray_length)],
+                                         crew_speed, hectares_per_tank.min())]
+
+    finish_times = np.zeros(len(drones))
+    solution = np.zeros(len(drones))
+    assigned = [[] for _ in drones]
+    sortie_plans = [None] * len(launch_points)
+    routes = [None] * len(launch_points)
+
+    for launch in used:
+        crew = np.flatnonzero(launch_of == launch)
+
+        # 2. Общие ограничения для дронов точки: скорость 1 м/с, время = дальность
+        common_drone = {'speed': 1.0,
+                        'flight_time': ranges[crew].min() / 60,
+                        'tank_capacity': hectares_per_tank[crew].min(),
+                        'efficiency': hectares_per_tank[crew].min()}
+        launch_plan = launch_plans[launch]
+        plan = schedule_sorties(launch_plan, cell_areas, common_drone, cell_ids=np.flatnonzero(nearest == launch))
+        # Итоговый маршрут точки: перелеты между квадратами тоже в обход зон
+        routes[launch] = reroute_transit(plan.to_flight_plan(launch_plan), zones, launch_points[launch])
+        starts = np.flatnonzero(routes[launch].leg_types == LEG_TO)
+        lengths = np.add.reduceat(routes[launch].leg_lengths(), starts) if len(starts) else np.empty(0)
+        # При скорости 1 м/с время вылета равно его длине
+        plan.durations, plan.distances = lengths, lengths.copy()
+        over = plan.feasible & (lengths > ranges[crew].min())
+        if over.any():
+            print(f"Вылетов, не укладывающихся в заряд после обхода зон между квадратами: {over.sum()}")
+            plan.feasible &= ~over
+        sortie_plans[launch] = plan
+
+        # 3. Жадное распределение вылетов: самый длинный - тому, кто раньше закончит
+        sortie_area = np.add.reduceat(areas_ha[plan.cells], plan.offsets[:-1]) if len(plan) else np.empty(0)
+        for sortie in np.argsort(-plan.distances, kind='stable'):
+            finish = finish_times[crew] + plan.distances[sortie] / speeds[crew] + turnaround_time
+            k = crew[np.argmin(finish)]
+            finish_times[k] = finish.min()
+            solution[k] += sortie_area[sortie] * liters_per_ha[k]
+            assigned[k].append(sortie)
+
+    # После последнего вылета замена батареи не нужна
+    finish_times[[bool(sorties) for sorties in assigned]] -= turnaround_time
+
+    offsets = np.concatenate(([0], np.cumsum([len(sorties) for sorties in assigned])))
+    sortie_ids = np.concatenate([np.asarray(sorties, dtype=np.int64) for sorties in assigned]) if drones else []
+    return FleetAllocation(list(drones), launch_points[launch_of], launch_of, sortie_plans, routes,
+                           sortie_ids, offsets, finish_times, solution)
+
+
+def _launch_cell_plan(flight_plan, launch_point, zones):
+    """План по квадратам, в котором подлеты и возвраты идут от launch_point в обход зон.
+
+    Участки обработки и точки входа и выхода квадратов берутся из
+    flight_plan; если его старт совпадает с launch_point, он возвращается
+    как есть.
+    """
+    launch_point = np.asarray(launch_point, dtype=float)[:2]
+    if np.array_equal(flight_plan.start_point(), launch_point):
+        return flight_plan
+    legs = np.flatnonzero(np.isin(flight_plan.leg_types, (LEG_TO, LEG_BACK)))
+    to_cell = flight_plan.leg_types[legs] == LEG_TO
+    first = flight_plan.vertices[flight_plan.offsets[legs]]
+    last = flight_plan.vertices[flight_plan.offsets[legs + 1] - 1]
+    origins = np.where(to_cell[:, None], launch_point, first)
+    targets = np.where(to_cell[:, None], last, launch_point)
+    straight = FlightPlan(np.stack((origins, targets), axis=1).reshape(-1, 2), np.arange(0, 2 * len(legs) + 1, 2),
+                          flight_plan.leg_types[legs], flight_plan.cells[legs])
+    return reroute_transit(flight_plan.replace(legs, straight), zones, launch_point)
+
+
+def _balance_launch_areas(distances, spray_length, areas_ha, crew_speed, hectares_per_tank, iterations=50):
+    """Номер точки старта для каждого квадрата: взвешенная диаграмма Вороного.
+
+    distances[i, j] - длина подлета к квадрату i от точки j (в обход зон).
+    Квадрат относится к точке с минимальным weight * расстояние. Оценка
+    работы команды точки: обработка квадратов плюс доля подлета и возврата
+    (пропорционально площади квадрата к площади на бак), деленная на
+    суммарную скорость дронов точки. Веса перегруженных точек растут, пока
+    оценки не выровняются; возвращается лучшее найденное разбиение.
+    """
+    num_cells, num_launches = distances.shape
+    if not num_cells or num_launches == 1:
+        return np.zeros(num_cells, dtype=np.int64)
+
+    work = spray_length[:, None] + 2 * distances * (areas_ha / hectares_per_tank)[:, None]
+
+    weights = np.ones(num_launches)
+    best, best_time = None, np.inf
+    for _ in range(iterations):
+        nearest = np.argmin(distances * weights, axis=1)
+        load = np.bincount(nearest, weights=work[np.arange(num_cells), nearest],
+                           minlength=num_launches) / crew_speed
+        if load.max() < best_time:
+            best, best_time = nearest, load.max()
+        weights *= np.sqrt(np.maximum(load, 1e-9) / max(load.mean(), 1e-9))
+    return best
@@ -0,0 +1,209 @@
+import numpy as np
+import shapely
+from shapely.geometry import Point
+
+# Коды типов участков маршрута
+LEG_TO = 0      # подлет от стартовой точки к квадрату
+LEG_BACK = 1    # возврат из квадрата на стартовую точку
+LEG_SPRAY = 2   # обработка квадрата галсами ("косилкой")
+LEG_HOP = 3     # перелет между квадратами внутри одного вылета
+LEG_TYPE_NAMES = ('to', 'back', 'spray', 'hop')
+
+
+class FlightPlan:
+    """Полетный план в виде массивов NumPy.
+
+    Каждый участок маршрута (leg) - ломаная. Вершины всех участков лежат
+    подряд в массиве vertices формы (N, 2), участок i занимает строки
+    vertices[offsets[i]:offsets[i + 1]]. Для участка хранятся код типа
+    (LEG_TO, LEG_BACK, LEG_SPRAY, LEG_HOP) и номер квадрата сетки.
+    """
+
+    __slots__ = ('vertices', 'offsets', 'leg_types', 'cells')
+
+    def __init__(self, vertices, offsets, leg_types, cells):
+        self.vertices = np.asarray(vertices, dtype=float).reshape(-1, 2)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.leg_types = np.asarray(leg_types, dtype=np.int8)
+        self.cells = np.asarray(cells, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.leg_types)
+
+    @classmethod
+    def from_grid(cls, grid, start_point, spray=None):
+        """Строит план для всех квадратов сетки: подлет, обработка, возврат.
+
+        spray - план обработки квадратов (участки LEG_SPRAY, номер квадрата в
+        cells), например результат routing.plan_spray_swaths. Без него дрон
+        летит к центру квадрата и обратно. Центры квадратов вычисляются один
+        раз, векторно по всей GeoSeries.
+        """
+        centroids = shapely.get_coordinates(shapely.centroid(as_geometry_array(grid)))
+        num_cells = len(centroids)
+        start = np.asarray(start_point, dtype=float)[:2]
+
+        # Вершины обработки каждого квадрата (для квадратов без обработки - пусто)
+        spray_lengths = np.zeros(num_cells, dtype=np.int64)
+        spray_vertices = np.empty((0, 2))
+        if spray is not None and len(spray):
+            order = np.argsort(spray.cells, kind='stable')
+            leg_lengths = np.diff(spray.offsets)[order]
+            np.add.at(spray_lengths, spray.cells[order], leg_lengths)
+            spray_vertices = spray.vertices[_leg_vertex_index(spray.offsets, order)]
+        has_spray = spray_lengths > 0
+        spray_starts = np.cumsum(spray_lengths) - spray_lengths
+
+        entry = centroids.copy()
+        exit_ = centroids.copy()
+        entry[has_spray] = spray_vertices[spray_starts[has_spray]]
+        exit_[has_spray] = spray_vertices[spray_starts[has_spray] + spray_lengths[has_spray] - 1]
+
+        # Для квадрата: [старт, вход] + вершины обработки + [выход, старт]
+        block_sizes = 4 + spray_lengths
+        blocks = np.cumsum(block_sizes) - block_sizes
+        vertices = np.empty((block_sizes.sum(), 2))
+        vertices[blocks] = start
+        vertices[blocks + 1] = entry
+        vertices[np.repeat(blocks + 2 - spray_starts, spray_lengths) + np.arange(len(spray_vertices))] = spray_vertices
+        vertices[blocks + 2 + spray_lengths] = exit_
+        vertices[blocks + 3 + spray_lengths] = start
+
+        # Начала участков: подлет, обработка (если есть), возврат
+        leg_starts = np.concatenate((blocks, blocks[has_spray] + 2, blocks + 2 + spray_lengths))
+        leg_types = np.concatenate((np.full(num_cells, LEG_TO), np.full(has_spray.sum(), LEG_SPRAY),
+                                    np.full(num_cells, LEG_BACK))).astype(np.int8)
+        cells = np.concatenate((np.arange(num_cells), np.flatnonzero(has_spray), np.arange(num_cells)))
+        order = np.argsort(leg_starts, kind='stable')
+        offsets = np.append(leg_starts[order], len(vertices))
+        return cls(vertices, offsets, leg_types[order], cells[order])
+
+    @classmethod
+    def from_paths(cls, flight_paths):
+        """Преобразует список словарей {'to_square': [...], 'back': [...]} в план."""
+        vertices, lengths, leg_types, cells = [], [], [], []
+        for cell, path in enumerate(flight_paths):
+            for key, leg_type in (('to_square', LEG_TO), ('back', LEG_BACK)):
+                points = path.get(key)
+                if not points:
+                    continue
+                vertices.extend(_point_xy(point) for point in points)
+                lengths.append(len(points))
+                leg_types.append(leg_type)
+                cells.append(cell)
+        offsets = np.concatenate(([0], np.cumsum(lengths, dtype=np.int64)))
+        return cls(vertices, offsets, leg_types, cells)
+
+    @classmethod
+    def concatenate(cls, plans, cell_offsets=None):
+        """Склеивает планы по порядку; к номерам квадратов i-го плана прибавляется cell_offsets[i]."""
+        plans = list(plans)
+        if not plans:
+            return cls(np.empty((0, 2)), [0], [], [])
+        if cell_offsets is None:
+            cell_offsets = np.zeros(len(plans), dtype=np.int64)
+
+        vertex_shifts = np.cumsum([0] + [len(plan.vertices) for plan in plans])
+        offsets = np.concatenate([plan.offsets[:-1] + shift for plan, shift in zip(plans, vertex_shifts)]
+                                 + [vertex_shifts[-1:]])
+        return cls(np.concatenate([plan.vertices for plan in plans]),
+                   offsets,
+                   np.concatenate([plan.leg_types for plan in plans]),
+                   np.concatenate([plan.cells + shift for plan, shift in zip(plans, cell_offsets)]))
+
+    def start_point(self):
+        """Стартовая точка плана - первая вершина первого подлета."""
+        to_legs = np.flatnonzero(self.leg_types == LEG_TO)
+        return self.vertices[self.offsets[to_legs[0]]] if to_legs.size else np.zeros(2)
+
+    def leg(self, i):
+        """Вершины участка i (представление без копирования)."""
+        return self.vertices[self.offsets[i]:self.offsets[i + 1]]
+
+    def take(self, legs):
+        """План из участков legs в заданном порядке (номера квадратов сохраняются)."""
+        legs = np.asarray(legs, dtype=np.int64)
+        lengths = self.offsets[legs + 1] - self.offsets[legs]
+        return FlightPlan(self.vertices[_leg_vertex_index(self.offsets, legs)],
+                          np.concatenate(([0], np.cumsum(lengths))),
+                          self.leg_types[legs], self.cells[legs])
+
+    def replace(self, legs, plan):
+        """Копия плана, в которой участки legs заменены участками plan (по порядку)."""
+        legs = np.asarray(legs, dtype=np.int64)
+        lengths = np.diff(self.offsets)
+        lengths[legs] = np.diff(plan.offsets)
+        offsets = np.concatenate(([0], np.cumsum(lengths)))
+        keep = np.ones(len(self), dtype=bool)
+        keep[legs] = False
+        kept = np.flatnonzero(keep)
+
+        vertices = np.empty((offsets[-1], 2))
+        vertices[_leg_vertex_index(offsets, kept)] = self.vertices[_leg_vertex_index(self.offsets, kept)]
+        vertices[_leg_vertex_index(offsets, legs)] = plan.vertices
+        leg_types = self.leg_types.copy()
+        leg_types[legs] = plan.leg_types
+        cells = self.cells.copy()
+        cells[legs] = plan.cells
+        return FlightPlan(vertices, offsets, leg_types, cells)
+
+    def segment_lengths(self):
+        """Длины всех отрезков между соседними вершинами (включая стыки участков)."""
+        return np.hypot(*np.diff(self.vertices, axis=0).T)
+
+    def leg_lengths(self):
+        """Длина каждого участка (сумма длин его отрезков), одним проходом по массиву."""
+        cumulative = np.concatenate(([0.0], np.cumsum(self.segment_lengths())))
+        first = np.minimum(self.offsets[:-1], len(self.vertices) - 1)
+        last = np.maximum(self.offsets[1:] - 1, first)
+        return cumulative[last] - cumulative[first]
+
+    def leg_type_names(self):
+        """Названия типов участков (LEG_TYPE_NAMES: 'to', 'back', 'spray', 'hop') для каждого участка."""
+        return np.asarray(LEG_TYPE_NAMES)[self.leg_types]
+
+    def vertex_leg_types(self):
+        """Код типа участка для каждой вершины."""
+        return np.repeat(self.leg_types, np.diff(self.offsets))
+
+    def route(self):
+        """Полный маршрут полета одной ломаной.
+
+        Соседние участки, у которых конец одного совпадает с началом
+        следующего, склеиваются без повторения общей вершины.
+        """
+        if not len(self):
+            return self.vertices[:0]
+        starts = self.offsets[1:-1]
+        duplicate = np.all(self.vertices[starts] == self.vertices[starts - 1], axis=1)
+        keep = np.ones(len(self.vertices), dtype=bool)
+        keep[starts[duplicate]] = False
+        return self.vertices[keep]
+
+
+def as_geometry_array(areas):
+    """Массив shapely-геометрий из GeoDataFrame, GeoSeries, списка или массива."""
+    if hasattr(areas, 'geometry'):
+        areas = areas.geometry
+    return np.asarray(getattr(areas, 'values', areas), dtype=object)
+
+
+def as_flight_plan(flight_paths):
+    """Приводит маршруты к FlightPlan (список словарей преобразуется)."""
+    if isinstance(flight_paths, FlightPlan):
+        return flight_paths
+    return FlightPlan.from_paths(flight_paths)
+
+
+def _leg_vertex_index(offsets, legs):
+    """Индексы вершин участков legs (в порядке legs) в массиве вершин плана."""
+    lengths = offsets[legs + 1] - offsets[legs]
+    starts = np.cumsum(lengths) - lengths
+    return np.repeat(offsets[legs] - starts, lengths) + np.arange(lengths.sum())
+
+
+def _point_xy(point):
+    """Координаты точки маршрута: shapely Point или пара (x, y)."""
+    if isinstance(point, Point):
+        return point.x, point.y
+    return point[0], point[1]
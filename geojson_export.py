@@ -1,38 +1,135 @@
+import json
+
 from shapely.geometry import LineString
+import numpy as np
 import geojson
-from fields import convert_to_utm
+from fields import convert_from_utm
+from flight_plan import FlightPlan, LEG_TYPE_NAMES, as_flight_plan
+from time_class import count, stage
+
+# Сколько участков маршрута переводится в градусы и сериализуется за раз
+STREAM_CHUNK_SIZE = 10000
+# Точность координат, как у geojson.dump по умолчанию
+COORDINATE_PRECISION = 6
+
 
+@stage('export_geojson')
+def export_flight_paths_to_geojson(flight_paths, output_path, utm_crs, stream=False):
+    """Экспортирует полетные маршруты в GeoJSON.
+
+    flight_paths - FlightPlan или список словарей маршрутов, координаты в
+    метрах зоны utm_crs. Все вершины переводятся в WGS84 одним векторным вызовом.
+    При stream=True файл пишется потоково (см. stream_flight_paths_to_geojson).
+    """
+    if stream:
+        return stream_flight_paths_to_geojson(flight_paths, output_path, utm_crs)
 
-def export_flight_paths_to_geojson(flight_paths, output_path):
-    """Экспортирует полетные маршруты в GeoJSON."""
     features = []
-    if not flight_paths:
+    plan = as_flight_plan(flight_paths)
+    if not len(plan):
         print("Нет данных для экспорта.")
         return
 
-    for path in flight_paths:
+    # Переводим все вершины всех маршрутов из UTM в градусы за один вызов
+    lon, lat = convert_from_utm(plan.vertices[:, 0], plan.vertices[:, 1], utm_crs)
+    lonlat = np.column_stack((lon, lat))
+    nonfinite = _nonfinite_legs(lonlat, plan.offsets)
+
+    for i, leg_type in enumerate(plan.leg_type_names()):
         # проверка на корректность данных координат
-        if path.get('to_square') and isinstance(path['to_square'], list):
-            try:
-                # line = LineString(path['to_square'])
-                utm_coordinates_to_square = [convert_to_utm(point.x, point.y) for point in path['to_square']]
-                line = LineString(utm_coordinates_to_square)
-                features.append(geojson.Feature(geometry=line, properties={"type": "to"}))
-            except ValueError:
-                print(f"Неправильные координаты для маршрута 'to_square': {path['to_square']}")
-
-        if path.get('back') and isinstance(path['back'], list):
-            try:
-                # line = LineString(path['back'])
-                utm_coordinates_back = [convert_to_utm(point.x, point.y) for point in path['back']]
-                line = LineString(utm_coordinates_back)
-                features.append(geojson.Feature(geometry=line, properties={"type": "back"}))
-            except ValueError:
-                print(f"Неправильные координаты для маршрута 'back': {path['back']}")
+        try:
+            if nonfinite[i]:
+                raise ValueError("координаты NaN или бесконечность")
+            line = LineString(lonlat[plan.offsets[i]:plan.offsets[i + 1]])
+            features.append(geojson.Feature(geometry=line, properties={"type": str(leg_type)}))
+        except ValueError:
+            print(f"Неправильные координаты для маршрута '{leg_type}': {plan.leg(i).tolist()}")
 
     feature_collection = geojson.FeatureCollection(features)
+    count('features_exported', len(features))
+    count('vertices_exported', len(plan.vertices))
 
     with open(output_path, 'w') as f:
-        geojson.dump(feature_collection, f)
+        geojson.dump(feature_collection, f, allow_nan=False)
+
+    print("Сгенерированные маршруты полета сохранены в:", output_path)
+
+
+def iter_geojson_features(flight_paths, utm_crs, chunk_size=STREAM_CHUNK_SIZE):
+    """Генератор строк GeoJSON Feature (LineString) для каждого участка маршрута.
+
+    flight_paths - FlightPlan, список словарей маршрутов или итератор FlightPlan
+    (например, план, рассчитанный по частям). Координаты сериализуются прямо
+    из массивов порциями по chunk_size участков, без промежуточных объектов
+    shapely/geojson, поэтому память не растет с размером плана. Участки с
+    координатами NaN или бесконечностью пропускаются (в GeoJSON их нет).
+    """
+    for plan in _iter_plans(flight_paths):
+        for first in range(0, len(plan), chunk_size):
+            last = min(first + chunk_size, len(plan))
+            start, end = plan.offsets[first], plan.offsets[last]
+
+            lon, lat = convert_from_utm(plan.vertices[start:end, 0], plan.vertices[start:end, 1], utm_crs)
+            lonlat = np.column_stack((lon, lat)).round(COORDINATE_PRECISION)
+            bounds = plan.offsets[first:last + 1] - start
+            nonfinite = _nonfinite_legs(lonlat, bounds).tolist()
+            coordinates, bounds = lonlat.tolist(), bounds.tolist()
+            count('vertices_exported', int(end - start))
+
+            for i, leg_type in enumerate(plan.leg_types[first:last].tolist()):
+                leg = coordinates[bounds[i]:bounds[i + 1]]
+                if len(leg) < 2 or nonfinite[i]:
+                    print(f"Неправильные координаты для маршрута '{LEG_TYPE_NAMES[leg_type]}': {leg}")
+                    continue
+                yield ('{"type": "Feature", "geometry": {"type": "LineString", "coordinates": '
+                       f'{json.dumps(leg, allow_nan=False)}}}, '
+                       f'"properties": {{"type": "{LEG_TYPE_NAMES[leg_type]}"}}}}')
+
+
+def stream_flight_paths_to_geojson(flight_paths, output_path, utm_crs, ndjson=None,
+                                   chunk_size=STREAM_CHUNK_SIZE):
+    """Потоково записывает маршруты в GeoJSON или GeoJSON с разделителем строк.
+
+    Объекты пишутся в файл по мере генерации. Формат NDJSON (по объекту
+    Feature на строку) выбирается параметром ndjson или расширением
+    .ndjson/.geojsonl/.geojsons. Возвращает число записанных участков.
+    """
+    if ndjson is None:
+        ndjson = output_path.endswith(('.ndjson', '.geojsonl', '.geojsons'))
+
+    written = 0
+    with open(output_path, 'w') as f:
+        if not ndjson:
+            f.write('{"type": "FeatureCollection", "features": [\n')
+        for feature in iter_geojson_features(flight_paths, utm_crs, chunk_size):
+            if ndjson:
+                f.write(feature)
+                f.write('\n')
+            else:
+                f.write(',\n' + feature if written else feature)
+            written += 1
+        if not ndjson:
+            f.write('\n]}\n')
+
+    count('features_exported', written)
+    if not written:
+        print("Нет данных для экспорта.")
+    print("Сгенерированные маршруты полета сохранены в:", output_path)
+    return written
+
+
+def _nonfinite_legs(lonlat, offsets):
+    """Маска участков (границы offsets), где есть вершина с координатой NaN или бесконечностью."""
+    bad = np.concatenate(([0], np.cumsum(~np.isfinite(lonlat).all(axis=1))))
+    return bad[offsets[1:]] > bad[offsets[:-1]]
+
 
-    print("Сгенерированные маршруты полета сохранены в:", output_path)
\ No newline at end of file
+def _iter_plans(flight_paths):
+    """Перебирает части плана: один FlightPlan, список словарей или итератор планов."""
+    if isinstance(flight_paths, FlightPlan):
+        yield flight_paths
+    elif isinstance(flight_paths, list) and (not flight_paths or isinstance(flight_paths[0], dict)):
+        yield as_flight_plan(flight_paths)
+    else:
+        for plan in flight_paths:
+            yield as_flight_plan(plan)
@@ -1,155 +1,295 @@
 import numpy as np
 from fields import FieldProcessor
 from drones import drones
-from routing import (generate_flight_grid,
-                     remove_restricted_areas,
-                     # calculate_flight_path,
-                     save_grid_to_file,
-                     load_grid_from_file
+from routing import (CellSizing,
+                     build_valid_grid,
+                     calculate_flight_path,
+                     grid_cache_key,
+                     grid_cache_path
                      )
 from geojson_export import export_flight_paths_to_geojson
+from table_export import save_flight_paths_to_table
+from sorties import SortiePlan, schedule_sorties
+from fleet_allocation import allocate_drones
+from transit import reroute_transit
+from terrain import open_dem
+from replanning import PlanState, plan_state_path, replan
 from shapely.geometry import Polygon
+from shapely.strtree import STRtree
 import pandas as pd
-from tqdm import tqdm
-import geojson
-import os
-from time_class import timex
+import argparse
+from time_class import PipelineRun, stage, timex
 
 
-def calculate_flight_metrics(drone, area):
-    """Рассчитывает метрики полета дрона для оператора."""
+def calculate_flight_metrics(drone, area, sorties=None):
+    """Рассчитывает метрики полета дрона для оператора.
+
+    Без sorties - грубая оценка по площади поля. С планом вылетов
+    (sorties.schedule_sorties) сессии, время и раствор берутся из него,
+    то есть учитывают подлет к дальним квадратам и возврат.
+
+    Параметры дрона могут быть массивами NumPy (по элементу на дрон, см.
+    drone_parameters); тогда sorties - список планов вылетов в том же
+    порядке, и все метрики возвращаются массивами.
+    """
     # Максимальная площадь, которую дрон может обработать за один вылет
-    max_area_per_flight = drone['efficiency'] / 3  # 5 Га
+    max_area_per_flight = np.asarray(drone['efficiency'], dtype=float) / 3  # 5 Га
     # Максимальное время полета за один вылет
-    max_flight_time = drone['flight_time']   # 20 Минут
-    # Ширина распыления
-    spray_width = drone['spray_width']   # 10 Метров
-    # Сдвиг дрона при полете методом "косилки"
-    shift_width = 8  # Метров
+    max_flight_time = np.asarray(drone['flight_time'], dtype=float)   # 20 Минут
+    scalar = max_area_per_flight.ndim == 0
+
+    if sorties is not None:
+        plans = [sorties] if isinstance(sorties, SortiePlan) else list(sorties)
+
+        # Сессии, время и раствор по плану вылетов
+        num_sessions = np.array([len(plan) for plan in plans], dtype=float)
+        total_flight_time = np.array([plan.durations.sum() for plan in plans]) / 60
+        total_solution_usage = np.array([plan.solution.sum() for plan in plans])
+        flight_time_per_session = np.divide(total_flight_time, num_sessions,
+                                            out=np.zeros_like(total_flight_time), where=num_sessions > 0)
+    else:
+        # Расчет количества сессий
+        num_sessions = np.ceil(area / max_area_per_flight)
 
-    # Расчет количества сессий
-    num_sessions = np.ceil(area / max_area_per_flight)
+        # Расчет времени полета на сессию
+        flight_time_per_session = max_flight_time
 
-    # Расчет времени полета на сессию
-    flight_time_per_session = max_flight_time
+        # Общий расход раствора
+        total_solution_usage = drone['tank_capacity'] * num_sessions
 
-    # Количество заправок равно количеству сессий
-    refuels = int(num_sessions)
+        total_flight_time = flight_time_per_session * num_sessions
 
-    # Общий расход раствора
-    total_solution_usage = drone['tank_capacity'] * num_sessions
+    # Количество заправок равно количеству сессий
+    refuels = num_sessions.astype(int)
 
     # Количество замен батарей
     total_battery_usage = refuels
 
     # Общие затраты времени (часы)
-    total_man_hours = (flight_time_per_session * num_sessions) / 60
+    total_man_hours = total_flight_time / 60
 
-    return {
+    metrics = {
         "количество_сессий": np.round(num_sessions, 2),
         "время_полета_в_сессию": np.round(flight_time_per_session, 2),
         "количество_посадок": refuels,
         "необходимо_раствора": np.round(total_solution_usage, 2),
-        "необходимо_батарей": refuels,
+        "необходимо_батарей": total_battery_usage,
         "затраты_человек_в_час": np.round(total_man_hours, 2)
     }
-
-
-def save_flight_paths_to_excel(flight_paths, output_path):
-    """Сохраняет маршруты полета в Excel файл."""
-    data = []
-    for path in tqdm(flight_paths, desc="Сохранение маршрутов в Excel"):
-        to_square = path['to_square']
-        back = path['back']
-        for point in to_square:
-            data.append({'type': 'to', 'lat': point[0], 'lon': point[1]})
-        for point in back:
-            data.append({'type': 'back', 'lat': point[0], 'lon': point[1]})
-
-    df = pd.DataFrame(data)
-    df.to_excel(output_path, index=False)
-    print("Сгенерированные маршруты полета сохранены в:", output_path)
+    if scalar:
+        metrics = {name: np.ravel(value)[0].item() for name, value in metrics.items()}
+    return metrics
+
+
+def drone_parameters(fleet):
+    """Параметры дронов реестра одной таблицей: словарь массивов NumPy по полям Drone."""
+    properties = [drone.get_properties() for drone in fleet.values()]
+    return {name: np.array([p[name] for p in properties]) for name in properties[0]}
+
+
+def compare_fleet(processed_data, fleet, field_geojson_path, restricted_geojson_path, terrain=None):
+    """Сравнивает все дроны реестра на одном поле и возвращает таблицу метрик.
+
+    Поле, индекс запретных зон и зона UTM готовятся один раз. Сетка и
+    маршруты по квадратам зависят только от ширины распыления и размера
+    квадратов (CellSizing по запасу хода дрона), поэтому строятся один раз
+    на каждый такой набор (и берутся из кэша сеток), вылеты планируются для каждого дрона, а метрики считаются
+    одним векторным вызовом по массиву параметров всех дронов. terrain -
+    ЦМР для учета рельефа при планировании вылетов.
+    """
+    field_polygon = Polygon(processed_data['field_coords'])
+    zone_tree = STRtree(processed_data['restricted_zones'])
+    params = drone_parameters(fleet)
+
+    grids, paths, sorties, num_cells = {}, {}, [], []
+    for drone in (drone.get_properties() for drone in fleet.values()):
+        sizing = CellSizing(drone, processed_data['start_point'])
+        key = (drone['spray_width'], drone['flight_radius'], sizing.key())
+        if key not in grids:
+            grids[key] = build_valid_grid(field_polygon,
+                                          zone_tree,
+                                          drone['spray_width'],
+                                          drone['flight_radius'],
+                                          processed_data['utm_crs'],
+                                          grid_cache_path(grid_cache_key(field_geojson_path,
+                                                                         restricted_geojson_path,
+                                                                         *key[:2], sizing)),
+                                          sizing)
+            paths[key] = calculate_flight_path(grids[key],
+                                               processed_data['start_point'],
+                                               drone['spray_width'],
+                                               processed_data['restricted_zones'])
+        sorties.append(schedule_sorties(paths[key], grids[key].area.values, drone,
+                                        terrain=terrain, crs=processed_data['utm_crs']))
+        num_cells.append(len(grids[key]))
+
+    metrics = calculate_flight_metrics(params, processed_data['field_area'], sorties)
+    table = pd.DataFrame({'дрон': params['name'],
+                          'квадратов': num_cells,
+                          **metrics})
+    return table.sort_values('затраты_человек_в_час', ignore_index=True)
 
 
 if __name__ == '__main__':
 
-    # Загружаем данные поля
-    field_processor = FieldProcessor('field.geojson', 'restrict_area.geojson', 'point_start.geojson')
-    processed_data = field_processor.process_field()
+    parser = argparse.ArgumentParser(description="Планирование полетов сельскохозяйственного дрона")
+    parser.add_argument('--drone', default="New Agricultural Drone", choices=list(drones),
+                        help="модель дрона из реестра drones")
+    parser.add_argument('--fleet', action='store_true',
+                        help="сравнить все дроны реестра и сохранить таблицу fleet_comparison.csv")
+    parser.add_argument('--allocate', nargs='+', metavar='DRONE', choices=list(drones),
+                        help="распределить поле между несколькими дронами (модели через пробел) "
+                             "и сохранить точки старта и маршруты каждого дрона в папку fleet_routes")
+    parser.add_argument('--incremental', action='store_true',
+                        help="сохранять план в папке .plan_state и при изменении запретных зон "
+                             "или границы поля пересчитывать только затронутые квадраты и вылеты")
+    parser.add_argument('--dem', metavar='PATH',
+                        help="цифровая модель рельефа (.npy с описанием .json или GeoTIFF): "
+                             "вылеты планируются с учетом подъемов и спусков")
+    parser.add_argument('--metrics', metavar='PATH',
+                        help="сохранить замер запуска в JSON: время и пик памяти по этапам, "
+                             "счетчики квадратов и вершин (для отслеживания регрессий)")
+    parser.add_argument('--profile', action='store_true',
+                        help="добавить в замер --metrics самые долгие функции по cProfile")
+    parser.add_argument('--trace-memory', action='store_true',
+                        help="добавить в замер --metrics пик памяти Python по этапам (tracemalloc)")
+    args = parser.parse_args()
+
+    # Замер сохраняется при выходе, в том числе после --fleet и --allocate
+    if args.metrics:
+        run = PipelineRun('main', profile=args.profile, trace_memory=args.trace_memory, metadata=vars(args))
+        run.start()
+        run.save_at_exit(args.metrics)
 
-    grid_filename = 'flight_grid_net.geojson'
+    # Загружаем данные поля
+    field_geojson_path = 'field.geojson'
+    restricted_geojson_path = 'restrict_area.geojson'
+    field_processor = FieldProcessor(field_geojson_path, restricted_geojson_path, 'point_start.geojson')
+    with stage('load_field'):
+        processed_data = field_processor.process_field()
+
+    # С диска читается только окно ЦМР под полем и точкой старта
+    terrain = None
+    if args.dem:
+        extent = np.vstack((processed_data['field_coords'], [processed_data['start_point']]))
+        terrain = open_dem(args.dem, (*extent.min(axis=0), *extent.max(axis=0)), processed_data['utm_crs'])
+
+    if args.fleet:
+        print("Сравнение дронов реестра...")
+        with timex('fleet'):
+            comparison = compare_fleet(processed_data, drones, field_geojson_path, restricted_geojson_path,
+                                       terrain)
+        print(comparison.to_string(index=False))
+        comparison.to_csv("fleet_comparison.csv", index=False)
+        raise SystemExit
+
+    if args.allocate:
+        fleet = [drones[name].get_properties() for name in args.allocate]
+        # Сетка строится по самой узкой полосе распыления, чтобы ее покрыл любой дрон
+        narrowest = min(fleet, key=lambda drone: drone['spray_width'])
+        # и квадраты - по дрону с наименьшим запасом хода, чтобы квадрат помещался в вылет любого
+        sizing = min((CellSizing(drone, processed_data['launch_points']) for drone in fleet),
+                     key=lambda sizing: sizing.max_side)
+        valid_grid = build_valid_grid(Polygon(processed_data['field_coords']),
+                                      processed_data['restricted_zones'],
+                                      narrowest['spray_width'],
+                                      narrowest['flight_radius'],
+                                      processed_data['utm_crs'],
+                                      grid_cache_path(grid_cache_key(field_geojson_path,
+                                                                     restricted_geojson_path,
+                                                                     narrowest['spray_width'],
+                                                                     narrowest['flight_radius'],
+                                                                     sizing)),
+                                      sizing)
+        print("Распределение квадратов между дронами...")
+        with timex('allocate'):
+            flight_paths = calculate_flight_path(valid_grid,
+                                                 processed_data['start_point'],
+                                                 narrowest['spray_width'],
+                                                 processed_data['restricted_zones'])
+            allocation = allocate_drones(flight_paths, valid_grid.area.values, fleet,
+                                         processed_data['launch_points'],
+                                         restricted_zones=processed_data['restricted_zones'])
+        for k, drone in enumerate(fleet):
+            print(f"Дрон {k} ({drone['name']}): вылетов {len(allocation.sorties_of(k))}, "
+                  f"работа {allocation.finish_times[k] / 3600:.2f} ч")
+        print(f"Время до окончания работы последнего дрона: {allocation.makespan / 3600:.2f} ч")
+        allocation.export_geojson("fleet_routes", processed_data['utm_crs'])
+        raise SystemExit
 
     # Выбор дрона
-    drone_name = "New Agricultural Drone"
+    drone_name = args.drone
     drone = drones[drone_name].get_properties()
 
     # Проверяем свойства дрона
     print(f"Свойства дрона: {drone}")
 
+    # С --incremental план хранится между запусками, и после правки зон или
+    # границы поля пересчитывается только затронутая ими часть
+    field_polygon = Polygon(processed_data['field_coords'])
+    state_path = plan_state_path(drone, processed_data['start_point'])
+    state = PlanState.load(state_path) if args.incremental else None
+    if state is not None and state.drone == drone:
+        print("Перепланирование по сохраненному плану...")
+        with timex('replan'):
+            state, changes = replan(state, field_polygon, processed_data['restricted_zones'],
+                                    processed_data['utm_crs'], terrain)
+        print(f"Изменения: {changes}")
+        sorties, flight_paths = state.sorties, state.plan
+    else:
+        # Сетка без запретных зон берется из кэша, если поле, зоны, дрон и старт не менялись;
+        # размер квадратов зависит от запаса хода дрона и удаленности от старта
+        sizing = CellSizing(drone, processed_data['start_point'])
+        grid_filename = grid_cache_path(grid_cache_key(field_geojson_path,
+                                                       restricted_geojson_path,
+                                                       drone['spray_width'],
+                                                       drone['flight_radius'],
+                                                       sizing))
+        valid_grid = build_valid_grid(field_polygon,
+                                      processed_data['restricted_zones'],
+                                      drone['spray_width'],
+                                      drone['flight_radius'],
+                                      processed_data['utm_crs'],
+                                      grid_filename,
+                                      sizing)
+
+        # Рассчитываем маршрут полета
+        print("Расчет маршрута полета...")
+        with timex('routes'):
+            # Дрон летит из стартовой точки к квадрату, обрабатывает его галсами
+            # "косилкой" с шагом ширины распыления и возвращается обратно.
+            # Квадраты считаются порциями в PLANNING_WORKERS процессах.
+            cell_paths = calculate_flight_path(valid_grid,
+                                               processed_data['start_point'],
+                                               drone['spray_width'],
+                                               processed_data['restricted_zones'])
+
+        # Группируем квадраты в вылеты с учетом заряда батареи, бака и подлета
+        print("Планирование вылетов...")
+        with timex('sorties'):
+            sorties = schedule_sorties(cell_paths, valid_grid.area.values, drone,
+                                       terrain=terrain, crs=processed_data['utm_crs'])
+            # Подлеты и возвраты уже обходят зоны, перелеты между квадратами проверяются здесь
+            flight_paths = reroute_transit(sorties.to_flight_plan(cell_paths),
+                                           processed_data['restricted_zones'],
+                                           processed_data['start_point'])
+        state = PlanState(field_polygon, processed_data['restricted_zones'], processed_data['start_point'],
+                          drone, valid_grid.geometry.values, cell_paths, sorties, flight_paths)
+    if args.incremental:
+        state.save(state_path)
+
     # Расчет метрик для оператора
-    flight_metrics = calculate_flight_metrics(drone, processed_data['field_area'])
+    with stage('metrics'):
+        flight_metrics = calculate_flight_metrics(drone, processed_data['field_area'], sorties)
     print("Метрики полета дрона:")
 
     for metric, value in flight_metrics.items():
         print(f"{metric}: {value}")
 
-    # Генерация сетки полета
-    print("Генерация сетки полета...")
-    #try:
-        #grid = load_grid_from_file(grid_filename)
-        #print("Сетка загружена из файла.")
-    #except:
-    grid = generate_flight_grid(Polygon(processed_data['field_coords']),
-                                    drone['spray_width'],
-                                    drone['flight_radius'])
-
-        #save_folder = os.getenv("SAVE_FOLDER", "C:/Users/khabi/PycharmProjects/dron_hakkaton/.venv/dron_model_3")
-        # Проверка существования папки и создание, если она не существует
-        #if not os.path.exists(save_folder):
-            #os.makedirs(save_folder)
-        # Сохранение файла
-        #filename = os.path.join(save_folder, "flight_grid_net.geojson")
-        #save_grid_to_file(grid, grid_filename)
-        #print("Сетка сгенерирована и сохранена в файл.")
-
-    # Удаляем зоны, пересекающиеся с запретными
-    print("Удаление запретных зон...")
-
-    restricted_areas = processed_data['restricted_zones']
-    has_intersections = any( any(square.intersects(restricted_area) for restricted_area in restricted_areas) for square in grid.geometry)
-
-    if not has_intersections:
-        valid_grid = grid
-    else:
-        valid_grid = remove_restricted_areas(grid, processed_data['restricted_zones'])
-    #print("Grid (первые 5 элементов):", valid_grid.head())             # Если valid_grid - GeoDataFrame
-    #print("Grid types:", valid_grid.geometry.apply(type))              # Проверяем типы объектов в сетке
-    #print("Restricted areas:", processed_data['restricted_zones'])     # Проверяем содержимое
-
-    # Рассчитываем маршрут полета
-    print("Расчет маршрута полета...")
-    with timex():
-        flight_paths = []
-
-        # Итерация по каждому элементу сетки
-        for index, row in valid_grid.iterrows():
-            square = row.geometry  # Получаем геометрию квадрата
-            path_to_square = [processed_data['start_point'],
-                              square.centroid]  # Дрон летит из стартовой точки к центру квадрата
-
-            # Создаем словарь для маршрута
-            flight_path = {
-                'to_square': path_to_square,
-                'back': [square.centroid, processed_data['start_point']]  # Возвращаемся обратно
-            }
-
-            flight_paths.append(flight_path)
-
-
     # Экспорт маршрутов в GeoJSON
     print("Экспорт маршрутов в GeoJSON...")
-    export_flight_paths_to_geojson(flight_paths, "flight_paths.geojson")
+    export_flight_paths_to_geojson(flight_paths, "flight_paths.geojson", processed_data['utm_crs'], stream=True)
 
-    # Сохраняем маршруты в Excel
-    # print("Сохранение маршрутов в Excel...")
-    # save_flight_paths_to_excel(flight_paths, "flight_paths.xlsx")
+    # Сохраняем вершины маршрутов таблицей (формат по расширению: .csv, .parquet, .xlsx)
+    print("Сохранение маршрутов в таблицу...")
+    save_flight_paths_to_table(flight_paths, "flight_paths.parquet", processed_data['utm_crs'])
@@ -1,64 +1,142 @@
 import numpy as np
-
-def handle_operator_command(command, drone_position, processed_data):
-
-    base_position = processed_data['start_point']
-
-    if command == "return_to_base":
-        # Логика возврата на место взлета
-        print("Drone is returning to base...")
-        return "Drone is returning to base", base_position
-
-    elif command == "emergency_landing":
-        # Логика экстренной посадки
-        print("Drone is performing emergency landing...")
-
-        # Безопасное место для посадки — последняя точка поворота
-        landing_position = drone_position  # Позиция, где дрон остановился
-        print(f"Landing at position: {landing_position}")
-        return "Drone is performing emergency landing", landing_position
-
+import shapely
+from shapely.geometry import Point, Polygon
+from shapely.strtree import STRtree
+from simulation import simulate_route, EVENT_RETURN
+from transit import ZONE_CLEARANCE, first_visible, get_visibility_graph
+
+# Шаг точек посадки вдоль границы поля, м
+LANDING_SPACING = 25.0
+
+COMMANDS = ("return_to_base", "emergency_landing", "hold_position")
+
+
+class CommandEngine:
+    """Отвечает на команды оператора для активной миссии за доли миллисекунды.
+
+    При создании один раз строятся граф видимости запретных зон с
+    кратчайшими путями от базы (и решеткой готовых путей возврата над полем)
+    и STRtree безопасных точек посадки (точки
+    границы поля, центры разрешенных квадратов и сама база вне раздутых
+    зон). Ответ на команду - словарь: command, message, position (цель),
+    path (маршрут до цели массивом (k, 2)) и safe (цель вне запретных зон).
+    """
+
+    def __init__(self, processed_data, valid_grid=None, clearance=ZONE_CLEARANCE):
+        self.base = np.asarray(processed_data['start_point'], dtype=float)[:2]
+        self.graph = get_visibility_graph(processed_data['restricted_zones'], clearance)
+        self.return_paths = self.graph.shortest_paths(self.base)
+
+        candidates = [self.base[None]]
+        if len(processed_data['field_coords']):
+            field = Polygon(processed_data['field_coords'])
+            edge = shapely.segmentize(field.exterior, LANDING_SPACING)
+            candidates.append(shapely.get_coordinates(edge))
+            # Пути возврата заранее находятся для решетки над полем и базой
+            minx, miny, maxx, maxy = field.bounds
+            self.return_paths.precompute((min(minx, self.base[0]), min(miny, self.base[1]),
+                                          max(maxx, self.base[0]), max(maxy, self.base[1])))
+        if valid_grid is not None and len(valid_grid):
+            candidates.append(shapely.get_coordinates(shapely.centroid(np.asarray(valid_grid.geometry.values))))
+        candidates = np.concatenate(candidates)
+        self.landing_points = candidates[~self.graph.blocked(candidates)]
+        self.landing_tree = STRtree(shapely.points(self.landing_points))
+
+    def respond(self, command, position):
+        """Ответ на команду оператора для дрона в точке position."""
+        position = np.asarray(position, dtype=float)[:2]
+        if command == "return_to_base":
+            return self._response(command, "Drone is returning to base", self.return_to_base(position))
+        if command == "emergency_landing":
+            return self._response(command, "Drone is performing emergency landing", self.emergency_landing(position))
+        if command == "hold_position":
+            return self._response(command, "Drone is holding position", position[None])
+        return self._response(command, "Unknown command", position[None])
+
+    def return_to_base(self, position):
+        """Маршрут до базы в обход запретных зон."""
+        return self.return_paths.path_to(position)
+
+    def emergency_landing(self, position):
+        """Маршрут до ближайшей безопасной точки посадки, достижимой по прямой.
+
+        Если по прямой не достижима ни одна точка в радиусе втрое больше
+        расстояния до ближайшей или безопасных точек нет совсем (база в
+        запретной зоне, поле не задано), дрон садится на базе по пути возврата.
+        """
+        if not len(self.landing_points):
+            return self.return_to_base(position)
+        point = Point(position)
+        nearest = self.landing_tree.query_nearest(point, return_distance=True)
+        radius = 3 * float(nearest[1][0]) + self.graph.clearance
+        candidates = self.landing_tree.query(point, predicate='dwithin', distance=radius)
+        targets = self.landing_points[candidates]
+        order = np.argsort(np.hypot(*(targets - position).T))
+        exit_point = self.graph.escape(position)
+        head = [position] if np.any(exit_point != position) else []
+        landing = first_visible(self.graph, exit_point, targets, order)
+        if landing < 0:
+            return self.return_to_base(position)
+        return np.array(head + [exit_point, targets[landing]])
+
+    def _response(self, command, message, path):
+        target = path[-1]
+        return {'command': command,
+                'message': message,
+                'position': target,
+                'path': path,
+                'safe': not self.graph.blocked(target)[0]}
+
+
+async def serve_commands(engine, inbox, outbox):
+    """Обрабатывает поток телеметрии и команд нескольких дронов.
+
+    Сообщения inbox (asyncio.Queue) - словари с ключом 'drone' и ключами
+    'position' (телеметрия) и/или 'command'; None завершает цикл. На каждую
+    команду в outbox кладется ответ engine.respond с номером дрона, для
+    позиции берется последняя телеметрия дрона (без нее - база).
+    Возвращает последние известные позиции дронов.
+    """
+    positions = {}
+    while True:
+        message = await inbox.get()
+        if message is None:
+            return positions
+        drone = message.get('drone')
+        if 'position' in message:
+            positions[drone] = message['position']
+        if 'command' in message:
+            response = engine.respond(message['command'], positions.get(drone, engine.base))
+            response['drone'] = drone
+            await outbox.put(response)
+
+
+def handle_operator_command(command, drone_position, processed_data, engine=None):
+    """Отвечает на команду оператора: возвращает (сообщение, целевая позиция).
+
+    Для серии команд передайте готовый CommandEngine; без него индексы
+    строятся заново при каждом вызове.
+    """
+    if engine is None:
+        engine = CommandEngine(processed_data)
+    response = engine.respond(command, drone_position)
+    if command in COMMANDS:
+        print(f"{response['message']}...")
+    if command == "emergency_landing":
+        print(f"Landing at position: {response['position']}")
     elif command == "hold_position":
-        # Логика приостановки
-        print("Drone is holding position...")
-        # Дрон зависает в текущей позиции
-        print(f"Drone is hovering at position: {drone_position}")
-        return "Drone is holding position", drone_position
-
-    else:
-        return "Unknown command", drone_position
+        print(f"Drone is hovering at position: {response['position']}")
+        if not response['safe']:
+            print("Warning: drone is inside a restricted zone")
+    return response['message'], response['position']
 
 def execute_spray_route(drone, route, processed_data):
-
-    current_position = processed_data['start_point']
-    total_distance = 0
-    battery_life = drone.flight_time * 60  # Время в секундах
-    spray_remaining = drone.tank_capacity
-
-    for i in range(len(route) - 1):
-        start = route[i]
-        end = route[i + 1]
-
-        # Расчет расстояния между точками
-        distance = np.linalg.norm(np.array(end) - np.array(start))
-        flight_time = distance / drone.speed
-
-        # Проверка на необходимость возвращения на базу для заправки или подзарядки
-        if battery_life < flight_time or spray_remaining <= 0:
-            print(f"Drone is returning to base from {start} for recharge or refill.")
-
-            # Возвращаем дрон на базу и обновляем заряд батареи и бак
-            current_position = processed_data['start_point']
-            total_distance += np.linalg.norm(np.array(current_position) - np.array(start))
-            battery_life = drone.flight_time * 60  # Сброс заряда батареи
-            spray_remaining = drone.tank_capacity  # Сброс объема распыляемого вещества
-
-        # Обновление позиции дрона и вычисление общей дистанции
-        current_position = end
-        total_distance += distance
-        battery_life -= flight_time
-        spray_remaining -= (distance / drone.speed) * 0.1  # потребление раствора
-
-        print(f"Drone moved to {end}, Total Distance: {total_distance}m")
-
-    print(f"Total route covered: {total_distance} meters")
\ No newline at end of file
+    """Моделирует выполнение маршрута и возвращает временную шкалу simulation.TIMELINE_DTYPE.
+
+    drone - словарь свойств или объект Drone, route - FlightPlan или список точек.
+    """
+    timeline = simulate_route(drone, route, processed_data['start_point'])
+    returns = np.count_nonzero(timeline['event'] == EVENT_RETURN)
+    total_distance = timeline['distance'][-1] if len(timeline) else 0.0
+    print(f"Total route covered: {total_distance} meters, returns to base: {returns}")
+    return timeline
@@ -0,0 +1,400 @@
+"""Сервис планирования: asyncio HTTP-сервер над конвейером main.py с прогретыми кэшами.
+
+Запуск из корня проекта:
+
+    python planning_service.py --port 8765
+    python planning_service.py --unix /tmp/planning.sock
+
+Запросы:
+
+    GET  /health  - состояние сервиса
+    GET  /drones  - реестр дронов
+    POST /plan    - план полетов: {"field": GeoJSON поля, "zones": GeoJSON запретных зон,
+                                   "start": [lon, lat] или GeoJSON точки, "drone": имя или свойства}
+
+Ответ /plan - FeatureCollection участков маршрута (как flight_paths.geojson)
+с дополнительным членом "properties": дрон, зона UTM, число квадратов и
+вылетов, метрики и изменения относительно прошлого плана этого поля.
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import shapely
+from shapely.errors import GEOSException
+from drones import drones
+from fields import convert_to_utm, fields_from_geojson
+from geojson_export import iter_geojson_features
+from main import calculate_flight_metrics
+from replanning import plan_field, replan
+from routing import CellSizing
+
+SERVICE_HOST = os.getenv("PLANNING_HOST", "127.0.0.1")
+SERVICE_PORT = int(os.getenv("PLANNING_PORT", "8765"))
+# Число процессов для расчета планов (0 - по числу ядер)
+SERVICE_WORKERS = int(os.getenv("SERVICE_WORKERS", "0"))
+# Сколько готовых ответов хранит сервис и сколько планов полей - каждый процесс
+RESPONSE_CACHE_SIZE = 256
+PLAN_CACHE_SIZE = 32
+# Наибольший размер тела запроса, байт
+MAX_REQUEST_SIZE = 64 * 2 ** 20
+# Наибольшая оценка числа квадратов и галсов плана: больше - запрос отклоняется (400),
+# чтобы один запрос не занял всю память процесса пула
+MAX_PLAN_CELLS = 500_000
+MAX_PLAN_SWATHS = 2_000_000
+
+HTTP_STATUS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 413: 'Payload Too Large',
+               500: 'Internal Server Error'}
+# Допустимые свойства дрона из запроса: (наименьшее, наибольшее)
+DRONE_LIMITS = {'flight_radius': (0.1, 100.0),  # км
+                'speed': (0.5, 50.0),  # м/с
+                'tank_capacity': (0.1, 500.0),  # л
+                'flight_time': (1.0, 600.0),  # мин
+                'spray_width': (0.5, 100.0),  # м
+                'efficiency': (0.01, 1000.0)}  # га за вылет
+DRONE_PROPERTIES = tuple(DRONE_LIMITS)
+
+# Планы процесса пула (PlanState) по точке старта и дрону, см. _plan_key
+_plans = OrderedDict()
+
+
+class PlanningService:
+    """Долгоживущий сервис планирования.
+
+    Расчеты идут в пуле процессов, по процессу на исполнителя: запросы с
+    той же точкой старта и тем же дроном всегда попадают в один процесс, где
+    остаются их PlanState, графы видимости зон (transit) и Transformer
+    (fields). Поэтому повторный расчет поля с измененными зонами или
+    границей идет через replan, а не с нуля. Готовые ответы хранятся в
+    памяти сервиса: точный повтор запроса отдается без обращения к пулу,
+    одинаковые запросы, пришедшие одновременно, считаются один раз.
+    """
+
+    def __init__(self, workers=SERVICE_WORKERS, cache_size=RESPONSE_CACHE_SIZE):
+        workers = workers or os.cpu_count() or 1
+        self.executors = [ProcessPoolExecutor(max_workers=1) for _ in range(workers)]
+        self.cache_size = cache_size
+        self.responses = OrderedDict()
+        self.pending = {}
+        self.requests = 0
+        self.cache_hits = 0
+
+    async def warm(self):
+        """Запускает процессы пула заранее, чтобы первый запрос не ждал их старта и импорта."""
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*(loop.run_in_executor(executor, os.getpid) for executor in self.executors))
+
+    def close(self):
+        for executor in self.executors:
+            executor.shutdown(cancel_futures=True)
+
+    def prepare(self, request):
+        """Ключ ответа и аргументы plan_request (None, если ответ готов или уже считается).
+
+        Запрос проверяется здесь, до передачи в пул: ValueError - ошибка в
+        запросе. Исключения из процесса пула - ошибки сервиса.
+        """
+        key = _digest(request)
+        if key in self.responses or key in self.pending:
+            return key, None
+        return key, request_arguments(request)
+
+    async def plan(self, key, arguments):
+        """Ответ на запрос плана (тело JSON в байтах) и признак попадания в кэш ответов."""
+        self.requests += 1
+        if key in self.responses:
+            self.responses.move_to_end(key)
+            self.cache_hits += 1
+            return self.responses[key], True
+
+        task = self.pending.get(key)
+        if task is None:
+            task = self.pending[key] = asyncio.ensure_future(self._compute(key, arguments))
+            task.add_done_callback(lambda _: self.pending.pop(key, None))
+        # Отключение клиента не отменяет расчет, который ждут и другие
+        return await asyncio.shield(task), False
+
+    async def _compute(self, key, arguments):
+        affinity = arguments[0]
+        executor = self.executors[int(affinity[:8], 16) % len(self.executors)]
+        body = await asyncio.get_running_loop().run_in_executor(executor, plan_request, *arguments)
+        self.responses[key] = body
+        while len(self.responses) > self.cache_size:
+            self.responses.popitem(last=False)
+        return body
+
+    async def dispatch(self, method, target, body):
+        """Обрабатывает HTTP-запрос: возвращает (код, тело ответа, заголовки)."""
+        path = target.split('?', 1)[0]
+        if method == 'GET' and path == '/health':
+            return 200, _json({'status': 'ok', 'workers': len(self.executors), 'requests': self.requests,
+                               'cache_hits': self.cache_hits, 'cached_responses': len(self.responses)}), {}
+        if method == 'GET' and path == '/drones':
+            return 200, _json({name: drone.get_properties() for name, drone in drones.items()}), {}
+        if method == 'POST' and path == '/plan':
+            try:
+                request = json.loads(body)
+                if not isinstance(request, dict):
+                    raise ValueError("тело запроса - не объект JSON")
+                key, arguments = self.prepare(request)
+            except ValueError as e:
+                return 400, _json({'error': f"Ошибка в запросе: {e}"}), {}
+            try:
+                response, hit = await self.plan(key, arguments)
+            except Exception as e:
+                print(f"Ошибка при расчете плана: {e!r}")
+                return 500, _json({'error': f"Ошибка при расчете плана: {e}"}), {}
+            return 200, response, {'X-Plan-Cache': 'hit' if hit else 'miss'}
+        return 404, _json({'error': f"Нет ресурса {method} {path}"}), {}
+
+    async def handle(self, reader, writer):
+        """Соединение HTTP/1.1 (с keep-alive): разбор запросов и запись ответов."""
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                method, target, version = request_line.decode('latin-1').split()
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if not line.strip():
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+
+                length = int(headers.get('content-length', 0))
+                if length > MAX_REQUEST_SIZE:
+                    status, body, extra = 413, _json({'error': "Слишком большой запрос"}), {}
+                    headers['connection'] = 'close'
+                else:
+                    content = await reader.readexactly(length) if length else b''
+                    status, body, extra = await self.dispatch(method.upper(), target, content)
+
+                keep_alive = version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+                head = [f"HTTP/1.1 {status} {HTTP_STATUS[status]}",
+                        "Content-Type: application/json; charset=utf-8",
+                        f"Content-Length: {len(body)}",
+                        f"Connection: {'keep-alive' if keep_alive else 'close'}"]
+                head.extend(f"{name}: {value}" for name, value in extra.items())
+                writer.write(("\r\n".join(head) + "\r\n\r\n").encode('latin-1') + body)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host=SERVICE_HOST, port=SERVICE_PORT, unix_path=None):
+        """Запускает сервер (TCP или Unix-сокет) и обслуживает запросы до отмены."""
+        await self.warm()
+        if unix_path:
+            server = await asyncio.start_unix_server(self.handle, unix_path)
+            print("Сервис планирования запущен:", unix_path)
+        else:
+            server = await asyncio.start_server(self.handle, host, port)
+            print(f"Сервис планирования запущен: http://{host}:{port}")
+        async with server:
+            await server.serve_forever()
+
+
+def request_arguments(request):
+    """Проверенные аргументы plan_request по запросу: (ключ плана, поле, зоны, старт, зона UTM, дрон).
+
+    ValueError - ошибка в запросе, в том числе слишком большой план.
+    """
+    field, zones, start_point, utm_crs = parse_request(request)
+    drone = drone_from_request(request['drone'])
+    check_plan_size(field, start_point, drone)
+    return _plan_key(request), field, zones, start_point, utm_crs, drone
+
+
+def plan_request(key, field, zones, start_point, utm_crs, drone):
+    """Расчет плана в процессе пула; возвращает тело ответа (GeoJSON в байтах).
+
+    Аргументы - из request_arguments. План с тем же ключом (точка старта и
+    дрон), посчитанный этим процессом раньше, обновляется через replan
+    (пересчитываются только квадраты и вылеты, задетые изменениями поля и
+    зон), иначе считается полностью.
+    """
+    state = _plans.pop(key, None)
+    if state is None:
+        state = plan_field(field, zones, start_point, drone, utm_crs)
+        changes = {'full': True}
+    else:
+        state, changes = replan(state, field, zones, utm_crs)
+    _plans[key] = state
+    while len(_plans) > PLAN_CACHE_SIZE:
+        _plans.popitem(last=False)
+
+    properties = {'drone': drone['name'],
+                  'utm_crs': utm_crs,
+                  'cells': len(state.grid),
+                  'sorties': len(state.sorties),
+                  'metrics': calculate_flight_metrics(drone, field.area / 10000, state.sorties),
+                  'changes': {name: _plain(value) for name, value in changes.items()}}
+    features = ',\n'.join(iter_geojson_features(state.plan, utm_crs))
+    return (f'{{"type": "FeatureCollection", "features": [\n{features}\n], '
+            f'"properties": {json.dumps(properties, ensure_ascii=False)}}}').encode('utf-8')
+
+
+def parse_request(request):
+    """Поле, запретные зоны и точка старта запроса в метрах UTM и сама зона UTM.
+
+    field и zones - GeoJSON в градусах (FeatureCollection, Feature,
+    геометрия или список), из field берется первый полигон. start - [lon,
+    lat] или GeoJSON точки. Любая ошибка в данных запроса - ValueError.
+    """
+    missing = [name for name in ('field', 'start', 'drone') if not request.get(name)]
+    if missing:
+        raise ValueError(f"не заданы {', '.join(missing)}")
+
+    field_data = _polygons(request['field'], 'field')
+    if not len(field_data['geometries']):
+        raise ValueError("в field нет полигона поля")
+    field, utm_crs = field_data['geometries'][0], field_data['utm_crs']
+    zones = []
+    if request.get('zones'):
+        zones = list(_polygons(request['zones'], 'zones', utm_crs)['geometries'])
+
+    start = request['start']
+    if isinstance(start, dict):
+        geometry = start.get('geometry') if start.get('type') == 'Feature' else start
+        if not isinstance(geometry, dict) or geometry.get('type') != 'Point':
+            raise ValueError("start - [lon, lat] или GeoJSON точки")
+        start = geometry.get('coordinates')
+    if (not isinstance(start, (list, tuple)) or len(start) < 2
+            or not all(_is_number(value) for value in start[:2])):
+        raise ValueError("start - [lon, lat] или GeoJSON точки")
+    lon, lat = float(start[0]), float(start[1])
+    if not (-180 <= lon <= 180 and -90 <= lat <= 90):
+        raise ValueError(f"координаты start вне диапазона: {lon}, {lat}")
+    x, y = convert_to_utm(lon, lat, utm_crs)
+    return field, zones, (float(x), float(y)), utm_crs
+
+
+def drone_from_request(drone):
+    """Свойства дрона: по имени из реестра drones или словарь со всеми полями Drone."""
+    if isinstance(drone, str):
+        if drone not in drones:
+            raise ValueError(f"неизвестный дрон {drone}, доступны: {', '.join(drones)}")
+        return drones[drone].get_properties()
+    if isinstance(drone, dict):
+        missing = [name for name in DRONE_PROPERTIES if name not in drone]
+        if missing:
+            raise ValueError(f"у дрона не заданы {', '.join(missing)}")
+        wrong = [f"{name} ({low:g}..{high:g})" for name, (low, high) in DRONE_LIMITS.items()
+                 if not _is_number(drone[name]) or not low <= drone[name] <= high]
+        if wrong:
+            raise ValueError(f"свойства дрона вне допустимых пределов: {', '.join(wrong)}")
+        return {'name': str(drone.get('name', 'custom')), **{name: float(drone[name]) for name in DRONE_PROPERTIES}}
+    raise ValueError("drone - имя дрона из реестра или словарь его свойств")
+
+
+def check_plan_size(field, start_point, drone):
+    """Отклоняет (ValueError) план, который займет слишком много памяти.
+
+    Оценка сверху по CellSizing: все поле покрыто квадратами, допустимыми
+    в дальней от старта точке поля (или наименьшими, если оттуда не
+    вернуться), в квадрате - сторона / spray_width галсов.
+    """
+    sizing = CellSizing(drone, start_point)
+    far = np.hypot(*(shapely.get_coordinates(field) - sizing.start_points[0]).T).max()
+    side = float(sizing.side(far))
+    side = min(side if np.isfinite(side) else sizing.min_side, sizing.max_side)
+    cells = field.area / side ** 2
+    swaths = field.area / (side * sizing.spray_width)
+    if cells > MAX_PLAN_CELLS or swaths > MAX_PLAN_SWATHS:
+        raise ValueError(f"слишком большой план: около {cells:.0f} квадратов и {swaths:.0f} галсов "
+                         f"(не больше {MAX_PLAN_CELLS} и {MAX_PLAN_SWATHS})")
+
+
+def _polygons(data, name, utm_crs=None):
+    """Многоугольники GeoJSON запроса в метрах UTM (fields_from_geojson); name - поле запроса для ошибок."""
+    collection = _feature_collection(data, name)
+    try:
+        result = fields_from_geojson(collection, utm_crs)
+    except (TypeError, IndexError, KeyError, ValueError, GEOSException) as e:
+        raise ValueError(f"{name}: некорректные координаты многоугольника ({e})") from None
+    invalid = ~shapely.is_valid(result['geometries'])
+    if invalid.any():
+        raise ValueError(f"{name}: некорректных многоугольников (самопересечения и т.п.): {invalid.sum()}")
+    return result
+
+
+def _feature_collection(data, name):
+    """Приводит FeatureCollection, Feature, геометрию или список к FeatureCollection с проверкой структуры."""
+    if isinstance(data, list):
+        return {'type': 'FeatureCollection',
+                'features': [feature for item in data for feature in _feature_collection(item, name)['features']]}
+    if not isinstance(data, dict):
+        raise ValueError(f"{name} - объект GeoJSON или список объектов")
+    if data.get('type') == 'FeatureCollection':
+        features = data.get('features')
+        if not isinstance(features, list) or not all(isinstance(feature, dict) for feature in features):
+            raise ValueError(f"{name}: features - список объектов Feature")
+        for feature in features:
+            _check_geometry(feature.get('geometry'), name)
+        return data
+    if data.get('type') == 'Feature':
+        _check_geometry(data.get('geometry'), name)
+        return {'type': 'FeatureCollection', 'features': [data]}
+    _check_geometry(data, name)
+    return {'type': 'FeatureCollection', 'features': [{'type': 'Feature', 'geometry': data}]}
+
+
+def _check_geometry(geometry, name):
+    """Геометрия GeoJSON - объект с type и списком coordinates (или null у Feature)."""
+    if geometry is None:
+        return
+    if not isinstance(geometry, dict) or not isinstance(geometry.get('type'), str):
+        raise ValueError(f"{name}: геометрия - объект GeoJSON с полем type")
+    if geometry['type'] in ('Polygon', 'MultiPolygon') and not isinstance(geometry.get('coordinates'), list):
+        raise ValueError(f"{name}: у геометрии {geometry['type']} нет списка coordinates")
+
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool) and np.isfinite(value)
+
+
+def _plan_key(request):
+    """Ключ плана в процессе пула (и выбора процесса): точка старта и дрон."""
+    return _digest({'start': request.get('start'), 'drone': request.get('drone')})
+
+
+def _digest(data):
+    """Хэш JSON-данных, не зависящий от порядка ключей."""
+    return hashlib.sha256(json.dumps(data, sort_keys=True, separators=(',', ':')).encode()).hexdigest()
+
+
+def _json(data):
+    return json.dumps(data, ensure_ascii=False).encode('utf-8')
+
+
+def _plain(value):
+    """Скаляр NumPy в число Python (для JSON)."""
+    return value.item() if isinstance(value, np.generic) else value
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Сервис планирования полетов сельскохозяйственного дрона")
+    parser.add_argument('--host', default=SERVICE_HOST)
+    parser.add_argument('--port', type=int, default=SERVICE_PORT)
+    parser.add_argument('--unix', metavar='PATH', help="слушать Unix-сокет вместо TCP")
+    parser.add_argument('--workers', type=int, default=SERVICE_WORKERS,
+                        help="процессов для расчета планов (0 - по числу ядер)")
+    args = parser.parse_args()
+
+    service = PlanningService(args.workers)
+    try:
+        asyncio.run(service.serve(args.host, args.port, args.unix))
+    except KeyboardInterrupt:
+        print("Сервис планирования остановлен.")
+    finally:
+        service.close()
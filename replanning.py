@@ -0,0 +1,363 @@
+import json
+import os
+
+import numpy as np
+import shapely
+from shapely.strtree import STRtree
+from flight_plan import FlightPlan, LEG_TO, LEG_BACK, LEG_HOP, _leg_vertex_index
+from routing import (CellSizing, generate_flight_grid, remove_restricted_areas,
+                     calculate_flight_path, _plan_cells)
+from sorties import SortiePlan, leg_costs, schedule_sorties
+from transit import ZONE_CLEARANCE, reroute_transit, segments_crossing, _bbox_corners
+
+# Папка сохраненных планов для инкрементального перепланирования
+PLAN_STATE_DIR = os.getenv("PLAN_STATE_DIR", ".plan_state")
+PLAN_STATE_VERSION = 2
+
+
+class PlanState:
+    """Сохраненный план поля: исходные данные и все промежуточные результаты.
+
+    field, zones - поле и запретные зоны (UTM), для которых построен план,
+    start_point - точка старта, drone - словарь свойств дрона. grid -
+    квадраты сетки (массив полигонов), cell_plan - маршруты квадратов
+    (calculate_flight_path), sorties - вылеты (SortiePlan), plan - итоговый
+    план по вылетам, который экспортируется. По этим данным replan
+    пересчитывает только то, что задели изменения поля и зон.
+    """
+
+    __slots__ = ('field', 'zones', 'start_point', 'drone', 'grid', 'cell_plan', 'sorties', 'plan')
+
+    def __init__(self, field, zones, start_point, drone, grid, cell_plan, sorties, plan):
+        self.field = field
+        self.zones = np.asarray(list(zones), dtype=object)
+        self.start_point = np.asarray(start_point, dtype=float)[:2]
+        self.drone = drone
+        self.grid = np.asarray(grid, dtype=object)
+        self.cell_plan = cell_plan
+        self.sorties = sorties
+        self.plan = plan
+
+    def save(self, path):
+        """Сохраняет план в .npz (геометрии - в WKB подряд, с границами как у FlightPlan)."""
+        folder = os.path.dirname(path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        arrays = {'version': PLAN_STATE_VERSION,
+                  'drone': json.dumps(self.drone, ensure_ascii=False),
+                  'start_point': self.start_point}
+        for name, geometries in (('field', [self.field]), ('zones', self.zones), ('grid', self.grid)):
+            arrays[f'{name}_wkb'], arrays[f'{name}_offsets'] = _pack_wkb(geometries)
+        for name, plan in (('cell_plan', self.cell_plan), ('plan', self.plan)):
+            for field in FlightPlan.__slots__:
+                arrays[f'{name}_{field}'] = getattr(plan, field)
+        for field in SortiePlan.__slots__:
+            arrays[f'sorties_{field}'] = getattr(self.sorties, field)
+
+        # Пишем во временный файл, чтобы прерванная запись не испортила план
+        tmp_path = f"{path}.tmp.npz"
+        np.savez(tmp_path, **arrays)
+        os.replace(tmp_path, path)
+        print("План сохранен в файл:", path)
+
+    @classmethod
+    def load(cls, path):
+        """Загружает план, сохраненный save; None, если файла нет или он другой версии."""
+        if not os.path.exists(path):
+            return None
+        try:
+            with np.load(path) as data:
+                if int(data['version']) != PLAN_STATE_VERSION:
+                    print(f"План {path} сохранен другой версией программы.")
+                    return None
+                geometries = {name: _unpack_wkb(data[f'{name}_wkb'], data[f'{name}_offsets'])
+                              for name in ('field', 'zones', 'grid')}
+                plans = {name: FlightPlan(*(data[f'{name}_{field}'] for field in FlightPlan.__slots__))
+                         for name in ('cell_plan', 'plan')}
+                sorties = SortiePlan(*(data[f'sorties_{field}'] for field in SortiePlan.__slots__))
+                return cls(geometries['field'][0], geometries['zones'], data['start_point'],
+                           json.loads(str(data['drone'])), geometries['grid'],
+                           plans['cell_plan'], sorties, plans['plan'])
+        except (OSError, KeyError, ValueError) as e:
+            print(f"Ошибка при загрузке плана из {path}: {e}")
+            return None
+
+
+def plan_state_path(drone, start_point, cache_dir=PLAN_STATE_DIR):
+    """Путь к сохраненному плану для дрона и точки старта."""
+    x, y = np.asarray(start_point, dtype=float)[:2]
+    name = "".join(c if c.isalnum() else "_" for c in drone['name'])
+    return os.path.join(cache_dir, f"{name}_{x:.0f}_{y:.0f}.npz")
+
+
+def plan_field(field_polygon, restricted_zones, start_point, drone, crs=None, grid=None,
+               terrain=None):
+    """Полный расчет плана поля: сетка, маршруты квадратов, вылеты и обход зон.
+
+    grid - готовая сетка без запретных зон (например, из кэша сеток).
+    Возвращает PlanState для последующих вызовов replan.
+    """
+    zones = list(restricted_zones)
+    if grid is None:
+        grid = remove_restricted_areas(generate_flight_grid(field_polygon, drone['spray_width'],
+                                                            drone['flight_radius'], crs,
+                                                            step=CellSizing(drone, start_point)), zones)
+    squares = np.asarray(getattr(grid, 'geometry', grid), dtype=object)
+    cell_plan = calculate_flight_path(squares, start_point, drone['spray_width'], zones)
+    sorties = schedule_sorties(cell_plan, shapely.area(squares), drone, terrain=terrain, crs=crs)
+    plan = reroute_transit(sorties.to_flight_plan(cell_plan), zones, start_point)
+    return PlanState(field_polygon, zones, start_point, drone, squares, cell_plan, sorties, plan)
+
+
+def replan(state, field_polygon, restricted_zones, crs=None, terrain=None):
+    """Перепланирование после изменения поля или запретных зон; возвращает (PlanState, изменения).
+
+    Старые и новые зоны сравниваются по нормализованному WKB. Квадраты,
+    задетые добавленными зонами, удаляются; квадраты решетки в удаленных
+    зонах и в изменившейся части поля строятся заново. Затем пересчитываются
+    только маршруты новых квадратов и подлеты и возвраты, задевающие
+    изменения. Заново группируются только вылеты с удаленными квадратами:
+    в остальных вылетах подлеты, возвраты и перелеты через изменения
+    прокладываются заново на месте, а время и длина вылета пересчитываются
+    по его участкам (вылет группируется заново, только если перестал
+    укладываться в заряд). Прочие вылеты и их участки переносятся без
+    пересчета. Если вместе с границей поля сдвинулась решетка (угол bbox
+    поля), выполняется полный расчет. изменения - словарь счетчиков.
+    """
+    drone = state.drone
+    sizing = CellSizing(drone, state.start_point)
+    zones = np.asarray(list(restricted_zones), dtype=object)
+    old_keys, new_keys = _geometry_keys(state.zones), _geometry_keys(zones)
+    added = zones[~np.isin(new_keys, old_keys)]
+    removed = state.zones[~np.isin(old_keys, new_keys)]
+    field_changed = not np.array_equal(_geometry_keys([field_polygon]), _geometry_keys([state.field]))
+    changes = {'added_zones': len(added), 'removed_zones': len(removed), 'field_changed': field_changed,
+               'dropped_cells': 0, 'new_cells': 0, 'rerouted_sorties': 0, 'rescheduled_sorties': 0,
+               'full': False}
+
+    if not len(added) and not len(removed) and not field_changed:
+        return state, changes
+    if field_changed and field_polygon.bounds[:2] != state.field.bounds[:2]:
+        print("Решетка сетки сдвинулась вместе с границей поля, выполняется полный расчет.")
+        changes['full'] = True
+        return plan_field(field_polygon, zones, state.start_point, drone, crs, terrain=terrain), changes
+
+    # Область, где квадраты могут появиться или измениться
+    parts = list(removed)
+    if field_changed:
+        parts.append(shapely.symmetric_difference(state.field, field_polygon))
+    region = shapely.union_all(parts) if parts else None
+
+    # Удаляемые квадраты: задетые новыми зонами или лежащие в области изменений
+    grid = state.grid
+    cell_bounds = shapely.bounds(grid)
+    dropped = np.zeros(len(grid), dtype=bool)
+    dropped[_touching(cell_bounds, added, grid)] = True
+    if region is not None:
+        dropped[_touching(_lattice_bounds(cell_bounds, field_polygon, sizing), [region])] = True
+    kept = np.flatnonzero(~dropped)
+
+    new_squares = np.empty(0, dtype=object)
+    if region is not None:
+        new_squares = remove_restricted_areas(
+            generate_flight_grid(field_polygon, drone['spray_width'], drone['flight_radius'], crs, region,
+                                 sizing),
+            zones).geometry.values
+    num_kept = len(kept)
+    new_grid = np.concatenate((grid[kept], np.asarray(new_squares, dtype=object)))
+    new_cells = np.arange(num_kept, len(new_grid))
+    remap = np.full(len(grid), -1, dtype=np.int64)
+    remap[kept] = np.arange(num_kept)
+    changes['dropped_cells'], changes['new_cells'] = int(dropped.sum()), len(new_cells)
+
+    # Маршруты квадратов: оставшиеся переносятся, новые строятся, подлеты и возвраты
+    # у изменений выпрямляются и снова проверяются на пересечение с зонами
+    old_cell_plan = state.cell_plan
+    cell_plan = old_cell_plan.take(np.flatnonzero(~dropped[old_cell_plan.cells]))
+    cell_plan.cells = remap[cell_plan.cells]
+    suspect = np.flatnonzero(_legs_near(cell_plan, added, removed))
+    if len(suspect):
+        cell_plan = cell_plan.replace(suspect, reroute_transit(_straight(cell_plan.take(suspect)),
+                                                               zones, state.start_point))
+    if len(new_cells):
+        fresh = _plan_cells(new_squares, tuple(state.start_point), drone['spray_width'], list(zones))
+        fresh.cells += num_kept
+        cell_plan = FlightPlan.concatenate([cell_plan, reroute_transit(fresh, zones, state.start_point)])
+
+    # Вылеты: заново группируются те, где удалены квадраты
+    old_sorties, old_plan = state.sorties, state.plan
+    sortie_of_cell = np.full(len(grid), -1, dtype=np.int64)
+    sortie_of_cell[old_sorties.cells] = np.repeat(np.arange(len(old_sorties)), np.diff(old_sorties.offsets))
+    sortie_of_leg = np.cumsum(old_plan.leg_types == LEG_TO) - 1
+    affected = np.zeros(len(old_sorties), dtype=bool)
+    affected[sortie_of_cell[dropped & (sortie_of_cell >= 0)]] = True
+
+    # В остальных вылетах участки через изменения прокладываются заново на месте: подлеты
+    # и возвраты берутся из уже пересчитанных маршрутов квадратов, перелеты ищутся
+    near = np.flatnonzero(_legs_near(old_plan, added, removed))
+    near = near[~affected[sortie_of_leg[near]]]
+    if len(near):
+        cell_leg = np.full((2, num_kept), -1, dtype=np.int64)
+        for leg_type in (LEG_TO, LEG_BACK):
+            legs = np.flatnonzero((cell_plan.leg_types == leg_type) & (cell_plan.cells < num_kept))
+            cell_leg[leg_type, cell_plan.cells[legs]] = legs
+        ends = near[old_plan.leg_types[near] != LEG_HOP]
+        hops = near[old_plan.leg_types[near] == LEG_HOP]
+        copied = cell_plan.take(cell_leg[old_plan.leg_types[ends], remap[old_plan.cells[ends]]])
+        copied.cells = old_plan.cells[ends]
+        old_plan = old_plan.replace(np.concatenate((ends, hops)), FlightPlan.concatenate(
+            [copied, reroute_transit(_straight(old_plan.take(hops)), zones, state.start_point)]))
+        old_sorties, over = _update_sortie_costs(old_sorties, old_plan, sortie_of_leg,
+                                                 np.unique(sortie_of_leg[near]), drone, terrain, crs)
+        affected[over] = True
+        changes['rerouted_sorties'] = len(np.unique(sortie_of_leg[near])) - len(over)
+    keep_sorties = np.flatnonzero(~affected)
+    changes['rescheduled_sorties'] = int(affected.sum())
+
+    replanned = np.concatenate((remap[old_sorties.cells[np.isin(sortie_of_cell[old_sorties.cells],
+                                                                 np.flatnonzero(affected))]],
+                                new_cells))
+    replanned = replanned[replanned >= 0]
+    sorties = _take_sorties(old_sorties, keep_sorties, remap)
+    plan = old_plan.take(np.flatnonzero(~affected[sortie_of_leg]))
+    plan.cells = remap[plan.cells]
+    if len(replanned):
+        sub_plan = cell_plan.take(np.flatnonzero(np.isin(cell_plan.cells, replanned)))
+        extra = schedule_sorties(sub_plan, shapely.area(new_grid), drone, cell_ids=replanned,
+                                 terrain=terrain, crs=crs)
+        sorties = _concat_sorties(sorties, extra)
+        plan = FlightPlan.concatenate([plan, reroute_transit(extra.to_flight_plan(sub_plan),
+                                                             zones, state.start_point)])
+
+    return PlanState(field_polygon, zones, state.start_point, drone, new_grid,
+                     cell_plan, sorties, plan), changes
+
+
+def _geometry_keys(geometries):
+    """Ключи сравнения геометрий: нормализованный WKB."""
+    geometries = np.asarray(list(geometries), dtype=object)
+    if not len(geometries):
+        return np.empty(0, dtype=object)
+    return shapely.to_wkb(shapely.normalize(geometries))
+
+
+def _touching(bounds, polygons, geometries=None, prefilter_only=False):
+    """Номера объектов с рамками bounds (n, 4), задевающих polygons.
+
+    Кандидаты отбираются сравнением рамок массивом, точная проверка -
+    только для них; без geometries проверяются сами прямоугольники bounds.
+    prefilter_only=True возвращает кандидатов без точной проверки.
+    """
+    polygons = np.asarray(list(polygons), dtype=object)
+    if not len(polygons) or not len(bounds):
+        return np.empty(0, dtype=np.int64)
+    near = np.zeros(len(bounds), dtype=bool)
+    for minx, miny, maxx, maxy in shapely.bounds(polygons):
+        near |= ((bounds[:, 0] <= maxx) & (bounds[:, 2] >= minx)
+                 & (bounds[:, 1] <= maxy) & (bounds[:, 3] >= miny))
+    candidates = np.flatnonzero(near)
+    if prefilter_only:
+        return candidates
+    shapes = shapely.box(*bounds[candidates].T) if geometries is None else geometries[candidates]
+    hit = STRtree(polygons).query(shapes, predicate='intersects')[0]
+    return candidates[np.unique(hit)]
+
+
+def _lattice_bounds(cell_bounds, field_polygon, sizing):
+    """Рамки квадратов решетки, из которых обрезаны квадраты сетки (по центрам их рамок)."""
+    centers = (cell_bounds[:, :2] + cell_bounds[:, 2:]) / 2
+    return sizing.leaf_bounds(centers, field_polygon.bounds[:2])
+
+
+def _legs_near(plan, added, removed, clearance=ZONE_CLEARANCE):
+    """Маска транзитных участков плана (подлеты, возвраты, перелеты), которые
+    пересекают добавленные зоны или обходят удаленные.
+
+    Обход удаленной зоны (участок больше чем из двух вершин, проходящий не
+    дальше 2 * clearance от нее) может стать короче, поэтому такой участок
+    тоже пересчитывается. Участки обработки не проверяются: их квадраты,
+    задетые зонами, удаляются. Отрезки отбираются сравнением рамок
+    массивом, точная проверка - только для отрезков рядом с зонами.
+    """
+    near = np.zeros(len(plan), dtype=bool)
+    if not len(plan) or not len(added) and not len(removed):
+        return near
+    legs = np.flatnonzero(np.isin(plan.leg_types, (LEG_TO, LEG_BACK, LEG_HOP)))
+    lengths = plan.offsets[legs + 1] - plan.offsets[legs]
+    leg_of = np.repeat(legs, lengths)
+    vertices = plan.vertices[_leg_vertex_index(plan.offsets, legs)]
+    # Отрезки внутри участков, без стыков соседних участков
+    inner = np.flatnonzero(leg_of[1:] == leg_of[:-1])
+    origins, targets = vertices[inner], vertices[inner + 1]
+    bounds = np.hstack((np.minimum(origins, targets), np.maximum(origins, targets)))
+
+    if len(removed):
+        detour = np.flatnonzero(np.repeat(lengths > 2, lengths)[inner])
+        zones = shapely.buffer(np.asarray(list(removed), dtype=object), 2 * clearance)
+        candidates = detour[_touching(bounds[detour], zones, prefilter_only=True)]
+        lines = shapely.linestrings(np.stack((origins[candidates], targets[candidates]), axis=1))
+        hit = candidates[np.unique(STRtree(zones).query(lines, predicate='intersects')[0])]
+        near[leg_of[inner[hit]]] = True
+    if len(added):
+        zones = np.asarray(list(added), dtype=object)
+        candidates = _touching(bounds, zones, prefilter_only=True)
+        shapely.prepare(zones)
+        crossing = segments_crossing(STRtree(zones), zones, _bbox_corners(zones),
+                                     origins[candidates], targets[candidates])
+        near[leg_of[inner[candidates[crossing]]]] = True
+    return near
+
+
+def _straight(plan):
+    """Участки плана прямыми отрезками от первой вершины до последней."""
+    ends = np.stack((plan.offsets[:-1], plan.offsets[1:] - 1), axis=1).ravel()
+    return FlightPlan(plan.vertices[ends], np.arange(0, 2 * len(plan) + 1, 2), plan.leg_types, plan.cells)
+
+
+def _update_sortie_costs(sorties, plan, sortie_of_leg, ids, drone, terrain=None, crs=None):
+    """Время и длина вылетов ids по их участкам в plan; возвращает (SortiePlan, вылеты сверх заряда).
+
+    Квадраты и раствор вылетов не меняются, меняются только транзитные
+    участки, поэтому достаточно пересчитать стоимость участков этих вылетов.
+    """
+    legs = np.flatnonzero(np.isin(sortie_of_leg, ids))
+    sub_plan = plan.take(legs)
+    position = np.searchsorted(ids, sortie_of_leg[legs])
+    time, energy = (np.bincount(position, weights=values, minlength=len(ids))
+                    for values in leg_costs(sub_plan, drone['speed'], terrain, crs))
+    durations, distances = sorties.durations.copy(), sorties.distances.copy()
+    durations[ids] = time
+    distances[ids] = np.bincount(position, weights=sub_plan.leg_lengths(), minlength=len(ids))
+    over = ids[energy > drone['flight_time'] * 60]
+    return SortiePlan(sorties.cells, sorties.offsets, durations, distances, sorties.solution, sorties.feasible), over
+
+
+def _take_sorties(sorties, ids, remap):
+    """Вылеты ids плана sorties с перенумерацией квадратов remap."""
+    lengths = sorties.offsets[ids + 1] - sorties.offsets[ids]
+    cells = sorties.cells[_leg_vertex_index(sorties.offsets, ids)]
+    return SortiePlan(remap[cells], np.concatenate(([0], np.cumsum(lengths))), sorties.durations[ids],
+                      sorties.distances[ids], sorties.solution[ids], sorties.feasible[ids])
+
+
+def _concat_sorties(first, second):
+    """Вылеты first, затем second."""
+    return SortiePlan(np.concatenate((first.cells, second.cells)),
+                      np.concatenate((first.offsets, second.offsets[1:] + len(first.cells))),
+                      np.concatenate((first.durations, second.durations)),
+                      np.concatenate((first.distances, second.distances)),
+                      np.concatenate((first.solution, second.solution)),
+                      np.concatenate((first.feasible, second.feasible)))
+
+
+def _pack_wkb(geometries):
+    """WKB геометрий одним массивом байтов и границы (как вершины участков FlightPlan)."""
+    blobs = shapely.to_wkb(np.asarray(list(geometries), dtype=object)).tolist() if len(geometries) else []
+    offsets = np.concatenate(([0], np.cumsum([len(blob) for blob in blobs], dtype=np.int64)))
+    return np.frombuffer(b''.join(blobs), dtype=np.uint8), offsets
+
+
+def _unpack_wkb(buffer, offsets):
+    """Обратное к _pack_wkb преобразование."""
+    data = buffer.tobytes()
+    return shapely.from_wkb([data[offsets[i]:offsets[i + 1]] for i in range(len(offsets) - 1)])
@@ -1,10 +1,15 @@
+import hashlib
+import os
+from concurrent.futures import ProcessPoolExecutor
+
 import numpy as np
+import shapely
 from shapely.geometry import Polygon, Point
 from shapely.strtree import STRtree
-from tqdm import tqdm
+from flight_plan import FlightPlan, LEG_SPRAY, as_geometry_array
+from time_class import count, stage
+from transit import reroute_transit
 import geopandas as gpd
-import geojson
-from geopandas import GeoDataFrame
 
 def is_point_in_forbidden_area(point, forbidden_areas):
 
@@ -19,131 +24,449 @@ def is_point_in_forbidden_area(point, forbidden_areas):
     return False
 
 def create_spray_route(field_size, drone, forbidden_areas):
+    """Маршрут "косилкой" по прямоугольному полю field_size = (ширина, высота).
 
+    Обертка над plan_spray_swaths: возвращает список точек (x, y) - концы
+    галсов в порядке облета, без участков внутри запретных зон.
+    """
     if not isinstance(field_size, tuple) or len(field_size) != 2:
 
         raise ValueError("field_size должен быть кортежем из двух элементов")
 
-    spray_width = drone['spray_width']
-    rows = int(field_size[1] // spray_width)
-    spray_route = []
+    field = shapely.box(0, 0, field_size[0], field_size[1])
+    zones = [Polygon(area) for area in forbidden_areas]
+    spray = plan_spray_swaths([field], drone['spray_width'], zones)
+
+    return [tuple(point) for point in spray.vertices.tolist()]
+
+
+def plan_spray_swaths(areas, spray_width, restricted_zones=None):
+    """Строит маршруты обработки "косилкой" (boustrophedon) для каждой площади.
+
+    areas - полигоны квадратов сетки (GeoSeries, GeoDataFrame или массив) либо
+    одно поле целиком. В каждой площади строятся параллельные галсы с шагом
+    не больше spray_width, все галсы всех площадей одним векторным вызовом
+    обрезаются по площади и по запретным зонам (подготовленные геометрии,
+    STRtree) и упорядочиваются змейкой. Возвращает FlightPlan с участком
+    LEG_SPRAY на каждую площадь, где остался хотя бы один галс; номер
+    площади - в cells.
+    """
+    areas = as_geometry_array(areas)
+
+    # Горизонтальные галсы: n рядов на площадь, равномерно по высоте
+    minx, miny, maxx, maxy = shapely.bounds(areas).T
+    rows = np.maximum(np.ceil((maxy - miny) / spray_width), 1).astype(np.int64)
+    area_of_line = np.repeat(np.arange(len(areas)), rows)
+    row = np.arange(rows.sum()) - np.repeat(np.cumsum(rows) - rows, rows)
+    y = miny[area_of_line] + (row + 0.5) * ((maxy - miny) / rows)[area_of_line]
+    coords = np.column_stack((np.stack((minx[area_of_line], maxx[area_of_line]), axis=1).ravel(),
+                              np.repeat(y, 2)))
+    lines = shapely.linestrings(coords, indices=np.repeat(np.arange(len(y)), 2))
+
+    # Обрезка по площадям: галсы целиком внутри не трогаем
+    shapely.prepare(areas)
+    inside = shapely.contains_properly(areas[area_of_line], lines)
+    lines[~inside] = shapely.intersection(lines[~inside], areas[area_of_line[~inside]])
+
+    # Вычитаем запретные зоны только из галсов, которые их пересекают
+    if restricted_zones is not None and len(restricted_zones):
+        zones = np.asarray(restricted_zones, dtype=object)
+        shapely.prepare(zones)
+        hit = np.unique(STRtree(zones).query(lines, predicate='intersects')[0])
+        if hit.size:
+            lines[hit] = shapely.difference(lines[hit], shapely.union_all(zones))
+
+    # Разбиваем на отдельные отрезки и отбрасываем пустые и точечные
+    segments, line_index = shapely.get_parts(lines, return_index=True)
+    seg_minx, _, seg_maxx, _ = shapely.bounds(segments).T
+    keep = (shapely.get_type_id(segments) == 1) & (seg_maxx > seg_minx)
+    segments, line_index = segments[keep], line_index[keep]
+    seg_minx, seg_maxx = seg_minx[keep], seg_maxx[keep]
+
+    # Змейка: четные ряды слева направо, нечетные - справа налево
+    seg_area = area_of_line[line_index]
+    seg_row = row[line_index]
+    reverse = seg_row % 2 == 1
+    order = np.lexsort((np.where(reverse, -seg_minx, seg_minx), seg_row, seg_area))
+    seg_area, reverse, seg_y = seg_area[order], reverse[order], y[line_index[order]]
+    seg_minx, seg_maxx = seg_minx[order], seg_maxx[order]
+
+    start_x = np.where(reverse, seg_maxx, seg_minx)
+    end_x = np.where(reverse, seg_minx, seg_maxx)
+    vertices = np.stack((np.column_stack((start_x, seg_y)), np.column_stack((end_x, seg_y))), axis=1).reshape(-1, 2)
+
+    # Участок на площадь: все концы ее галсов подряд
+    cells, counts = np.unique(seg_area, return_counts=True)
+    offsets = np.concatenate(([0], np.cumsum(2 * counts)))
+    return FlightPlan(vertices, offsets, np.full(len(cells), LEG_SPRAY), cells)
+
+
+# Сторона квадрата без данных о запасе хода дрона, м ("квадраты 50x50 м")
+DEFAULT_CELL_SIZE = 50.0
+# Доля заряда и бака на один квадрат: вылет вмещает около 1 / CELL_FILL квадратов,
+# остаток уходит на перелеты между ними и неполные квадраты у границы поля
+CELL_FILL = 0.5
+# Наименьшая сторона квадрата, в полосах распыления
+MIN_CELL_SWATHS = 2
+
+
+def grid_step(spray_width, drone_flight_radius):
+    """Сторона квадрата (м) без данных о запасе хода: около DEFAULT_CELL_SIZE, целое число полос.
+
+    drone_flight_radius - радиус полета дрона, км: квадрат не больше того,
+    что дрон облетает, не удаляясь от его угла дальше радиуса (диагональ
+    квадрата не длиннее радиуса), но не меньше одной полосы.
+    """
+    swaths = max(round(DEFAULT_CELL_SIZE / spray_width), 1)
+    reach = int(drone_flight_radius * 1000 / np.sqrt(2) // spray_width)
+    return max(min(swaths, reach), 1) * spray_width
+
+
+class CellSizing:
+    """Размер квадратов сетки по запасу хода дрона и удаленности от точки старта.
+
+    Квадрат должен обрабатываться за долю fill вылета вместе с подлетом и
+    возвратом: на обработку остается flight_time * speed - 2 * d метров
+    полета (d - расстояние до ближайшей точки старта), то есть площадь
+    (flight_time * speed - 2 * d) * spray_width, но не больше efficiency га
+    (бак). Сторона округляется вниз до целого числа полос.
+
+    Сетка строится деревом квадрантов: квадраты решетки со стороной
+    max_side делятся на четыре, пока квадрат не помещается целиком в один
+    вылет (fill = 1) из дальнего от старта угла, поэтому у старта квадраты
+    крупные, а вдали - мельче, и подлет к дальним квадратам не съедает
+    весь заряд. Если из дальнего угла дрон не возвращается даже с
+    наименьшим квадратом, берется ближний край.
+    """
+
+    __slots__ = ('spray_width', 'flight_range', 'tank_area', 'start_points', 'fill')
+
+    def __init__(self, drone, start_points, fill=CELL_FILL):
+        self.spray_width = float(drone['spray_width'])
+        self.flight_range = float(drone['flight_time']) * 60 * float(drone['speed'])  # м на один заряд
+        self.tank_area = float(drone['efficiency']) * 10_000  # м2 на один бак
+        self.start_points = np.asarray(start_points, dtype=float).reshape(-1, 2)
+        self.fill = fill
+
+    @property
+    def min_side(self):
+        return MIN_CELL_SWATHS * self.spray_width
+
+    @property
+    def max_side(self):
+        """Сторона квадратов решетки - допустимая у самой точки старта."""
+        side = float(self.side(0.0))
+        return side if np.isfinite(side) else self.min_side
+
+    def key(self):
+        """Параметры, от которых зависит сетка (для ключа кэша)."""
+        return (self.spray_width, self.flight_range, self.tank_area, self.fill,
+                tuple(map(tuple, np.round(self.start_points, 3).tolist())))
+
+    def side(self, distance, fill=None):
+        """Допустимая сторона квадрата (м) на расстоянии distance от старта; inf - не долететь и с наименьшим."""
+        distance = np.asarray(distance, dtype=float)
+        area = np.minimum(np.maximum(self.flight_range - 2 * distance, 0) * self.spray_width,
+                          self.tank_area) * (self.fill if fill is None else fill)
+        side = np.floor(np.sqrt(area) / self.spray_width) * self.spray_width
+        return np.where(side >= self.min_side, side, np.inf)
+
+    def split(self, x0, y0, side):
+        """Маска квадратов (левые нижние углы x0, y0, общая сторона side), которые делятся на четыре."""
+        if side / 2 < self.min_side:
+            return np.zeros(len(x0), dtype=bool)
+        sx, sy = self.start_points[:, 0], self.start_points[:, 1]
+        x0, y0 = x0[:, None], y0[:, None]
+        # Ближайшая к старту и дальняя от него точки квадрата
+        near = np.hypot(np.maximum(np.maximum(x0 - sx, sx - x0 - side), 0),
+                        np.maximum(np.maximum(y0 - sy, sy - y0 - side), 0)).min(axis=1)
+        far = np.hypot(np.maximum(np.abs(x0 - sx), np.abs(x0 + side - sx)),
+                       np.maximum(np.abs(y0 - sy), np.abs(y0 + side - sy))).min(axis=1)
+        need = self.side(far, fill=1.0)
+        need = np.where(np.isinf(need), self.side(near, fill=1.0), need)
+        return side > need
+
+    def leaves(self, x0, y0):
+        """Делит квадраты решетки max_side (левые нижние углы) до допустимого размера; (x0, y0, side)."""
+        xs, ys, sides = [], [], []
+        side = self.max_side
+        while len(x0):
+            split = self.split(x0, y0, side)
+            xs.append(x0[~split])
+            ys.append(y0[~split])
+            sides.append(np.full(len(xs[-1]), side))
+            half = side / 2
+            x0, y0 = x0[split], y0[split]
+            x0 = np.concatenate((x0, x0 + half, x0, x0 + half))
+            y0 = np.concatenate((y0, y0, y0 + half, y0 + half))
+            side = half
+        return np.concatenate(xs), np.concatenate(ys), np.concatenate(sides)
+
+    def leaf_bounds(self, points, origin):
+        """Рамки (minx, miny, maxx, maxy) квадратов дерева от угла решетки origin, содержащих точки."""
+        points = np.asarray(points, dtype=float).reshape(-1, 2)
+        side = self.max_side
+        corners = np.asarray(origin, dtype=float) + np.floor((points - origin) / side) * side
+        sides = np.full(len(points), side)
+        active = np.arange(len(points))
+        while len(active):
+            split = self.split(corners[active, 0], corners[active, 1], side)
+            active = active[split]
+            side /= 2
+            sides[active] = side
+            corners[active] += np.where(points[active] >= corners[active] + side, side, 0.0)
+        return np.hstack((corners, corners + sides[:, None]))
+
+
+@stage('generate_flight_grid')
+def generate_flight_grid(field_polygon, spray_width, drone_flight_radius, crs=None, region=None, step=None):
+    """Генерирует сетку полетных квадратов, обрезанную по границе поля.
+
+    Все квадраты создаются одним пакетом из массивов координат. Через STRtree
+    отбираются только квадраты, чей bbox пересекает поле, и точная обрезка
+    выполняется лишь для граничных квадратов. Координаты поля - в метрах
+    зоны UTM, которая передается в crs. С region строятся только квадраты
+    той же решетки (от угла bbox поля), задевающие region, - для пересчета
+    части сетки. step - сторона квадрата (по умолчанию grid_step) или
+    CellSizing: тогда квадраты решетки делятся по удаленности от старта.
+    """
+    sizing = step if isinstance(step, CellSizing) else None
+    if sizing is not None:
+        step = sizing.max_side
+    elif step is None:
+        step = grid_step(spray_width, drone_flight_radius)
 
-    for i in range(rows):
+    # Получаем границы поля
+    minx, miny, maxx, maxy = field_polygon.bounds
+    x_step = y_step = step
+    x_starts = np.arange(minx, maxx, x_step)
+    y_starts = np.arange(miny, maxy, y_step)
+    if region is not None:
+        region_minx, region_miny, region_maxx, region_maxy = region.bounds
+        x_starts = x_starts[(x_starts + x_step >= region_minx) & (x_starts <= region_maxx)]
+        y_starts = y_starts[(y_starts + y_step >= region_miny) & (y_starts <= region_maxy)]
+
+    # Левые нижние углы всех квадратов (x - внешний цикл, y - внутренний)
+    x0, y0 = np.meshgrid(x_starts, y_starts, indexing='ij')
+    x0 = x0.ravel()
+    y0 = y0.ravel()
+    grid_squares = shapely.box(x0, y0, x0 + x_step, y0 + y_step)
+
+    # Оставляем только квадраты, чей bbox пересекается с полем,
+    # и сразу отбрасываем те, что касаются только bbox поля, но не его самого
+    candidates = np.sort(STRtree(grid_squares).query(field_polygon, predicate='intersects'))
+    grid_squares = grid_squares[candidates]
+    shapely.prepare(field_polygon)
+    if sizing is not None:
+        x0, y0, sides = sizing.leaves(x0[candidates], y0[candidates])
+        grid_squares = shapely.box(x0, y0, x0 + sides, y0 + sides)
+        grid_squares = grid_squares[shapely.intersects(field_polygon, grid_squares)]
+    if region is not None:
+        shapely.prepare(region)
+        grid_squares = grid_squares[shapely.intersects(region, grid_squares)]
+
+    # Квадраты целиком внутри поля не обрезаем, граничные - обрезаем точно
+    on_border = ~shapely.contains_properly(field_polygon, grid_squares)
+    grid_squares[on_border] = shapely.intersection(grid_squares[on_border], field_polygon)
+    grid_squares = _keep_polygonal(grid_squares)
+    count('cells_generated', len(grid_squares))
+
+    return gpd.GeoDataFrame(geometry=grid_squares, crs=crs)  # crs - зона UTM поля
+
+
+def _keep_polygonal(geometries):
+    """Оставляет только площадные части геометрий и отбрасывает пустые."""
+
+    collections = shapely.get_type_id(geometries) == 7
+    for i in np.flatnonzero(collections):
+        parts = shapely.get_parts(geometries[i])
+        parts = parts[np.isin(shapely.get_type_id(parts), (3, 6))]
+        geometries[i] = shapely.union_all(parts)
+
+    polygonal = np.isin(shapely.get_type_id(geometries), (3, 6))
+    return geometries[polygonal & (shapely.area(geometries) > 0)]
+
+# Папка кэша сеток и версия алгоритма построения сетки (входит в ключ кэша)
+GRID_CACHE_DIR = os.getenv("GRID_CACHE_DIR", ".grid_cache")
+GRID_CACHE_VERSION = 3
+
+
+def grid_cache_key(field_geojson_path, restricted_geojson_path, spray_width, flight_radius, step=None):
+    """Возвращает ключ кэша сетки: хэш содержимого входных файлов, параметров дрона и размера квадратов."""
+
+    sha = hashlib.sha256(f"v{GRID_CACHE_VERSION}".encode())
+    for path in (field_geojson_path, restricted_geojson_path):
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                sha.update(chunk)
+        sha.update(b'\0')
+    sha.update(repr((float(spray_width), float(flight_radius))).encode())
+    sha.update(repr(step.key() if isinstance(step, CellSizing) else step).encode())
+    return sha.hexdigest()
+
+
+def grid_cache_path(cache_key, cache_dir=GRID_CACHE_DIR):
+    """Путь к файлу сетки в кэше."""
+    return os.path.join(cache_dir, f"{cache_key}.parquet")
 
-        if i % 2 == 0:
-            route_row = [(x, i * spray_width) for x in range(0, field_size[0], spray_width)]
 
-        else:
-            route_row = [(x, i * spray_width) for x in range(field_size[0], 0, -spray_width)]
-        route_row = [point for point in route_row if not is_point_in_forbidden_area(point, forbidden_areas)]
-        spray_route.extend(route_row)
+def save_grid_to_file(grid, filename):
+    """Сохраняет сетку в файл GeoParquet."""
 
-    return spray_route
+    folder = os.path.dirname(filename)
+    if folder:
+        os.makedirs(folder, exist_ok=True)
 
-    '''Чтобы выбрать размер квадрата для сетки, основываемся на ограничениях дрона:
-        - Полоса распыления — 12 метров (0.012 км).
-        - Площадь, покрываемая за один пролет — не более 5 гектаров (50000 м²).
-        Таким образом, подходящий размер квадрата будет зависеть от эффективного времени полета и максимального радиуса дрона.
-        Ширина полосы распыления: 12 метров (это ширина одного пролета). Длина одного пролета (для покрытия 5 гектаров):
-        Длина пролета = 50000/12 ≈ 4166.67 метров, но это превышает радиус в 2.5 км. 
-        Таким образом, придется делать несколько таких квадратов.
-        Поэтому целесообразно выбрать квадрат 50x50 метров (в пределах разумного, чтобы не перегружать расчет сетки).'''
+    # Пишем во временный файл, чтобы прерванная запись не испортила кэш
+    tmp_filename = f"{filename}.tmp"
+    try:
+        grid.to_parquet(tmp_filename, index=False)
+    except ImportError as e:
+        print(f"Сетка не сохранена, нет поддержки GeoParquet: {e}")
+        return
+    os.replace(tmp_filename, filename)
+    print("Сетка сохранена в файл:", filename)
 
-def generate_flight_grid(field_polygon, spray_width, drone_flight_radius):
-    # Создаем GeoDataFrame для поля
-    field_gdf = gpd.GeoDataFrame([1], geometry=[field_polygon], crs="EPSG:4326")  # EPSG:4326 для географических данных
 
-    # Получаем границы поля
-    minx, miny, maxx, maxy = field_polygon.bounds
-    x_step = spray_width * 40 / 1000  # Шаг в км (0.5)
-    y_step = spray_width * 40 / 1000  # Шаг в км
+def load_grid_from_file(filename):
+    """Загружает сетку из файла GeoParquet."""
 
-    # Создаем список для хранения квадратов
-    grid_squares = []
+    if not os.path.exists(filename):
+        print(f"Файл {filename} не существует.")
+        return None
+    try:
+        return gpd.read_parquet(filename)
+    except (ImportError, OSError, ValueError) as e:
+        print(f"Ошибка при загрузке сетки из {filename}: {e}")
+        return None
 
-    # Генерация сетки
-    for x in tqdm(np.arange(minx, maxx, x_step), desc="Создание сетки"):
-        for y in np.arange(miny, maxy, y_step):
-            grid_square = Polygon([(x, y), (x + x_step, y), (x + x_step, y + y_step), (x, y + y_step)])
-            grid_squares.append(grid_square)
+@stage('remove_restricted_areas')
+def remove_restricted_areas(grid, restricted_areas):
+    """Удаляет из сетки квадраты, пересекающиеся с запретными зонами.
+
+    Все квадраты проверяются против всех зон одним пакетным запросом
+    к STRtree, построенному по сетке. Вместо списка зон можно передать
+    готовый STRtree зон, общий для нескольких сеток.
+    """
+    squares = grid.geometry.values
+
+    # Проверка на валидность геометрии
+    valid = shapely.is_valid(squares)
+    if not valid.all():
+        print("Недопустимые геометрии:", squares[~valid])
+
+    # Квадраты, которые действительно пересекаются с зонами
+    if isinstance(restricted_areas, STRtree):
+        hit_cells = restricted_areas.query(squares, predicate='intersects')[0]
+    else:
+        hit_cells = STRtree(squares).query(np.asarray(restricted_areas, dtype=object), predicate='intersects')[1]
 
-    # Превращаем сетку в GeoDataFrame
-    grid_gdf = gpd.GeoDataFrame(geometry=grid_squares, crs="EPSG:4326")
-    #print("Generated grid (первые 5 элементов):", grid_gdf.head())  # Вывод первых 5 элементов сетки
-    #print("Grid types:", [type(geom) for geom in grid_gdf.geometry])  # Проверяем типы объектов в сетке
+    if not hit_cells.size and valid.all():
+        print("Нет пересечений между зоной полета и запретными зонами. Возвращаем исходную сетку.")
+        return grid  # Возвращаем исходный grid, так как пересечений нет
 
-    # Оставляем только те квадраты, которые пересекаются с полем
-    intersecting_grid = gpd.overlay(grid_gdf, field_gdf, how='intersection')
+    keep = valid.copy()
+    keep[hit_cells] = False
+    count('cells_rejected', int(len(keep) - keep.sum()))
 
-    return intersecting_grid
+    if not keep.any():
+        print("Нет допустимых зон для полета.")
 
-def save_grid_to_file(grid, filename):
-    """Сохраняет сетку в файл."""
+    return grid[keep].reset_index(drop=True)
 
-    print(grid.head())  # Посмотрим на первые 5 строк данных
-    print(grid.dtypes)  # Проверим типы данных в столбцах
-    grid['0'] = grid['0'].astype(str)
-    grid.to_file(filename, driver='GeoJSON')
 
+@stage('build_valid_grid')
+def build_valid_grid(field_polygon, restricted_zones, spray_width, flight_radius, crs=None, cache_path=None,
+                     step=None):
+    """Сетка полета без запретных зон; при заданном cache_path берется из кэша или сохраняется в него.
 
-def load_grid_from_file(filename):
-    """Загружает сетку из файла."""
+    restricted_zones - список полигонов или готовый STRtree зон, step -
+    размер квадратов (см. generate_flight_grid).
+    """
+    if cache_path is not None:
+        valid_grid = load_grid_from_file(cache_path)
+        if valid_grid is not None:
+            print("Сетка загружена из файла:", cache_path)
+            count('grid_cache_hits')
+            return valid_grid
 
-    if not os.path.exists(filename):
-        print(f"Файл {filename} не существует.")
-        return None
-    return gpd.read_file(filename)
+    # Генерация сетки полета
+    print("Генерация сетки полета...")
+    grid = generate_flight_grid(field_polygon, spray_width, flight_radius, crs, step=step)
 
-def remove_restricted_areas(grid, restricted_areas):
-    print("Restricted areas:", restricted_areas)
+    # Удаляем зоны, пересекающиеся с запретными
+    print("Удаление запретных зон...")
+    valid_grid = remove_restricted_areas(grid, restricted_zones)
 
-    # Проверка на пересечения
-    has_intersections = any(
-        any(square.intersects(restricted_area) for restricted_area in restricted_areas)
-        for square in grid.geometry
-    )
+    if cache_path is not None:
+        save_grid_to_file(valid_grid, cache_path)
+    return valid_grid
 
-    if not has_intersections:
-        print("Нет пересечений между зоной полета и запретными зонами. Возвращаем исходную сетку.")
-        return grid  # Возвращаем исходный grid, так как пересечений нет
 
-    valid_grid = []
-    for square in grid.geometry:
-        #print("Square:", square)  # Отладочный вывод
-        #print("Square type:", type(square))  # Проверяем тип
-
-        # Проверка на валидность геометрии
-        if square.is_valid:
-            intersects = any(square.intersects(restricted_area) for restricted_area in restricted_areas)
-
-            if not intersects:
-                valid_grid.append(square)
-        else:
-            print("Недопустимая геометрия:", square)
-
-    # Создаем GeoDataFrame из валидных геометрий
-    if valid_grid:
-        valid_grid_gdf = gpd.GeoDataFrame(geometry=valid_grid)
-        print("Grid types:", valid_grid_gdf.geometry.apply(type))  # Проверяем типы объектов
-        return valid_grid_gdf
+# Число процессов для расчета маршрутов (0 - по числу ядер, 1 - последовательно)
+PLANNING_WORKERS = int(os.getenv("PLANNING_WORKERS", "0"))
+# Число квадратов в одной порции, отправляемой в процесс
+PLANNING_CHUNK_SIZE = 20000
+
+# Общие для всех порций данные процесса-исполнителя (зоны, старт, ширина распыления)
+_worker_state = {}
+
+
+@stage('calculate_flight_path')
+def calculate_flight_path(valid_grid, start_point, spray_width, restricted_zones=None,
+                          workers=PLANNING_WORKERS, chunk_size=PLANNING_CHUNK_SIZE):
+    """Рассчитывает маршруты (подлет, обработка галсами, возврат) для всех квадратов сетки.
+
+    Сетка делится на порции по chunk_size квадратов, порции считаются в
+    ProcessPoolExecutor из workers процессов (геометрия передается в WKB)
+    и склеиваются в исходном порядке, поэтому результат не зависит от
+    числа процессов. При workers=1 или одной порции расчет идет в текущем
+    процессе (удобно для отладки). Подлеты и возвраты, пересекающие
+    запретные зоны, затем заменяются путями в обход (transit.reroute_transit).
+    """
+    squares = as_geometry_array(valid_grid)
+    zones = list(restricted_zones) if restricted_zones is not None else []
+    start_point = tuple(np.asarray(start_point, dtype=float)[:2])
+
+    if not workers:
+        workers = os.cpu_count() or 1
+    bounds = list(range(0, len(squares), chunk_size)) + [len(squares)]
+
+    if workers == 1 or len(bounds) <= 2:
+        plan = _plan_cells(squares, start_point, spray_width, zones)
     else:
-        print("Нет допустимых зон для полета.")
-        return gpd.GeoDataFrame(columns=['geometry'])  # Возвращаем пустой GeoDataFrame с нужной колонкой
-
-
-# def calculate_flight_path(valid_grid, start_point):
-#     flight_paths = []
-#
-#     for index, row in valid_grid.iterrows():
-#         square = row.geometry  # Получаем геометрию квадрата
-#         path_to_square = [processed_data['start_point'],
-#                           square.centroid]  # Дрон летит из стартовой точки к центру квадрата
-#
-#         # Создаем словарь для маршрута
-#         flight_path = {
-#             'to_square': path_to_square,
-#             'back': [square.centroid, processed_data['start_point']]  # Возвращаемся обратно
-#         }
-#
-#         flight_paths.append(flight_path)
-#         return flight_paths
\ No newline at end of file
+        plan = _plan_chunks(squares, start_point, spray_width, zones, workers, bounds)
+    plan = reroute_transit(plan, zones, start_point)
+    count('route_legs', len(plan))
+    count('route_vertices', len(plan.vertices))
+    return plan
+
+
+def _plan_chunks(squares, start_point, spray_width, zones, workers, bounds):
+    """Маршруты квадратов, посчитанные порциями [bounds[i], bounds[i + 1]) в процессах."""
+    chunks = (shapely.to_wkb(squares[first:last]) for first, last in zip(bounds[:-1], bounds[1:]))
+    with ProcessPoolExecutor(max_workers=workers,
+                             initializer=_init_planning_worker,
+                             initargs=(shapely.to_wkb(np.asarray(zones, dtype=object)), start_point, spray_width)
+                             ) as executor:
+        plans = list(executor.map(_plan_chunk, chunks))
+    return FlightPlan.concatenate(plans, bounds[:-1])
+
+
+def _plan_cells(squares, start_point, spray_width, restricted_zones):
+    """Маршруты для набора квадратов (номера квадратов - от начала набора)."""
+    spray = plan_spray_swaths(squares, spray_width, restricted_zones)
+    return FlightPlan.from_grid(squares, start_point, spray)
+
+
+def _init_planning_worker(zones_wkb, start_point, spray_width):
+    _worker_state['zones'] = list(shapely.from_wkb(zones_wkb))
+    _worker_state['start_point'] = start_point
+    _worker_state['spray_width'] = spray_width
+
+
+def _plan_chunk(chunk_wkb):
+    return _plan_cells(shapely.from_wkb(chunk_wkb),
+                       _worker_state['start_point'],
+                       _worker_state['spray_width'],
+                       _worker_state['zones'])
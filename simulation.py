@@ -0,0 +1,249 @@
+import numpy as np
+from flight_plan import FlightPlan, LEG_SPRAY
+from terrain import flight_costs, terrain_profile
+
+# Коды событий временной шкалы полета
+EVENT_WAYPOINT = 0  # прибытие в вершину маршрута
+EVENT_LANDING = 1   # плановая посадка на базе по маршруту (замена батареи, заправка)
+EVENT_RETURN = 2    # внеплановый возврат на базу для подзарядки или заправки
+EVENT_RESUME = 3    # возвращение с базы в точку, где маршрут был прерван
+EVENT_NAMES = ('waypoint', 'landing', 'return', 'resume')
+
+TIMELINE_DTYPE = np.dtype([
+    ('event', 'i1'),
+    ('vertex', 'i8'),       # номер вершины маршрута
+    ('x', 'f8'),
+    ('y', 'f8'),
+    ('time', 'f8'),         # с от начала миссии
+    ('distance', 'f8'),     # м от начала миссии
+    ('battery', 'f8'),      # оставшееся время полета, с
+    ('tank', 'f8'),         # остаток раствора, л
+])
+
+SUMMARY_DTYPE = np.dtype([
+    ('route', 'i8'),
+    ('drone', 'i8'),
+    ('time', 'f8'),
+    ('distance', 'f8'),
+    ('landings', 'i8'),     # плановые посадки на базе
+    ('returns', 'i8'),      # внеплановые возвраты на базу
+    ('solution', 'f8'),     # израсходовано раствора, л
+    ('feasible', '?'),      # все отрезки выполнимы на полном заряде и баке
+])
+
+# Допуск совпадения вершины маршрута с базой, м
+BASE_TOLERANCE = 1e-6
+# Число участков профиля рельефа на пути вершина - база (по умолчанию шаг ЦМР)
+HOME_PROFILE_PIECES = 32
+
+
+def drone_properties(drone):
+    """Свойства дрона словарем: принимает словарь или объект drones.Drone."""
+    return drone if isinstance(drone, dict) else drone.get_properties()
+
+
+def simulate_route(drone, route, base_point, terrain=None, crs=None):
+    """Моделирует выполнение маршрута одним дроном и возвращает временную шкалу.
+
+    route - FlightPlan (раствор расходуется только на отрезках обработки)
+    или последовательность точек (раствор расходуется на всем маршруте).
+    Длины отрезков считаются одной разностью массива, а точки, где
+    заканчивается заряд или раствор, находятся по порогам кумулятивных
+    сумм. Прибытие на базу по маршруту - плановая посадка с заменой
+    батареи и заправкой. Если до следующей вершины не хватит заряда на
+    полет с запасом на возврат или раствора, дрон возвращается на базу из
+    текущей вершины и затем летит обратно. Результат - массив TIMELINE_DTYPE.
+
+    terrain - ЦМР (terrain.ElevationModel) в системе crs или с crs точек
+    маршрута: подъемы и спуски над рельефом удлиняют отрезки по времени и
+    расходуют заряд (см. terrain.flight_costs). Без ЦМР поверхность ровная.
+    """
+    timeline, _ = _simulate(drone_properties(drone), _RouteArrays(route, base_point, terrain, crs))
+    return timeline
+
+
+def simulate_missions(routes, drones, base_points, with_timelines=False, terrain=None, crs=None):
+    """Пакетное моделирование: каждый маршрут с каждым дроном (анализ "что если").
+
+    base_points - база каждого маршрута или одна точка на все. Длины
+    отрезков, расстояния до базы и профили рельефа считаются один раз на
+    маршрут и используются для всех дронов. Возвращает массив SUMMARY_DTYPE по парам
+    (маршрут, дрон), а при with_timelines=True еще и список временных шкал
+    в том же порядке.
+    """
+    drones = [drone_properties(drone) for drone in drones]
+    base_points = np.asarray(base_points, dtype=float)
+    if base_points.ndim == 1:
+        base_points = np.broadcast_to(base_points, (len(routes), base_points.size))
+
+    summary = np.zeros(len(routes) * len(drones), dtype=SUMMARY_DTYPE)
+    timelines = []
+    row = 0
+    for r, route in enumerate(routes):
+        arrays = _RouteArrays(route, base_points[r], terrain, crs)
+        for d, drone in enumerate(drones):
+            timeline, feasible = _simulate(drone, arrays)
+            events = timeline['event']
+            summary[row] = (r, d,
+                            timeline['time'][-1] if len(timeline) else 0.0,
+                            timeline['distance'][-1] if len(timeline) else 0.0,
+                            np.count_nonzero(events == EVENT_LANDING),
+                            np.count_nonzero(events == EVENT_RETURN),
+                            arrays.spray_length.sum() * _liters_per_meter(drone),
+                            feasible)
+            if with_timelines:
+                timelines.append(timeline)
+            row += 1
+
+    return (summary, timelines) if with_timelines else summary
+
+
+class _RouteArrays:
+    """Общие для всех дронов массивы маршрута: вершины, длины отрезков, расстояния до базы.
+
+    ascent/descent - набор и потеря высоты на отрезках маршрута,
+    home_ascent/home_descent - на пути из каждой вершины на базу (обратный
+    путь с базы в вершину меняет их местами).
+    """
+
+    __slots__ = ('points', 'base', 'lengths', 'spray_length', 'home', 'at_base',
+                 'ascent', 'descent', 'home_ascent', 'home_descent')
+
+    def __init__(self, route, base_point, terrain=None, crs=None):
+        self.base = np.asarray(base_point, dtype=float)[:2]
+        if isinstance(route, FlightPlan):
+            self.points = route.vertices
+            # Отрезок обрабатывает поле, если обе его вершины принадлежат одному участку обработки
+            leg_of = np.repeat(np.arange(len(route.leg_types)), np.diff(route.offsets))
+            spraying = (leg_of[1:] == leg_of[:-1]) & (route.leg_types[leg_of[1:]] == LEG_SPRAY)
+        else:
+            self.points = np.asarray(route, dtype=float).reshape(-1, 2)
+            spraying = np.ones(max(len(self.points) - 1, 0), dtype=bool)
+
+        self.lengths = np.hypot(*np.diff(self.points, axis=0).T)
+        self.spray_length = np.where(spraying, self.lengths, 0.0)
+        self.home = np.hypot(*(self.points - self.base).T)
+        self.at_base = self.home <= BASE_TOLERANCE
+
+        self.ascent, self.descent = terrain_profile(self.points[:-1], self.points[1:], terrain, crs)
+        # Путь до базы нужен только для запаса и возвратов: профиль берется грубее
+        step = None if terrain is None else np.maximum(terrain.resolution, self.home / HOME_PROFILE_PIECES)
+        self.home_ascent, self.home_descent = terrain_profile(
+            self.points, np.broadcast_to(self.base, self.points.shape), terrain, crs, step)
+
+
+def _liters_per_meter(drone):
+    """Расход раствора на метр обработки: бак на drone['efficiency'] га при полосе spray_width."""
+    return drone['tank_capacity'] / (drone['efficiency'] * 10000 / drone['spray_width'])
+
+
+def _simulate(drone, arrays):
+    """Находит точки внеплановых возвратов и возвращает (временная шкала, маршрут выполним)."""
+    battery = drone['flight_time'] * 60
+    tank = drone['tank_capacity']
+
+    num_points = len(arrays.points)
+    if not num_points:
+        return np.zeros(0, dtype=TIMELINE_DTYPE), True
+
+    costs = _costs(drone, arrays)
+    _, segment_energy, _, home_energy, _, out_energy = costs
+    cum_energy = np.concatenate(([0.0], np.cumsum(segment_energy)))
+    cum_spray = np.concatenate(([0.0], np.cumsum(arrays.spray_length * _liters_per_meter(drone))))
+    # Посадка на базе не требует запаса заряда на возврат
+    reserve = np.where(arrays.at_base, 0.0, home_energy)
+
+    # Ближайшая плановая посадка после каждой вершины: дальше нее порог не ищем
+    base_vertices = np.flatnonzero(arrays.at_base)
+    next_base = np.append(base_vertices, num_points - 1)[
+        np.searchsorted(base_vertices, np.arange(num_points), side='right')]
+
+    returns = []
+    feasible = True
+    # Текущая вершина, израсходованный заряд и раствор на момент вылета из нее,
+    # и признак того, что заряд и бак в ней только что восстановлены
+    i, spent, spray_start, fresh = 0, 0.0, 0.0, True
+    while i < num_points - 1:
+        stop = max(next_base[i], i + 1)
+        window = slice(i + 1, stop + 1)
+        elapsed = spent + cum_energy[window] - cum_energy[i]
+        over = ((elapsed + reserve[window] > battery)
+                | (cum_spray[window] - spray_start > tank))
+        if not over.any():
+            i, spent, spray_start, fresh = stop, 0.0, cum_spray[stop], True
+            continue
+
+        failed = i + 1 + int(np.argmax(over))
+        if failed - 1 > i or not fresh:
+            # Возврат на базу из последней достижимой вершины и полет обратно
+            r = failed - 1
+            returns.append(r)
+            i, spent, spray_start, fresh = r, out_energy[r], cum_spray[r], True
+            continue
+
+        # Отрезок невыполним даже сразу после подзарядки: пролетаем его с нарушением
+        feasible = False
+        i, spent, fresh = failed, elapsed[0], False
+
+    return _timeline(drone, arrays, np.asarray(returns, dtype=np.int64), costs), feasible
+
+
+def _costs(drone, arrays):
+    """Время и расход заряда: на отрезках маршрута, на пути вершина -> база и база -> вершина."""
+    speed = drone['speed']
+    return (*flight_costs(arrays.lengths, arrays.ascent, arrays.descent, speed),
+            *flight_costs(arrays.home, arrays.home_ascent, arrays.home_descent, speed),
+            *flight_costs(arrays.home, arrays.home_descent, arrays.home_ascent, speed))
+
+
+def _timeline(drone, arrays, returns, costs):
+    """Собирает временную шкалу: вершины маршрута и пары строк (возврат, возвращение)."""
+    segment_time, segment_energy, home_time, home_energy, out_time, out_energy = costs
+    points = arrays.points
+    num_points = len(points)
+    vertices = np.arange(num_points)
+
+    # Строка каждой вершины сдвигается на две строки за каждый предшествующий возврат
+    position = vertices + 2 * np.searchsorted(returns, vertices)
+    back, resumed = position[returns] + 1, position[returns] + 2
+
+    timeline = np.zeros(num_points + 2 * len(returns), dtype=TIMELINE_DTYPE)
+    event = timeline['event']
+    # Посадка - прибытие на базу извне; стыки вылетов из базы посадкой не считаются
+    landing = arrays.at_base.copy()
+    landing[0] = False
+    landing[1:] &= ~arrays.at_base[:-1]
+    event[position] = np.where(landing, EVENT_LANDING, EVENT_WAYPOINT)
+    event[back], event[resumed] = EVENT_RETURN, EVENT_RESUME
+    timeline['vertex'][position] = vertices
+    timeline['vertex'][back] = timeline['vertex'][resumed] = returns
+
+    xy = np.empty((len(timeline), 2))
+    xy[position] = points
+    xy[back] = arrays.base
+    xy[resumed] = points[returns]
+    timeline['x'], timeline['y'] = xy.T
+
+    segment = np.hypot(*np.diff(xy, axis=0).T)
+    distance = np.concatenate(([0.0], np.cumsum(segment)))
+    # Время и заряд строки - по отрезку маршрута, пути на базу или обратно
+    step_time, step_energy = np.zeros(len(segment)), np.zeros(len(segment))
+    step_time[position[1:] - 1], step_energy[position[1:] - 1] = segment_time, segment_energy
+    step_time[back - 1], step_energy[back - 1] = home_time[returns], home_energy[returns]
+    step_time[resumed - 1], step_energy[resumed - 1] = out_time[returns], out_energy[returns]
+    elapsed = np.concatenate(([0.0], np.cumsum(step_time)))
+    energy = np.concatenate(([0.0], np.cumsum(step_energy)))
+    # Раствор расходуется только на отрезках, ведущих в вершину маршрута
+    spray = np.zeros(len(segment))
+    spray[position[1:] - 1] = arrays.spray_length * _liters_per_meter(drone)
+    solution = np.concatenate(([0.0], np.cumsum(spray)))
+
+    # Заряд и раствор отсчитываются от последней строки подзарядки
+    recharge = (event == EVENT_LANDING) | (event == EVENT_RETURN)
+    recharge[0] = True
+    last = np.maximum.accumulate(np.where(recharge, np.arange(len(timeline)), 0))
+    timeline['distance'] = distance
+    timeline['time'] = elapsed
+    timeline['battery'] = drone['flight_time'] * 60 - (energy - energy[last])
+    timeline['tank'] = drone['tank_capacity'] - (solution - solution[last])
+    return timeline
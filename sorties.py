@@ -0,0 +1,289 @@
+import numpy as np
+import shapely
+from shapely.strtree import STRtree
+from flight_plan import FlightPlan, LEG_TO, LEG_BACK, LEG_SPRAY, LEG_HOP
+from terrain import flight_costs, terrain_profile
+from time_class import count, stage
+
+
+class SortiePlan:
+    """Разбиение квадратов сетки на вылеты (сессии) дрона.
+
+    Квадраты всех вылетов лежат подряд в cells, вылет i включает
+    cells[offsets[i]:offsets[i + 1]] в порядке облета. Для вылета хранятся
+    длительность (с), длина полета (м), расход раствора (л) и признак
+    выполнимости за один заряд/бак (feasible = False только у вылетов из
+    одного квадрата, который дрону не по силам).
+    """
+
+    __slots__ = ('cells', 'offsets', 'durations', 'distances', 'solution', 'feasible')
+
+    def __init__(self, cells, offsets, durations, distances, solution, feasible):
+        self.cells = np.asarray(cells, dtype=np.int64)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.durations = np.asarray(durations, dtype=float)
+        self.distances = np.asarray(distances, dtype=float)
+        self.solution = np.asarray(solution, dtype=float)
+        self.feasible = np.asarray(feasible, dtype=bool)
+
+    def __len__(self):
+        return len(self.durations)
+
+    def sortie(self, i):
+        """Квадраты вылета i в порядке облета."""
+        return self.cells[self.offsets[i]:self.offsets[i + 1]]
+
+    def to_flight_plan(self, flight_plan, start_point=None, sortie_ids=None):
+        """План полета по вылетам: старт -> квадраты (галсы и перелеты между ними) -> старт.
+
+        flight_plan - план по квадратам (calculate_flight_path), из которого
+        берутся участки обработки, точки входа и выхода квадратов. По
+        умолчанию старт - тот же, что в flight_plan, и берутся все вылеты
+        (sortie_ids - номера вылетов в нужном порядке). С тем же стартом
+        подлет и возврат копируются из flight_plan (вместе с обходом
+        запретных зон), с другим - прямые.
+        """
+        entry, exit_, _ = cell_entry_exit(flight_plan)
+        own_start = start_point is None
+        start = flight_plan.start_point() if own_start else np.asarray(start_point, dtype=float)[:2]
+        spray_legs = _cell_legs(flight_plan, LEG_SPRAY)
+        to_legs = _cell_legs(flight_plan, LEG_TO)
+        back_legs = _cell_legs(flight_plan, LEG_BACK)
+
+        vertices, lengths, leg_types, cells = [], [], [], []
+
+        def add_leg(points, leg_type, cell):
+            vertices.append(points)
+            lengths.append(len(points))
+            leg_types.append(leg_type)
+            cells.append(cell)
+
+        for i in range(len(self)) if sortie_ids is None else sortie_ids:
+            sortie = self.sortie(i)
+            if own_start:
+                add_leg(flight_plan.leg(to_legs[sortie[0]]), LEG_TO, sortie[0])
+            else:
+                add_leg(np.array([start, entry[sortie[0]]]), LEG_TO, sortie[0])
+            for k, cell in enumerate(sortie):
+                if k:
+                    add_leg(np.array([exit_[sortie[k - 1]], entry[cell]]), LEG_HOP, cell)
+                if cell in spray_legs:
+                    add_leg(flight_plan.leg(spray_legs[cell]), LEG_SPRAY, cell)
+            if own_start:
+                add_leg(flight_plan.leg(back_legs[sortie[-1]]), LEG_BACK, sortie[-1])
+            else:
+                add_leg(np.array([exit_[sortie[-1]], start]), LEG_BACK, sortie[-1])
+
+        if not vertices:
+            return FlightPlan(np.empty((0, 2)), [0], [], [])
+        offsets = np.concatenate(([0], np.cumsum(lengths)))
+        return FlightPlan(np.concatenate(vertices), offsets, leg_types, cells)
+
+
+def cell_entry_exit(flight_plan):
+    """Точки входа/выхода и длина обработки каждого квадрата плана calculate_flight_path."""
+    num_cells = int(flight_plan.cells.max()) + 1 if len(flight_plan) else 0
+    entry = np.zeros((num_cells, 2))
+    exit_ = np.zeros((num_cells, 2))
+    spray_length = np.zeros(num_cells)
+
+    to_legs = np.flatnonzero(flight_plan.leg_types == LEG_TO)
+    back_legs = np.flatnonzero(flight_plan.leg_types == LEG_BACK)
+    spray_legs = flight_plan.leg_types == LEG_SPRAY
+
+    entry[flight_plan.cells[to_legs]] = flight_plan.vertices[flight_plan.offsets[to_legs + 1] - 1]
+    exit_[flight_plan.cells[back_legs]] = flight_plan.vertices[flight_plan.offsets[back_legs]]
+    np.add.at(spray_length, flight_plan.cells[spray_legs], flight_plan.leg_lengths()[spray_legs])
+    return entry, exit_, spray_length
+
+
+def cell_transit_lengths(flight_plan):
+    """Длины подлета и возврата каждого квадрата по участкам плана (с учетом обхода зон)."""
+    num_cells = int(flight_plan.cells.max()) + 1 if len(flight_plan) else 0
+    to_cell = np.zeros(num_cells)
+    from_cell = np.zeros(num_cells)
+    leg_lengths = flight_plan.leg_lengths()
+    for lengths, leg_type in ((to_cell, LEG_TO), (from_cell, LEG_BACK)):
+        legs = flight_plan.leg_types == leg_type
+        lengths[flight_plan.cells[legs]] = leg_lengths[legs]
+    return to_cell, from_cell
+
+
+def cell_costs(flight_plan, speed, start_point=None, terrain=None, crs=None):
+    """Время и расход заряда (с) на подлет, обработку и возврат каждого квадрата.
+
+    Возвращает словарь пар (время, заряд) по ключам 'to', 'spray', 'back'.
+    Профиль рельефа (terrain) считается одним вызовом по всем отрезкам
+    плана, затем стоимости отрезков суммируются по участкам и квадратам.
+    Со своим start_point подлет и возврат - прямые отрезки.
+    """
+    num_cells = int(flight_plan.cells.max()) + 1 if len(flight_plan) else 0
+    per_leg_costs = leg_costs(flight_plan, speed, terrain, crs)
+
+    costs = {}
+    for key, leg_type in (('to', LEG_TO), ('spray', LEG_SPRAY), ('back', LEG_BACK)):
+        legs = flight_plan.leg_types == leg_type
+        pair = []
+        for per_leg in per_leg_costs:
+            per_cell = np.zeros(num_cells)
+            np.add.at(per_cell, flight_plan.cells[legs], per_leg[legs])
+            pair.append(per_cell)
+        costs[key] = tuple(pair)
+
+    if start_point is not None:
+        entry, exit_, _ = cell_entry_exit(flight_plan)
+        start = np.broadcast_to(np.asarray(start_point, dtype=float)[:2], entry.shape)
+        costs['to'] = flight_costs(np.hypot(*(entry - start).T),
+                                   *terrain_profile(start, entry, terrain, crs), speed)
+        costs['back'] = flight_costs(np.hypot(*(exit_ - start).T),
+                                     *terrain_profile(exit_, start, terrain, crs), speed)
+    return costs
+
+
+def leg_costs(flight_plan, speed, terrain=None, crs=None):
+    """Время и расход заряда (с) на каждый участок плана (пара массивов, см. terrain.flight_costs).
+
+    Профиль рельефа считается одним вызовом по всем отрезкам плана.
+    """
+    vertices = flight_plan.vertices
+    leg_of = np.repeat(np.arange(len(flight_plan)), np.diff(flight_plan.offsets))
+    # Отрезки внутри участков; стыки соседних участков не считаются
+    inner = np.flatnonzero(leg_of[1:] == leg_of[:-1])
+    lengths = np.hypot(*(vertices[inner + 1] - vertices[inner]).T)
+    ascent, descent = terrain_profile(vertices[inner], vertices[inner + 1], terrain, crs)
+    return tuple(np.bincount(leg_of[inner], weights=values, minlength=len(flight_plan))
+                 for values in flight_costs(lengths, ascent, descent, speed))
+
+
+@stage('schedule_sorties')
+def schedule_sorties(flight_plan, cell_areas, drone, start_point=None, cell_ids=None,
+                     terrain=None, crs=None):
+    """Группирует квадраты в вылеты, укладывающиеся в заряд батареи и бак дрона.
+
+    Вылет = подлет от старта + обработка квадратов + перелеты между ними +
+    возврат на старт; его время (при drone['speed']) не должно превышать
+    drone['flight_time'], а обработанная площадь - drone['efficiency'] га
+    на полный бак drone['tank_capacity'] л.
+
+    Эвристика "дальний квадрат + ближайший сосед": вылет начинается с самого
+    дальнего от старта неназначенного квадрата, затем добавляется ближайший
+    (по STRtree) квадрат, после которого дрон еще успевает вернуться.
+    Расстояния от старта до всех квадратов считаются заранее одним массивом.
+
+    Без start_point длины подлета и возврата берутся из участков плана
+    (то есть учитывают обход запретных зон); start_point задает другую
+    точку старта (расстояния по прямой), cell_ids - подмножество квадратов
+    (по умолчанию все квадраты плана).
+
+    terrain - ЦМР (terrain.ElevationModel), crs - система координат плана:
+    подъемы над рельефом удлиняют полет и расходуют заряд (см.
+    terrain.flight_costs). Заряд ограничивает вылет, время дает
+    длительность; на перелетах между соседними квадратами перепад высот
+    берется по их точкам входа и выхода.
+    """
+    entry, exit_, spray_length = cell_entry_exit(flight_plan)
+    start = flight_plan.start_point() if start_point is None else np.asarray(start_point, dtype=float)[:2]
+    areas = np.asarray(cell_areas, dtype=float) / 10000  # в гектарах
+    num_cells = len(entry)
+
+    speed = drone['speed']
+    time_budget = drone['flight_time'] * 60
+    liters_per_ha = drone['tank_capacity'] / drone['efficiency']
+    solution = areas[:num_cells] * liters_per_ha
+
+    if start_point is None:
+        to_cell, from_cell = cell_transit_lengths(flight_plan)
+    else:
+        to_cell = np.hypot(*(entry - start).T)
+        from_cell = np.hypot(*(exit_ - start).T)
+    costs = cell_costs(flight_plan, speed, start_point, terrain, crs)
+    (to_time, to_energy), (spray_time, spray_energy), (from_time, from_energy) = (
+        costs['to'], costs['spray'], costs['back'])
+    entry_height = exit_height = np.zeros(num_cells)
+    if terrain is not None:
+        entry_height, exit_height = terrain.sample(entry, crs), terrain.sample(exit_, crs)
+
+    search_radius = max(np.sqrt(np.median(areas)) * 100 * 1.5, 1.0) if num_cells else 1.0
+
+    remaining = np.ones(num_cells, dtype=bool)
+    if cell_ids is not None:
+        remaining[:] = False
+        remaining[np.asarray(cell_ids, dtype=np.int64)] = True
+    # Дерево только по распределяемым квадратам (при replan их немного)
+    pool = np.flatnonzero(remaining)
+    tree = STRtree(shapely.points(entry[pool]))
+    cells, offsets, durations, distances, used, feasible = [], [0], [], [], [], []
+
+    seeds = np.argsort(-to_cell, kind='stable')
+    for seed in seeds[remaining[seeds]]:
+        if not remaining[seed]:
+            continue
+        remaining[seed] = False
+        sortie = [seed]
+        elapsed = to_time[seed] + spray_time[seed]
+        energy = to_energy[seed] + spray_energy[seed]
+        distance = to_cell[seed] + spray_length[seed]
+        tank = solution[seed]
+        position, height = exit_[seed], exit_height[seed]
+        ok = energy + from_energy[seed] <= time_budget and tank <= drone['tank_capacity']
+
+        while ok:
+            # Заряд на метр не меньше 1 / speed, так что дальше reach перелет не поместится
+            reach = (time_budget - energy) * speed
+            candidates = _nearby(tree, pool, position, search_radius, reach, remaining)
+            if not candidates.size:
+                break
+            hop = np.hypot(*(entry[candidates] - position).T)
+            if terrain is None:
+                hop_time = hop_energy = hop / speed
+            else:
+                climb = np.nan_to_num(entry_height[candidates] - height)
+                hop_time, hop_energy = flight_costs(hop, np.maximum(climb, 0), np.maximum(-climb, 0), speed)
+            fits = ((energy + hop_energy + spray_energy[candidates] + from_energy[candidates] <= time_budget)
+                    & (tank + solution[candidates] <= drone['tank_capacity']))
+            if not fits.any():
+                break
+            best = np.flatnonzero(fits)[np.argmin(hop[fits])]
+            cell = candidates[best]
+            remaining[cell] = False
+            sortie.append(cell)
+            elapsed += hop_time[best] + spray_time[cell]
+            energy += hop_energy[best] + spray_energy[cell]
+            distance += hop[best] + spray_length[cell]
+            tank += solution[cell]
+            position, height = exit_[cell], exit_height[cell]
+
+        last = sortie[-1]
+        cells.extend(sortie)
+        offsets.append(len(cells))
+        durations.append(elapsed + from_time[last])
+        distances.append(distance + from_cell[last])
+        used.append(tank)
+        feasible.append(ok)
+
+    count('sorties', len(feasible))
+    if not all(feasible):
+        print(f"Квадратов, недоступных за один вылет: {len(feasible) - sum(feasible)}")
+
+    return SortiePlan(cells, offsets, durations, distances, used, feasible)
+
+
+def _cell_legs(flight_plan, leg_type):
+    """Номер участка типа leg_type для каждого квадрата: {квадрат: участок}."""
+    legs = np.flatnonzero(flight_plan.leg_types == leg_type)
+    return dict(zip(flight_plan.cells[legs].tolist(), legs.tolist()))
+
+
+def _nearby(tree, pool, position, radius, max_radius, remaining):
+    """Неназначенные квадраты вблизи position; радиус поиска удваивается до max_radius.
+
+    tree - STRtree точек входа квадратов pool.
+    """
+    while True:
+        radius = min(radius, max_radius)
+        found = pool[tree.query(shapely.box(position[0] - radius, position[1] - radius,
+                                            position[0] + radius, position[1] + radius))]
+        found = found[remaining[found]]
+        if found.size or radius >= max_radius:
+            return found
+        radius *= 2
@@ -0,0 +1,168 @@
+import os
+import zipfile
+from xml.sax.saxutils import escape
+
+import numpy as np
+import pandas as pd
+from fields import convert_from_utm
+from flight_plan import LEG_TYPE_NAMES, as_flight_plan
+from time_class import count, stage
+
+# Форматы таблиц по расширению файла
+TABLE_FORMATS = {
+    '.csv': 'csv',
+    '.parquet': 'parquet',
+    '.xlsx': 'excel',
+}
+# Строк на листе Excel (вместе с заголовком) и строк листа, формируемых за раз
+EXCEL_MAX_ROWS = 1_048_576
+EXCEL_CHUNK_ROWS = 100_000
+
+# Служебные части книги .xlsx из одного листа (без стилей и общих строк)
+_XLSX_PARTS = {
+    '[Content_Types].xml':
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+        '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+        '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+        '<Default Extension="xml" ContentType="application/xml"/>'
+        '<Override PartName="/xl/workbook.xml" '
+        'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+        '<Override PartName="/xl/worksheets/sheet1.xml" '
+        'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+        '</Types>',
+    '_rels/.rels':
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Target="xl/workbook.xml" Type='
+        '"http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument"/>'
+        '</Relationships>',
+    'xl/workbook.xml':
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+        '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+        'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+        '<sheets><sheet name="Sheet1" sheetId="1" r:id="rId1"/></sheets></workbook>',
+    'xl/_rels/workbook.xml.rels':
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Target="worksheets/sheet1.xml" Type='
+        '"http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet"/>'
+        '</Relationships>',
+}
+
+
+def flight_paths_to_dataframe(flight_paths, utm_crs=None):
+    """Таблица вершин маршрутов: по строке на вершину, столбцы строятся прямо из массивов плана.
+
+    Если задана зона utm_crs, добавляются столбцы lon/lat (один векторный вызов).
+    """
+    plan = as_flight_plan(flight_paths)
+    leg_lengths = np.diff(plan.offsets)
+
+    columns = {
+        'type': pd.Categorical.from_codes(plan.vertex_leg_types(), categories=LEG_TYPE_NAMES),
+        'cell': np.repeat(plan.cells, leg_lengths),
+        'leg': np.repeat(np.arange(len(plan), dtype=np.int64), leg_lengths),
+        'x': plan.vertices[:, 0],
+        'y': plan.vertices[:, 1],
+    }
+    if utm_crs is not None:
+        columns['lon'], columns['lat'] = convert_from_utm(plan.vertices[:, 0], plan.vertices[:, 1], utm_crs)
+
+    return pd.DataFrame(columns)
+
+
+@stage('export_table')
+def save_flight_paths_to_table(flight_paths, output_path, utm_crs=None, fmt=None):
+    """Сохраняет маршруты полета в таблицу CSV, Parquet или Excel.
+
+    Формат задается fmt ('csv', 'parquet', 'excel') или расширением файла.
+    CSV и Parquet предназначены для конвейеров обработки, Excel - для оператора.
+    """
+    if fmt is None:
+        fmt = TABLE_FORMATS.get(os.path.splitext(output_path)[1].lower())
+    if fmt not in TABLE_FORMATS.values():
+        raise ValueError(f"Неизвестный формат таблицы для {output_path}: {fmt}")
+
+    df = flight_paths_to_dataframe(flight_paths, utm_crs)
+    count('rows_exported', len(df))
+
+    if fmt == 'csv':
+        _write_csv(df, output_path)
+    elif fmt == 'parquet':
+        df.to_parquet(output_path, index=False)
+    else:
+        _write_excel(df, output_path)
+
+    print("Сгенерированные маршруты полета сохранены в:", output_path)
+
+
+def save_flight_paths_to_excel(flight_paths, output_path, utm_crs=None):
+    """Сохраняет маршруты полета в Excel файл (по строке на вершину маршрута)."""
+    save_flight_paths_to_table(flight_paths, output_path, utm_crs, fmt='excel')
+
+
+def _write_csv(df, output_path):
+    """Пишет CSV через pyarrow, если он установлен, иначе средствами pandas."""
+    try:
+        import pyarrow as pa
+        import pyarrow.csv as pa_csv
+    except ImportError:
+        df.to_csv(output_path, index=False)
+        return
+    pa_csv.write_csv(pa.Table.from_pandas(df, preserve_index=False), output_path)
+
+
+def _write_excel(df, output_path):
+    """Пишет .xlsx, собирая XML листа прямо из столбцов через pyarrow, иначе средствами pandas.
+
+    Текст ячеек всех строк порции (EXCEL_CHUNK_ROWS строк) формируется
+    векторно (pyarrow.compute: число в строку и склейка по элементам) и
+    сразу сжимается в архив книги, без объекта на ячейку, поэтому память не
+    растет с размером таблицы. Строки ячеек встроенные (inlineStr),
+    NaN и бесконечности - пустые ячейки.
+    """
+    try:
+        import pyarrow as pa
+        import pyarrow.compute as pc
+    except ImportError:
+        df.to_excel(output_path, index=False)
+        return
+    if len(df) >= EXCEL_MAX_ROWS:
+        raise ValueError(f"На лист Excel помещается {EXCEL_MAX_ROWS - 1} строк, а в таблице {len(df)}: "
+                         "сохраните CSV или Parquet")
+
+    with zipfile.ZipFile(output_path, 'w', zipfile.ZIP_DEFLATED, compresslevel=1) as archive:
+        for name, content in _XLSX_PARTS.items():
+            archive.writestr(name, content)
+        with archive.open('xl/worksheets/sheet1.xml', 'w') as sheet:
+            header = ''.join(_inline_cell(name) for name in df.columns)
+            sheet.write(('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+                         '<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+                         f'<sheetData><row>{header}</row>').encode('utf-8'))
+            for first in range(0, len(df), EXCEL_CHUNK_ROWS):
+                chunk = df.iloc[first:first + EXCEL_CHUNK_ROWS]
+                rows = pc.binary_join_element_wise(
+                    '<row>', *(_excel_cells(chunk[name], pa, pc) for name in chunk.columns), '</row>', '')
+                # Тексты всех строк порции лежат в буфере данных массива подряд
+                offsets = np.frombuffer(rows.buffers()[1], dtype=np.int32)[rows.offset:rows.offset + len(rows) + 1]
+                sheet.write(memoryview(rows.buffers()[2])[offsets[0]:offsets[-1]])
+            sheet.write(b'</sheetData></worksheet>')
+
+
+def _excel_cells(column, pa, pc):
+    """XML ячеек столбца (массив строк pyarrow): числа - значения, остальное - встроенные строки."""
+    if isinstance(column.dtype, pd.CategoricalDtype):
+        cells = pa.array([_inline_cell(value) for value in column.cat.categories] + ['<c/>'])
+        codes = column.cat.codes.to_numpy()
+        return cells.take(pa.array(np.where(codes < 0, len(column.cat.categories), codes)))
+    values = column.to_numpy()
+    if values.dtype.kind not in 'iuf':
+        return pa.array([_inline_cell(value) for value in column.astype(str)])
+    cells = pc.binary_join_element_wise('<c><v>', pc.cast(pa.array(values), pa.string()), '</v></c>', '')
+    if values.dtype.kind == 'f' and not np.isfinite(values).all():
+        cells = pc.if_else(pa.array(np.isfinite(values)), cells, '<c/>')
+    return cells
+
+
+def _inline_cell(value):
+    return f'<c t="inlineStr"><is><t>{escape(str(value))}</t></is></c>'
@@ -0,0 +1,222 @@
+import json
+import os
+
+import numpy as np
+from fields import transform_coords
+
+# Вертикальные скорости дрона при следовании рельефу, м/с
+CLIMB_RATE = 3.0
+DESCENT_RATE = 2.0
+# Дополнительный расход батареи на набор высоты, секунд полета на метр подъема
+CLIMB_ENERGY = 0.5
+
+
+class ElevationModel:
+    """Цифровая модель рельефа (ЦМР): растр высот с геопривязкой.
+
+    data - двумерный массив высот (м), обычно np.memmap или окно растра,
+    строка 0 - север. origin - координаты левого верхнего угла растра,
+    resolution - размер ячейки в единицах crs. Ячейки со значением nodata
+    и точки вне растра дают NaN.
+    """
+
+    __slots__ = ('data', 'origin', 'resolution', 'crs', 'nodata')
+
+    def __init__(self, data, origin, resolution, crs=None, nodata=None):
+        self.data = data
+        self.origin = np.asarray(origin, dtype=float)
+        self.resolution = float(resolution)
+        self.crs = crs
+        self.nodata = nodata
+
+    @property
+    def bounds(self):
+        """Границы растра (minx, miny, maxx, maxy)."""
+        rows, cols = self.data.shape
+        x0, y0 = self.origin
+        return x0, y0 - rows * self.resolution, x0 + cols * self.resolution, y0
+
+    def window(self, bounds, margin=1):
+        """Окно растра, покрывающее bounds (плюс margin ячеек), без чтения данных.
+
+        Для np.memmap окно - тоже отображение файла: при выборке высот с
+        диска читаются только страницы под нужными ячейками.
+        """
+        minx, miny, maxx, maxy = bounds
+        rows, cols = self.data.shape
+        x0, y0 = self.origin
+        first_col = max(int(np.floor((minx - x0) / self.resolution)) - margin, 0)
+        last_col = min(int(np.ceil((maxx - x0) / self.resolution)) + margin, cols)
+        first_row = max(int(np.floor((y0 - maxy) / self.resolution)) - margin, 0)
+        last_row = min(int(np.ceil((y0 - miny) / self.resolution)) + margin, rows)
+        return ElevationModel(self.data[first_row:last_row, first_col:last_col],
+                              (x0 + first_col * self.resolution, y0 - first_row * self.resolution),
+                              self.resolution, self.crs, self.nodata)
+
+    def sample(self, points, crs=None):
+        """Высоты в точках (n, 2) билинейной интерполяцией, одним векторным обращением к растру.
+
+        crs - система координат точек, если она отличается от системы ЦМР.
+        """
+        points = np.asarray(points, dtype=float).reshape(-1, 2)
+        x, y = points[:, 0], points[:, 1]
+        if crs is not None and self.crs is not None and crs != self.crs:
+            x, y = transform_coords(x, y, crs, self.crs)
+
+        rows, cols = self.data.shape
+        elevation = np.full(len(points), np.nan)
+        if rows < 2 or cols < 2:
+            return elevation
+        # Координаты относительно центров ячеек
+        col = (x - self.origin[0]) / self.resolution - 0.5
+        row = (self.origin[1] - y) / self.resolution - 0.5
+        inside = (col >= -0.5) & (col <= cols - 0.5) & (row >= -0.5) & (row <= rows - 0.5)
+        col, row = np.clip(col[inside], 0, cols - 1), np.clip(row[inside], 0, rows - 1)
+        c0 = np.minimum(col.astype(np.int64), cols - 2)
+        r0 = np.minimum(row.astype(np.int64), rows - 2)
+        fc, fr = col - c0, row - r0
+
+        corners = np.asarray(self.data[np.stack((r0, r0, r0 + 1, r0 + 1)),
+                                       np.stack((c0, c0 + 1, c0, c0 + 1))], dtype=float)
+        if self.nodata is not None:
+            corners[corners == self.nodata] = np.nan
+        weights = np.stack(((1 - fc) * (1 - fr), fc * (1 - fr), (1 - fc) * fr, fc * fr))
+        elevation[inside] = (corners * weights).sum(axis=0)
+        return elevation
+
+
+def open_dem(path, bounds=None, crs=None):
+    """Открывает ЦМР; при заданных bounds возвращается только окно под ними.
+
+    .npy (с описанием геопривязки в файле <имя>.json, см. save_dem)
+    открывается через np.load(mmap_mode='r'), поэтому в память попадают
+    только прочитанные ячейки. GeoTIFF читается окном через rasterio (если
+    он установлен). crs - система координат bounds. Возвращает None, если
+    файл не удалось прочитать.
+    """
+    try:
+        if path.endswith('.npy'):
+            with open(os.path.splitext(path)[0] + '.json') as f:
+                meta = json.load(f)
+            dem = ElevationModel(np.load(path, mmap_mode='r'), meta['origin'], meta['resolution'],
+                                 meta.get('crs'), meta.get('nodata'))
+            return dem if bounds is None else dem.window(_bounds_in(bounds, crs, dem.crs))
+        return _open_geotiff(path, bounds, crs)
+
+    except (FileNotFoundError, KeyError, ValueError) as e:
+        print(f"Ошибка при загрузке ЦМР: {e}")
+        return None
+
+
+def save_dem(path, data, origin, resolution, crs=None, nodata=None):
+    """Сохраняет растр высот в .npy и геопривязку в <имя>.json для open_dem."""
+    np.save(path, np.asarray(data, dtype=np.float32))
+    with open(os.path.splitext(path)[0] + '.json', 'w') as f:
+        json.dump({'origin': [float(v) for v in origin], 'resolution': float(resolution),
+                   'crs': crs, 'nodata': nodata}, f)
+
+
+def terrain_profile(origins, targets, dem, crs=None, step=None):
+    """Набор и потеря высоты (м) на отрезках origins[i] -> targets[i] при полете над рельефом.
+
+    Каждый отрезок разбивается на участки не длиннее step (по умолчанию -
+    размер ячейки ЦМР), высоты всех промежуточных точек всех отрезков
+    выбираются одним вызовом sample. Возвращает (подъем, спуск) по отрезку;
+    вне ЦМР (и в ячейках nodata) высота держится по ближайшей известной
+    точке того же отрезка, то есть рельеф там ровный.
+    """
+    origins = np.asarray(origins, dtype=float).reshape(-1, 2)
+    targets = np.asarray(targets, dtype=float).reshape(-1, 2)
+    if dem is None or not len(origins):
+        return np.zeros(len(origins)), np.zeros(len(origins))
+    step = dem.resolution if step is None else step
+
+    lengths = np.hypot(*(targets - origins).T)
+    pieces = np.maximum(np.ceil(lengths / step).astype(np.int64), 1)
+    # Точки профиля отрезка: начало и pieces точек до конца включительно
+    counts = pieces + 1
+    starts = np.cumsum(counts) - counts
+    fraction = (np.arange(counts.sum()) - np.repeat(starts, counts)) / np.repeat(pieces, counts)
+    segment = np.repeat(np.arange(len(origins)), counts)
+    points = origins[segment] + (targets - origins)[segment] * fraction[:, None]
+
+    elevation = _fill_missing(dem.sample(points, crs), segment)
+    change = np.diff(elevation)
+    # Разности между последней точкой отрезка и первой точкой следующего не считаются
+    change[starts[1:] - 1] = 0.0
+    ascent = np.add.reduceat(np.maximum(change, 0), starts) if len(change) else np.zeros(len(origins))
+    descent = np.add.reduceat(np.maximum(-change, 0), starts) if len(change) else np.zeros(len(origins))
+    return ascent, descent
+
+
+def flight_costs(lengths, ascent, descent, speed,
+                 climb_rate=CLIMB_RATE, descent_rate=DESCENT_RATE, climb_energy=CLIMB_ENERGY):
+    """Время (с) и расход батареи (секунд полета) на отрезки с учетом рельефа.
+
+    Дрон идет над рельефом на постоянной высоте: отрезок не короче, чем
+    позволяют вертикальные скорости, а подъем дополнительно расходует
+    climb_energy секунд батареи на метр. Без рельефа оба значения равны
+    lengths / speed.
+    """
+    time = np.maximum(np.asarray(lengths, dtype=float) / speed,
+                      np.asarray(ascent) / climb_rate + np.asarray(descent) / descent_rate)
+    return time, time + climb_energy * np.asarray(ascent)
+
+
+def _bounds_in(bounds, crs, dem_crs):
+    """Переводит bounds в систему координат ЦМР (по четырем углам)."""
+    if crs is None or dem_crs is None or crs == dem_crs:
+        return bounds
+    minx, miny, maxx, maxy = bounds
+    x, y = transform_coords([minx, maxx, maxx, minx], [miny, miny, maxy, maxy], crs, dem_crs)
+    return min(x), min(y), max(x), max(y)
+
+
+def _open_geotiff(path, bounds, crs):
+    """Читает GeoTIFF через rasterio: только окно под bounds."""
+    try:
+        import rasterio
+        from rasterio.windows import from_bounds
+    except ImportError:
+        print("Для чтения GeoTIFF нужен rasterio; ЦМР можно сохранить в .npy через save_dem")
+        return None
+
+    with rasterio.open(path) as src:
+        dem_crs = src.crs.to_string() if src.crs else None
+        window = None
+        if bounds is not None:
+            minx, miny, maxx, maxy = _bounds_in(bounds, crs, dem_crs)
+            pad = abs(src.res[0])
+            window = from_bounds(minx - pad, miny - pad, maxx + pad, maxy + pad, src.transform)
+            window = window.round_offsets().round_lengths().intersection(
+                rasterio.windows.Window(0, 0, src.width, src.height))
+        data = src.read(1, window=window)
+        transform = src.window_transform(window) if window is not None else src.transform
+        return ElevationModel(data, (transform.c, transform.f), transform.a, dem_crs, src.nodata)
+
+
+def _fill_missing(elevation, segment):
+    """Заменяет NaN (вне ЦМР или nodata) ближайшей известной высотой того же отрезка.
+
+    segment - номер отрезка каждой точки (точки отрезка идут подряд).
+    Высоты соседних отрезков не используются, поэтому часть отрезка вне
+    ЦМР ровная, а отрезок целиком вне ЦМР не дает ни подъема, ни спуска.
+    """
+    known = np.isfinite(elevation)
+    if known.all():
+        return elevation
+    index = np.arange(len(elevation))
+    # Ближайшие известные точки слева и справа; чужой отрезок не считается
+    before = np.maximum.accumulate(np.where(known, index, -1))
+    after = np.minimum.accumulate(np.where(known, index, len(elevation))[::-1])[::-1]
+    has_before = before >= 0
+    has_before[has_before] = segment[before[has_before]] == segment[has_before]
+    has_after = after < len(elevation)
+    has_after[has_after] = segment[after[has_after]] == segment[has_after]
+
+    use_after = has_after & (~has_before | (after - index < index - before))
+    nearest = np.where(use_after, after, before)
+    filled = np.zeros_like(elevation)
+    source = has_before | has_after
+    filled[source] = elevation[nearest[source]]
+    return filled
@@ -1,11 +1,263 @@
+import atexit
+import cProfile
+import json
+import os
+import pstats
+import sys
+import threading
 import time
+import tracemalloc
+from contextlib import ContextDecorator
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# Единица ru_maxrss в байтах: на macOS - байты, на Linux и BSD - килобайты
+RU_MAXRSS_UNIT = 1 if sys.platform == 'darwin' else 1024
+
+# Период опроса RSS процесса во время замера, с
+RSS_SAMPLE_INTERVAL = 0.01
+# Сколько функций профиля cProfile попадает в отчет
+PROFILE_TOP = 30
+
+# Текущий замер (PipelineRun), в который пишут timex, stage и count
+_current_run = None
+
+
+class timex(ContextDecorator):
+    """Замер времени блока кода.
+
+    Без активного PipelineRun просто печатает время работы блока. Внутри
+    PipelineRun блок с именем name становится этапом замера: этапы
+    вкладываются друг в друга по вложенности блоков, время, число вызовов и
+    пик памяти повторяющихся этапов суммируются. verbose=False отключает
+    печать (для этапов внутри модулей, см. stage). Работает и как
+    декоратор функции.
+    """
+
+    def __init__(self, name=None, verbose=True):
+        self.name = name
+        self.verbose = verbose
+
+    def _recreate_cm(self):
+        # Для декоратора: свой объект на каждый вызов функции
+        return timex(self.name, self.verbose)
 
-class timex:
     def __enter__(self):
         # Фиксация времени старта процесса
-        self.t = time.time()
+        self.t = time.perf_counter()
+        self.run = _current_run if self.name is not None else None
+        if self.run is not None:
+            self.run._enter(self.name)
         return self
 
     def __exit__(self, type, value, traceback):
+        elapsed = time.perf_counter() - self.t
+        if self.run is not None:
+            self.run._exit(elapsed)
         # Вывод времени работы
-        print('Время обработки: {:.2f} с'.format(time.time() - self.t))
\ No newline at end of file
+        if self.verbose:
+            label = f"{self.name}: " if self.name else ""
+            print('{}Время обработки: {:.2f} с'.format(label, elapsed))
+
+
+def stage(name):
+    """Этап текущего замера без печати: with stage(name): ... или @stage(name) у функции."""
+    return timex(name, verbose=False)
+
+
+def count(name, value=1):
+    """Прибавляет value к счетчику name текущего замера (без замера ничего не делает)."""
+    if _current_run is not None:
+        _current_run.counters[name] = _current_run.counters.get(name, 0) + value
+
+
+def current_run():
+    """Активный PipelineRun или None."""
+    return _current_run
+
+
+class PipelineRun:
+    """Замер одного запуска планирования: этапы, счетчики, память и профиль.
+
+    Используется как контекстный менеджер (или start/stop); пока замер
+    активен, timex(name), stage и count записывают данные в него. Пик
+    RSS каждого этапа получается опросом памяти процесса в фоновом потоке
+    раз в sample_interval с. trace_memory=True включает tracemalloc (пик
+    выделенной Python памяти по этапам), profile=True - cProfile на все
+    время замера. Результат - словарь to_dict() или JSON-файл save(path).
+    """
+
+    def __init__(self, name='run', profile=False, trace_memory=False,
+                 sample_interval=RSS_SAMPLE_INTERVAL, metadata=None):
+        self.name = name
+        self.metadata = dict(metadata or {})
+        self.counters = {}
+        self.stages = {}
+        self.seconds = 0.0
+        self.profile = cProfile.Profile() if profile else None
+        self.trace_memory = trace_memory
+        self.sample_interval = sample_interval
+        self.profile_stats = []
+        self._stack = []
+        self._peak_rss = 0
+        self._stop = threading.Event()
+        self._sampler = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, type, value, traceback):
+        self.stop()
+
+    def start(self):
+        """Начинает замер и делает его текущим."""
+        global _current_run
+        self._previous, _current_run = _current_run, self
+        self.started = time.time()
+        self._t = time.perf_counter()
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        else:
+            self.trace_memory = self.trace_memory and tracemalloc.is_tracing()
+        self._peak_rss = _current_rss()
+        if self._peak_rss is not None and self.sample_interval:
+            self._sampler = threading.Thread(target=self._sample, daemon=True)
+            self._sampler.start()
+        # Корневой этап - весь замер
+        self._enter(self.name)
+        if self.profile is not None:
+            self.profile.enable()
+        return self
+
+    def stop(self):
+        """Завершает замер (повторный вызов ничего не делает)."""
+        global _current_run
+        if not self._stack:
+            return self
+        while len(self._stack) > 1:
+            # Этапы, прерванные выходом из программы
+            self._exit(time.perf_counter() - self._stack[-1]['t'])
+        if self.profile is not None:
+            self.profile.disable()
+            self.profile_stats = _top_functions(self.profile)
+        self.seconds = time.perf_counter() - self._t
+        self._exit(self.seconds)
+        self._stop.set()
+        if self._sampler is not None:
+            self._sampler.join()
+        if self.trace_memory:
+            tracemalloc.stop()
+        _current_run = self._previous
+        return self
+
+    def save_at_exit(self, path):
+        """Завершает замер и сохраняет его в path при выходе из программы (в том числе по SystemExit)."""
+        atexit.register(lambda: self.stop().save(path))
+
+    def count(self, name, value=1):
+        """Прибавляет value к счетчику name."""
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def to_dict(self):
+        """Результаты замера словарем (все значения сериализуются в JSON)."""
+        stages = []
+        for path, record in self.stages.items():
+            stage_record = {'stage': path, 'depth': path.count('/'), 'calls': record['calls'],
+                            'seconds': round(record['seconds'], 6)}
+            if record['peak_rss'] is not None:
+                stage_record['peak_rss_mb'] = round(record['peak_rss'] / 2 ** 20, 2)
+            if self.trace_memory:
+                stage_record['peak_traced_mb'] = round(record['peak_traced'] / 2 ** 20, 2)
+            stages.append(stage_record)
+
+        result = {'name': self.name,
+                  'started': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.started)),
+                  'seconds': round(self.seconds, 6),
+                  'metadata': self.metadata,
+                  'counters': self.counters,
+                  'stages': stages}
+        if self.profile_stats:
+            result['profile'] = self.profile_stats
+        return result
+
+    def save(self, path):
+        """Сохраняет результаты замера в JSON (папка создается при необходимости)."""
+        folder = os.path.dirname(path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(self.to_dict(), f, ensure_ascii=False, indent=2)
+        print("Замер сохранен в файл:", path)
+
+    def _enter(self, name):
+        """Начало этапа: пики памяти родителя фиксируются, счетчики пиков сбрасываются."""
+        parent = self._stack[-1] if self._stack else None
+        path = f"{parent['path']}/{name}" if parent else name
+        if parent is not None:
+            parent['rss_acc'] = _max(parent['rss_acc'], self._peak_rss)
+            if self.trace_memory:
+                parent['traced_acc'] = max(parent['traced_acc'], tracemalloc.get_traced_memory()[1])
+        self._peak_rss = _current_rss()
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+        self._stack.append({'path': path, 't': time.perf_counter(), 'rss_acc': None, 'traced_acc': 0})
+
+    def _exit(self, elapsed):
+        """Конец этапа: время и пики памяти добавляются в запись этапа и родителю."""
+        frame = self._stack.pop()
+        peak_rss = _max(frame['rss_acc'], _max(self._peak_rss, _current_rss()))
+        peak_traced = max(frame['traced_acc'], tracemalloc.get_traced_memory()[1]) if self.trace_memory else 0
+
+        record = self.stages.setdefault(frame['path'], {'calls': 0, 'seconds': 0.0,
+                                                        'peak_rss': None, 'peak_traced': 0})
+        record['calls'] += 1
+        record['seconds'] += elapsed
+        record['peak_rss'] = _max(record['peak_rss'], peak_rss)
+        record['peak_traced'] = max(record['peak_traced'], peak_traced)
+
+        if self._stack:
+            parent = self._stack[-1]
+            parent['rss_acc'] = _max(parent['rss_acc'], peak_rss)
+            parent['traced_acc'] = max(parent['traced_acc'], peak_traced)
+        self._peak_rss = _current_rss()
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+
+    def _sample(self):
+        """Фоновый опрос RSS: запоминает максимум с начала текущего этапа."""
+        while not self._stop.wait(self.sample_interval):
+            self._peak_rss = _max(self._peak_rss, _current_rss())
+
+
+def _current_rss():
+    """Текущий RSS процесса в байтах (Linux - /proc, иначе пиковый ru_maxrss или None)."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        if resource is None:
+            return None
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * RU_MAXRSS_UNIT
+
+
+def _max(a, b):
+    """Максимум с учетом None (память не измеряется)."""
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return max(a, b)
+
+
+def _top_functions(profile, limit=PROFILE_TOP):
+    """Функции с наибольшим суммарным временем по профилю cProfile."""
+    stats = pstats.Stats(profile)
+    rows = sorted(stats.stats.items(), key=lambda item: item[1][3], reverse=True)[:limit]
+    return [{'function': f"{os.path.basename(filename)}:{line}({name})",
+             'calls': calls,
+             'own_seconds': round(own, 6),
+             'cumulative_seconds': round(cumulative, 6)}
+            for (filename, line, name), (_, calls, own, cumulative, _) in rows]
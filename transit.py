@@ -0,0 +1,703 @@
+import hashlib
+import heapq
+
+import numpy as np
+import shapely
+from shapely.geometry.polygon import orient
+from shapely.strtree import STRtree
+from flight_plan import FlightPlan, LEG_TO, LEG_BACK, LEG_HOP, _leg_vertex_index
+from time_class import count, stage
+
+# Отступ от запретных зон для транзитных перелетов, м
+ZONE_CLEARANCE = 10.0
+# Сжатие препятствий: отрезки по границе раздутой зоны и через ее вершины не считаются пересечением
+BOUNDARY_TOLERANCE = 1e-6
+# Число отрезков, проверяемых за один запрос к STRtree при построении графа
+EDGE_CHUNK_SIZE = 200000
+# Число узлов-кандидатов, проверяемых на видимость за один запрос при поиске пути
+VISIBILITY_BATCH = 16
+# Решетка заранее найденных путей (PathTree.precompute): шаг, м, и предельное число точек
+LOOKUP_SPACING = 25.0
+LOOKUP_MAX_POINTS = 10000
+# Размер матрицы "точки x узлы" в одном пакете при поиске первых узлов путей
+LOOKUP_CHUNK_ELEMENTS = 2000000
+# Сколько лучших узлов-кандидатов упорядочивается для каждой точки сразу
+LOOKUP_CANDIDATES = 32
+# Сколько графов видимости (наборов зон) хранится в кэше процесса
+GRAPH_CACHE_SIZE = 8
+# Наибольшее число добавленных и удаленных зон, при котором граф из кэша обновляется, а не строится заново
+GRAPH_UPDATE_MAX_ZONES = 32
+
+# Графы видимости по ключу набора зон и отступа (get_visibility_graph)
+_graph_cache = {}
+
+
+def get_visibility_graph(zones, clearance=ZONE_CLEARANCE):
+    """Граф видимости для набора зон: строится один раз и берется из кэша процесса.
+
+    Ключ - множество хэшей WKB нормализованных зон и отступ, поэтому
+    одинаковые зоны, загруженные заново, находят готовый граф вместе с уже
+    посчитанными деревьями кратчайших путей. Если в кэше есть граф для
+    набора, отличающегося не больше чем на GRAPH_UPDATE_MAX_ZONES зон,
+    новый граф получается его обновлением (VisibilityGraph.updated) без
+    полного перебора пар узлов.
+    """
+    zones = np.asarray(list(zones), dtype=object)
+    key = (frozenset(_zone_keys(zones)), float(clearance))
+    if key not in _graph_cache:
+        base, changes = None, GRAPH_UPDATE_MAX_ZONES + 1
+        for (zone_keys, cached_clearance), graph in _graph_cache.items():
+            difference = len(zone_keys ^ key[0])
+            if cached_clearance == key[1] and difference < min(changes, max(len(key[0]), 1)):
+                base, changes = graph, difference
+        if len(_graph_cache) >= GRAPH_CACHE_SIZE:
+            del _graph_cache[next(iter(_graph_cache))]
+        _graph_cache[key] = base.updated(zones) if base is not None else VisibilityGraph(zones, clearance)
+    return _graph_cache[key]
+
+
+class VisibilityGraph:
+    """Граф видимости вершин раздутых запретных зон.
+
+    Зоны раздуваются на clearance и объединяются; узлы графа - выпуклые
+    вершины внешних границ и вершины отверстий (только через них проходят
+    кратчайшие пути в обход многоугольников). Ребро соединяет два узла,
+    если отрезок между ними касателен к препятствиям в обоих узлах (иначе
+    кратчайший путь через него не проходит) и не заходит внутрь ни одной
+    раздутой зоны.
+    Смежность хранится массивами в стиле CSR: соседи узла i - neighbors[
+    offsets[i]:offsets[i + 1]], длины ребер - weights.
+
+    Для обновления графа (updated) хранятся раздутые части зон (parts) с
+    ключами их зон (part_keys) и номерами препятствий (part_obstacle), а
+    для узлов - соседние вершины контура (ring_neighbors) и номер
+    препятствия (node_obstacle).
+    """
+
+    __slots__ = ('clearance', 'parts', 'part_keys', 'part_obstacle', 'obstacles', 'blockers', 'corners', 'tree',
+                 'nodes', 'ring_neighbors', 'node_obstacle', 'offsets', 'neighbors', 'weights', 'trees')
+
+    def __init__(self, zones, clearance=ZONE_CLEARANCE):
+        self.clearance = clearance
+        self.trees = {}
+        zones = np.asarray([zone for zone in np.asarray(list(zones), dtype=object)
+                            if zone is not None and not zone.is_empty], dtype=object)
+        self.parts, self.part_keys = _inflate(zones, _zone_keys(zones), clearance)
+        obstacles = _merge(self.parts)
+        self.part_obstacle = _locate(self.parts, obstacles)
+        self._set_obstacles(obstacles)
+        self.nodes, self.ring_neighbors, self.node_obstacle = _obstacle_nodes(self.obstacles)
+
+        firsts, seconds = [np.empty(0, dtype=np.int64)], [np.empty(0, dtype=np.int64)]
+        # Пары перебираются блоками не больше EDGE_CHUNK_SIZE, поэтому память
+        # не растет квадратично с числом узлов
+        for first, second in _node_pairs(len(self.nodes), EDGE_CHUNK_SIZE):
+            first, second = self._edges_among(first, second)
+            firsts.append(first)
+            seconds.append(second)
+        self._set_edges(np.concatenate(firsts), np.concatenate(seconds))
+
+    def updated(self, zones):
+        """Граф для нового набора зон, полученный обновлением этого (сам граф не меняется).
+
+        Заново объединяются только препятствия, которых касаются добавленные
+        и удаленные зоны; их узлы заменяются узлами новых препятствий.
+        Сохраненные ребра проверяются только против новых препятствий,
+        новые ребра ищутся только от новых узлов, а пары старых узлов, чей
+        отрезок проходил через освободившуюся площадь удаленных зон,
+        проверяются заново. Результат совпадает с полным построением.
+        """
+        zones = np.asarray([zone for zone in np.asarray(list(zones), dtype=object)
+                            if zone is not None and not zone.is_empty], dtype=object)
+        keys = _zone_keys(zones)
+        old_keys = set(self.part_keys.tolist())
+        new = np.asarray([key not in old_keys for key in keys], dtype=bool)
+        added, added_keys = _inflate(zones[new], np.asarray(keys, dtype=object)[new], self.clearance)
+        removed = ~np.isin(self.part_keys, np.asarray(keys, dtype=object))
+
+        # Затронутые препятствия: с удаленными частями и пересекающие добавленные
+        affected = np.zeros(len(self.obstacles), dtype=bool)
+        affected[self.part_obstacle[removed]] = True
+        if len(added) and len(self.obstacles):
+            affected[STRtree(self.obstacles).query(added, predicate='intersects')[1]] = True
+
+        local = ~removed & affected[self.part_obstacle]
+        local_parts = np.concatenate((self.parts[local], added))
+        local_obstacles = _merge(local_parts)
+
+        graph = VisibilityGraph.__new__(VisibilityGraph)
+        graph.clearance = self.clearance
+        graph.trees = {}
+        kept_obstacles = np.flatnonzero(~affected)
+        renumber = np.full(len(self.obstacles), -1, dtype=np.int64)
+        renumber[kept_obstacles] = np.arange(len(kept_obstacles))
+        kept_parts = ~removed & ~affected[self.part_obstacle]
+        graph.parts = np.concatenate((self.parts[kept_parts], local_parts))
+        graph.part_keys = np.concatenate((self.part_keys[kept_parts], self.part_keys[local], added_keys))
+        graph.part_obstacle = np.concatenate((renumber[self.part_obstacle[kept_parts]],
+                                              len(kept_obstacles) + _locate(local_parts, local_obstacles)))
+        graph._set_obstacles(np.concatenate((self.obstacles[kept_obstacles], local_obstacles)))
+
+        # Узлы: сохраненные (в прежнем порядке), затем узлы новых препятствий
+        kept_nodes = np.flatnonzero(~affected[self.node_obstacle])
+        node_index = np.full(len(self.nodes), -1, dtype=np.int64)
+        node_index[kept_nodes] = np.arange(len(kept_nodes))
+        nodes, ring_neighbors, node_obstacle = _obstacle_nodes(local_obstacles)
+        graph.nodes = np.concatenate((self.nodes[kept_nodes], nodes))
+        graph.ring_neighbors = np.concatenate((self.ring_neighbors[kept_nodes], ring_neighbors))
+        graph.node_obstacle = np.concatenate((renumber[self.node_obstacle[kept_nodes]],
+                                              len(kept_obstacles) + node_obstacle))
+
+        # Сохраненные ребра между сохраненными узлами: мешать им могут только новые препятствия
+        source = np.repeat(np.arange(len(self.nodes)), np.diff(self.offsets))
+        once = source < self.neighbors
+        first, second = node_index[source[once]], node_index[self.neighbors[once]]
+        both = (first >= 0) & (second >= 0)
+        first, second = first[both], second[both]
+        if len(added) and len(local_obstacles) and len(first):
+            blockers = graph.blockers[len(kept_obstacles):]
+            blocked = segments_crossing(STRtree(blockers), blockers, graph.corners[len(kept_obstacles):],
+                                        graph.nodes[first], graph.nodes[second])
+            keep = np.ones(len(first), dtype=bool)
+            keep[blocked] = False
+            first, second = first[keep], second[keep]
+        firsts, seconds = [first], [second]
+
+        # Пары с новыми узлами: каждый новый узел со всеми узлами перед ним
+        new_nodes = np.arange(len(kept_nodes), len(graph.nodes))
+        rows_per_chunk = max(EDGE_CHUNK_SIZE // max(len(graph.nodes), 1), 1)
+        for start in range(0, len(new_nodes), rows_per_chunk):
+            rows = new_nodes[start:start + rows_per_chunk]
+            first, second = graph._edges_among(np.repeat(rows, rows), _ranges(rows))
+            firsts.append(first)
+            seconds.append(second)
+
+        # Пары сохраненных узлов через освободившуюся площадь: раньше их закрывали удаленные зоны
+        # (только добавленные зоны площадь не освобождают)
+        if removed.any() and len(kept_nodes):
+            freed = shapely.union_all(self.blockers[affected])
+            if len(local_obstacles):
+                freed = shapely.difference(freed, shapely.union_all(graph.blockers[len(kept_obstacles):]))
+            # Щели порядка BOUNDARY_TOLERANCE от повторного объединения не в счет
+            freed = shapely.get_parts(freed)
+            freed = freed[shapely.area(freed) > self.clearance * BOUNDARY_TOLERANCE * 1000]
+            if len(freed):
+                first, second = _pairs_through(freed, graph.nodes[:len(kept_nodes)])
+                fresh = ~np.isin(first * len(graph.nodes) + second, firsts[0] * len(graph.nodes) + seconds[0])
+                first, second = graph._edges_among(first[fresh], second[fresh])
+                firsts.append(first)
+                seconds.append(second)
+
+        graph._set_edges(np.concatenate(firsts), np.concatenate(seconds))
+        return graph
+
+    def _set_obstacles(self, obstacles):
+        """Препятствия и индекс для проверки видимости.
+
+        Препятствия для проверки чуть меньше раздутых зон и подготовлены
+        один раз: STRtree отбирает кандидатов по рамкам, точная проверка идет
+        по подготовленным геометриям.
+        """
+        self.obstacles = np.asarray(obstacles, dtype=object)
+        self.blockers = shapely.buffer(self.obstacles, -BOUNDARY_TOLERANCE, join_style='mitre')
+        shapely.prepare(self.blockers)
+        self.tree = STRtree(self.blockers)
+        self.corners = _bbox_corners(self.blockers)
+
+    def _edges_among(self, first, second):
+        """Из пар узлов оставляет ребра: касательные в обоих узлах и не заходящие в зоны."""
+        tangent = (_tangent(self.nodes[first], self.nodes[second], self.ring_neighbors[first])
+                   & _tangent(self.nodes[second], self.nodes[first], self.ring_neighbors[second]))
+        first, second = first[tangent], second[tangent]
+        keep = self.visible(self.nodes[first], self.nodes[second])
+        return first[keep], second[keep]
+
+    def _set_edges(self, first, second):
+        """Смежность CSR по парам ребер: каждое ребро хранится в обе стороны, отсортировано по узлу."""
+        source = np.concatenate((first, second))
+        target = np.concatenate((second, first))
+        order = np.argsort(source, kind='stable')
+        self.neighbors = target[order]
+        self.weights = np.hypot(*(self.nodes[source[order]] - self.nodes[self.neighbors]).T)
+        self.offsets = np.concatenate(([0], np.cumsum(np.bincount(source, minlength=len(self.nodes)))))
+
+    def visible(self, origins, targets):
+        """Для пар точек (массивы (n, 2)) возвращает маску: отрезок не заходит в запретную зону."""
+        origins = np.broadcast_to(np.asarray(origins, dtype=float), np.shape(targets))
+        targets = np.asarray(targets, dtype=float)
+        mask = np.ones(len(targets), dtype=bool)
+        if not len(targets) or not len(self.obstacles):
+            return mask
+        mask[segments_crossing(self.tree, self.blockers, self.corners, origins, targets)] = False
+        return mask
+
+    def blocked(self, points):
+        """Маска точек, лежащих внутри раздутых запретных зон."""
+        points = np.asarray(points, dtype=float).reshape(-1, 2)
+        mask = np.zeros(len(points), dtype=bool)
+        if len(self.obstacles):
+            geometries = shapely.points(points)
+            index, blocker = self.tree.query(geometries)
+            mask[index[shapely.intersects(self.blockers[blocker], geometries[index])]] = True
+        return mask
+
+    def escape(self, point):
+        """Ближайшая к точке внутри раздутой зоны точка ее границы (или сама точка снаружи)."""
+        return self.escape_points(np.asarray(point, dtype=float)[None, :2])[0]
+
+    def escape_points(self, points):
+        """Для массива точек (n, 2): точки внутри раздутых зон переносятся на ближайшую границу."""
+        points = np.array(points, dtype=float).reshape(-1, 2)
+        if not len(points) or not len(self.obstacles):
+            return points
+        geometries = shapely.points(points)
+        index, blocker = self.tree.query(geometries)
+        inside = shapely.intersects(self.blockers[blocker], geometries[index])
+        index, blocker = index[inside], blocker[inside]
+        if len(index):
+            index, first = np.unique(index, return_index=True)
+            boundary = shapely.get_exterior_ring(self.obstacles[blocker[first]])
+            nearest = shapely.line_interpolate_point(boundary, shapely.line_locate_point(boundary, geometries[index]))
+            points[index] = shapely.get_coordinates(nearest)
+        return points
+
+    def shortest_paths(self, source):
+        """Дейкстра от source до всех узлов графа (PathTree), запоминается для каждой точки."""
+        key = tuple(np.asarray(source, dtype=float)[:2].tolist())
+        if key not in self.trees:
+            self.trees[key] = self._dijkstra(np.asarray(key))
+        return self.trees[key]
+
+    def path_between(self, origin, target):
+        """Путь между двумя произвольными точками в обход зон (отдельный поиск от origin)."""
+        return self._dijkstra(np.asarray(origin, dtype=float)[:2]).path_to(target)[::-1]
+
+    def _dijkstra(self, source):
+        """Дейкстра от source до всех узлов графа; возвращает PathTree."""
+        source = np.asarray(source, dtype=float)[:2]
+        exit_point = self.escape(source)
+        num_nodes = len(self.nodes)
+        distance = np.full(num_nodes, np.inf)
+        predecessor = np.full(num_nodes, -1, dtype=np.int64)
+
+        # Узлы, видимые из точки выхода, получают начальные расстояния
+        start = np.flatnonzero(self.visible(exit_point, self.nodes))
+        distance[start] = (np.hypot(*(exit_point - source))
+                           + np.hypot(*(self.nodes[start] - exit_point).T))
+        heap = list(zip(distance[start].tolist(), start.tolist()))
+        heapq.heapify(heap)
+        done = np.zeros(num_nodes, dtype=bool)
+        offsets, neighbors, weights = self.offsets, self.neighbors, self.weights
+        while heap:
+            dist, node = heapq.heappop(heap)
+            if done[node]:
+                continue
+            done[node] = True
+            adjacent = slice(offsets[node], offsets[node + 1])
+            candidate = dist + weights[adjacent]
+            targets = neighbors[adjacent]
+            better = candidate < distance[targets]
+            for target, value in zip(targets[better].tolist(), candidate[better].tolist()):
+                distance[target] = value
+                predecessor[target] = node
+                heapq.heappush(heap, (value, target))
+        return PathTree(self, source, exit_point, distance, predecessor)
+
+
+class PathTree:
+    """Кратчайшие пути от одной точки (базы) до всех узлов графа видимости.
+
+    Для путей из многих точек (paths_to) первые узлы ищутся пакетно, а
+    цепочки узлов до источника строятся один раз на дерево. После
+    precompute для узлов решетки над районом работ хранится первый узел
+    пути, и одиночный запрос path_to проверяет только узлы соседних точек
+    решетки.
+    """
+
+    __slots__ = ('graph', 'source', 'exit_point', 'distance', 'predecessor', 'chains',
+                 'lookup_origin', 'lookup_step', 'lookup_shape', 'lookup_nodes')
+
+    def __init__(self, graph, source, exit_point, distance, predecessor):
+        self.graph = graph
+        self.source = source
+        self.exit_point = exit_point
+        self.distance = distance
+        self.predecessor = predecessor
+        self.chains = None
+        self.lookup_nodes = None
+
+    def precompute(self, bounds, spacing=LOOKUP_SPACING, max_points=LOOKUP_MAX_POINTS):
+        """Находит первый узел пути для точек решетки внутри bounds (minx, miny, maxx, maxy).
+
+        Шаг решетки увеличивается, если точек получается больше max_points.
+        """
+        minx, miny, maxx, maxy = bounds
+        spacing = max(spacing, np.sqrt((maxx - minx) * (maxy - miny) / max_points))
+        xs = np.arange(minx, maxx + spacing, spacing)
+        ys = np.arange(miny, maxy + spacing, spacing)
+        points = np.stack(np.meshgrid(xs, ys), axis=-1).reshape(-1, 2)
+
+        self.lookup_nodes = self.first_nodes(points)
+        self.lookup_origin = np.array([minx, miny])
+        self.lookup_step = spacing
+        self.lookup_shape = (len(ys), len(xs))
+
+    def first_nodes(self, points):
+        """Первый узел кратчайшего пути до источника для каждой точки (n, 2).
+
+        -1 - источник виден напрямую, -2 - точка внутри зоны или путь не
+        найден. Точки обрабатываются пакетами: на каждом шаге для всех еще
+        не решенных точек проверяется очередная порция узлов в порядке
+        возрастания |точка - узел| + distance[узел], поэтому первый видимый
+        узел дает кратчайший путь.
+        """
+        graph = self.graph
+        points = np.asarray(points, dtype=float).reshape(-1, 2)
+        result = np.full(len(points), -2, dtype=np.int64)
+        free = np.flatnonzero(~graph.blocked(points))
+        direct = graph.visible(points[free], np.broadcast_to(self.exit_point, (len(free), 2)))
+        result[free[direct]] = -1
+
+        pending_all = free[~direct]
+        chunk_size = max(LOOKUP_CHUNK_ELEMENTS // max(len(graph.nodes), 1), 1)
+        nearest = min(LOOKUP_CANDIDATES, len(graph.nodes))
+        for start in range(0, len(pending_all), chunk_size):
+            rows = pending_all[start:start + chunk_size]
+            total = (np.hypot(*(points[rows, None] - graph.nodes[None]).transpose(2, 0, 1))
+                     + self.distance)
+
+            def scan(order, pending, column):
+                # Обычно виден один из первых узлов: первый шаг узкий, затем шире
+                width = 1
+                while len(pending) and column < order.shape[1]:
+                    candidates = order[pending, column:column + width]
+                    column, width = column + width, min(2 * width, VISIBILITY_BATCH)
+                    count = candidates.shape[1]
+                    visible = graph.visible(np.repeat(points[rows[pending]], count, axis=0),
+                                            graph.nodes[candidates.ravel()]).reshape(-1, count)
+                    visible &= np.isfinite(total[pending[:, None], candidates])
+                    found = visible.any(axis=1)
+                    result[rows[pending[found]]] = candidates[found, np.argmax(visible[found], axis=1)]
+                    pending = pending[~found]
+                return pending
+
+            # Полностью сортируются только ближайшие по сумме узлы, остальные - если понадобятся
+            order = np.argpartition(total, nearest - 1, axis=1)[:, :nearest]
+            order = np.take_along_axis(order, np.argsort(np.take_along_axis(total, order, axis=1), axis=1), axis=1)
+            pending = scan(order, np.arange(len(rows)), 0)
+            if len(pending) and nearest < len(graph.nodes):
+                scan(np.argsort(total, axis=1), pending, nearest)
+        return result
+
+    def paths_to(self, points):
+        """Пути из многих точек до source: (вершины (N, 2), границы путей offsets).
+
+        Путь i - vertices[offsets[i]:offsets[i + 1]], от точки до источника.
+        Недостижимые точки соединяются с источником прямым отрезком.
+        """
+        points = np.asarray(points, dtype=float).reshape(-1, 2)
+        exits = self.graph.escape_points(points)
+        nodes = self.first_nodes(exits)
+        reachable = nodes != -2
+        escaped = np.any(exits != points, axis=1) & reachable
+        tail = np.array([self.exit_point, self.source]) if np.any(self.exit_point != self.source) \
+            else self.source[None]
+
+        chain_offsets, chain_nodes = self._chains()
+        via = nodes >= 0
+        chain_length = np.zeros(len(points), dtype=np.int64)
+        chain_length[via] = np.diff(chain_offsets)[nodes[via]]
+        sizes = np.where(reachable, 1 + escaped + chain_length + len(tail), 2)
+        offsets = np.concatenate(([0], np.cumsum(sizes)))
+
+        vertices = np.empty((offsets[-1], 2))
+        position = offsets[:-1].copy()
+        vertices[position] = points
+        position += 1
+        vertices[position[escaped]] = exits[escaped]
+        position += escaped
+        vertices[np.repeat(position[via], chain_length[via]) + _ranges(chain_length[via])] = \
+            self.graph.nodes[chain_nodes[_leg_vertex_index(chain_offsets, nodes[via])]]
+        position += chain_length
+        for k, point in enumerate(tail):
+            vertices[position[reachable] + k] = point
+        vertices[offsets[1:][~reachable] - 1] = self.source
+        return vertices, offsets
+
+    def path_to(self, point):
+        """Путь из точки до source в обход запретных зон: массив вершин (k, 2).
+
+        Если точка внутри раздутой зоны, путь сначала выводит ее на
+        ближайшую границу. Если точка недостижима, путь - прямой отрезок.
+        """
+        point = np.asarray(point, dtype=float)[:2]
+        graph = self.graph
+        exit_point = graph.escape(point)
+        head = [point] if np.any(exit_point != point) else []
+        tail = [self.exit_point, self.source] if np.any(self.exit_point != self.source) else [self.source]
+
+        if graph.visible(exit_point, self.exit_point[None])[0]:
+            return np.array(head + [exit_point] + tail)
+
+        node = self._lookup(exit_point)
+        if node < 0:
+            # Через видимый узел длина пути точно равна |точка - узел| + distance[узел],
+            # поэтому узлы проверяются по возрастанию этой суммы до первого видимого
+            total = np.hypot(*(graph.nodes - exit_point).T) + self.distance
+            order = np.argsort(total)
+            order = order[np.isfinite(total[order])]
+            node = first_visible(graph, exit_point, graph.nodes, order)
+        if node < 0:
+            return np.array([point, self.source])
+        chain = []
+        while node >= 0:
+            chain.append(graph.nodes[node])
+            node = self.predecessor[node]
+        return np.array(head + [exit_point] + chain + tail)
+
+    def length_to(self, point):
+        """Длина пути path_to(point), м."""
+        return float(np.hypot(*np.diff(self.path_to(point), axis=0).T).sum())
+
+    def _chains(self):
+        """Цепочки узлов от каждого узла до источника в стиле CSR (строятся один раз)."""
+        if self.chains is None:
+            chains = [[] for _ in range(len(self.distance))]
+            # В порядке возрастания расстояния цепочка предка уже построена
+            for node in np.argsort(self.distance):
+                if not np.isfinite(self.distance[node]):
+                    break
+                parent = self.predecessor[node]
+                chains[node] = [node] + (chains[parent] if parent >= 0 else [])
+            lengths = [len(chain) for chain in chains]
+            self.chains = (np.concatenate(([0], np.cumsum(lengths, dtype=np.int64))),
+                           np.fromiter((node for chain in chains for node in chain), dtype=np.int64,
+                                       count=sum(lengths)))
+        return self.chains
+
+    def _lookup(self, point):
+        """Лучший видимый из точки узел среди узлов четырех соседних точек решетки (или -1)."""
+        if self.lookup_nodes is None:
+            return -1
+        cell = np.floor((point - self.lookup_origin) / self.lookup_step).astype(np.int64)
+        rows, cols = self.lookup_shape
+        if not (0 <= cell[0] < cols - 1 and 0 <= cell[1] < rows - 1):
+            return -1
+        corner = (cell[1] + np.array([0, 0, 1, 1])) * cols + cell[0] + np.array([0, 1, 0, 1])
+        candidates = np.unique(self.lookup_nodes[corner])
+        candidates = candidates[candidates >= 0]
+        if not len(candidates):
+            return -1
+        visible = self.graph.visible(point, self.graph.nodes[candidates])
+        if not visible.any():
+            return -1
+        candidates = candidates[visible]
+        total = np.hypot(*(self.graph.nodes[candidates] - point).T) + self.distance[candidates]
+        return candidates[np.argmin(total)]
+
+
+@stage('reroute_transit')
+def reroute_transit(flight_plan, restricted_zones, start_point=None, clearance=ZONE_CLEARANCE):
+    """Заменяет прямые транзитные участки, пересекающие запретные зоны, путями в обход.
+
+    Подлеты и возвраты (LEG_TO, LEG_BACK) между стартом и квадратом берутся
+    из одного дерева кратчайших путей от старта (Дейкстра один раз на все
+    квадраты), перелеты между квадратами (LEG_HOP) и участки с другой
+    точкой старта ищутся отдельно. Граф видимости берется из кэша
+    get_visibility_graph. Участки, не задевающие зоны, не меняются.
+    """
+    zones = np.asarray(list(restricted_zones), dtype=object)
+    transit = np.flatnonzero(np.isin(flight_plan.leg_types, (LEG_TO, LEG_BACK, LEG_HOP))
+                             & (np.diff(flight_plan.offsets) == 2))
+    if not len(zones) or not len(transit):
+        return flight_plan
+
+    origins = flight_plan.vertices[flight_plan.offsets[transit]]
+    targets = flight_plan.vertices[flight_plan.offsets[transit] + 1]
+    shapely.prepare(zones)
+    crossing = np.unique(segments_crossing(STRtree(zones), zones, _bbox_corners(zones), origins, targets))
+    if not len(crossing):
+        return flight_plan
+
+    graph = get_visibility_graph(zones, clearance)
+    start = np.asarray(start_point if start_point is not None else flight_plan.start_point(), dtype=float)[:2]
+    tree = graph.shortest_paths(start)
+    legs, origins, targets = transit[crossing], origins[crossing], targets[crossing]
+    leg_types = flight_plan.leg_types[legs]
+    count('transit_legs_rerouted', len(legs))
+
+    paths = [None] * len(legs)
+    # Подлеты - пути от квадрата до старта в обратном порядке
+    to_start = np.flatnonzero((leg_types == LEG_TO) & np.all(origins == start, axis=1))
+    from_start = np.flatnonzero((leg_types == LEG_BACK) & np.all(targets == start, axis=1))
+    for group, points, reverse in ((to_start, targets, True), (from_start, origins, False)):
+        vertices, offsets = tree.paths_to(points[group])
+        for k, leg in enumerate(group):
+            path = vertices[offsets[k]:offsets[k + 1]]
+            paths[leg] = path[::-1] if reverse else path
+    for leg in range(len(legs)):
+        if paths[leg] is None:
+            paths[leg] = graph.path_between(origins[leg], targets[leg])
+
+    offsets = np.concatenate(([0], np.cumsum([len(path) for path in paths])))
+    return flight_plan.replace(legs, FlightPlan(np.concatenate(paths), offsets, leg_types, flight_plan.cells[legs]))
+
+
+def segments_crossing(tree, polygons, corners, origins, targets):
+    """Номера отрезков origins[i]-targets[i], пересекающих полигоны STRtree (с повторами).
+
+    polygons - подготовленные (shapely.prepare) геометрии дерева, corners -
+    углы их рамок (_bbox_corners). Рамки длинных отрезков задевают много
+    полигонов, поэтому сначала отбрасываются пары, у которых все углы рамки
+    полигона лежат по одну сторону от прямой отрезка.
+    """
+    lines = shapely.linestrings(np.stack((origins, targets), axis=1))
+    index, polygon = tree.query(lines)
+    side = _cross((targets - origins)[index, None], corners[polygon] - origins[index, None])
+    near = (side.min(axis=1) <= 0) & (side.max(axis=1) >= 0)
+    index, polygon = index[near], polygon[near]
+    return index[shapely.intersects(polygons[polygon], lines[index])]
+
+
+def first_visible(graph, origin, targets, order):
+    """Первый по порядку order номер цели, видимой из origin (или -1).
+
+    Цели проверяются пакетами, размер которых удваивается: обычно хватает
+    первого пакета, а в худшем случае число запросов растет логарифмически.
+    """
+    start, size = 0, VISIBILITY_BATCH
+    while start < len(order):
+        batch = order[start:start + size]
+        visible = np.flatnonzero(graph.visible(origin, targets[batch]))
+        if len(visible):
+            return batch[visible[0]]
+        start, size = start + size, 2 * size
+    return -1
+
+
+def _bbox_corners(geometries):
+    """Четыре угла рамки каждой геометрии: массив (n, 4, 2)."""
+    bounds = shapely.bounds(geometries).reshape(-1, 4)
+    return bounds[:, [[0, 1], [2, 1], [2, 3], [0, 3]]]
+
+
+def _ranges(lengths):
+    """Номера 0..length-1 подряд для каждого элемента lengths."""
+    return np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+
+
+def _zone_keys(zones):
+    """Ключ каждой зоны: хэш WKB нормализованной геометрии."""
+    if not len(zones):
+        return []
+    return [hashlib.sha256(wkb).digest() for wkb in shapely.to_wkb(shapely.normalize(zones))]
+
+
+def _inflate(zones, keys, clearance):
+    """Зоны, раздутые на clearance, по отдельным многоугольникам: (части, ключи зон частей)."""
+    if not len(zones):
+        return np.empty(0, dtype=object), np.empty(0, dtype=object)
+    parts, index = shapely.get_parts(shapely.buffer(zones, clearance, join_style='mitre'), return_index=True)
+    polygon = (shapely.get_type_id(parts) == 3) & ~shapely.is_empty(parts)
+    keys_array = np.empty(len(keys), dtype=object)
+    keys_array[:] = keys
+    return parts[polygon], keys_array[index[polygon]]
+
+
+def _merge(parts):
+    """Препятствия - многоугольники объединения раздутых частей зон."""
+    if not len(parts):
+        return np.empty(0, dtype=object)
+    return np.asarray([part for part in shapely.get_parts(shapely.union_all(parts))
+                       if isinstance(part, shapely.Polygon)], dtype=object)
+
+
+def _locate(parts, obstacles):
+    """Номер препятствия, в которое входит каждая часть (по ее внутренней точке)."""
+    result = np.zeros(len(parts), dtype=np.int64)
+    if len(parts) and len(obstacles):
+        index, obstacle = STRtree(obstacles).query(shapely.point_on_surface(parts), predicate='intersects')
+        result[index] = obstacle
+    return result
+
+
+def _pairs_through(regions, nodes):
+    """Пары узлов i < j, отрезок между которыми может пересекать один из regions (с запасом).
+
+    Для каждого узла и области строится тень ее выпуклой оболочки -
+    выпуклая оболочка вершин и их проекций вдаль от узла; узлы в тени
+    ищутся одним запросом к STRtree. Узлы внутри оболочки видят все узлы.
+    """
+    points = STRtree(shapely.points(nodes))
+    minx, miny = nodes.min(axis=0)
+    maxx, maxy = nodes.max(axis=0)
+    codes = [np.empty(0, dtype=np.int64)]
+    for region in regions:
+        outline = shapely.convex_hull(region)
+        hull = shapely.get_coordinates(outline)[:-1]
+        if len(hull) < 3:
+            continue
+        reach = 2 * np.hypot(max(maxx, hull[:, 0].max()) - min(minx, hull[:, 0].min()),
+                             max(maxy, hull[:, 1].max()) - min(miny, hull[:, 1].min()))
+        direction = hull[None] - nodes[:, None]
+        distance = np.maximum(np.hypot(direction[..., 0], direction[..., 1]), 1e-9)
+        far = hull[None] + direction / distance[..., None] * reach
+        coords = np.concatenate((np.broadcast_to(hull, far.shape), far), axis=1).reshape(-1, 2)
+        shadows = shapely.convex_hull(shapely.multipoints(coords, indices=np.repeat(np.arange(len(nodes)),
+                                                                                     2 * len(hull))))
+        shadows[shapely.contains_xy(outline, *nodes.T)] = shapely.box(minx, miny, maxx, maxy).buffer(1.0)
+        first, second = points.query(shadows, predicate='intersects')
+        low, high = np.minimum(first, second), np.maximum(first, second)
+        codes.append(low[low < high] * len(nodes) + high[low < high])
+    codes = np.unique(np.concatenate(codes))
+    return codes // len(nodes), codes % len(nodes)
+
+
+def _obstacle_nodes(obstacles):
+    """Узлы графа, соседние с ними вершины контура и препятствия узлов.
+
+    Возвращает (узлы (n, 2), соседи (n, 2, 2), номера препятствий (n,)).
+    Узлы - выпуклые вершины внешних границ и все вершины отверстий.
+    """
+    nodes, neighbors, owners = [], [], []
+    for number, polygon in enumerate(obstacles):
+        polygon = orient(polygon, 1.0)
+        for k, ring in enumerate([polygon.exterior, *polygon.interiors]):
+            ring = np.asarray(ring.coords)[:-1]
+            previous, following = np.roll(ring, 1, axis=0), np.roll(ring, -1, axis=0)
+            keep = np.ones(len(ring), dtype=bool)
+            if k == 0:
+                # Для обхода против часовой стрелки выпуклая вершина - левый поворот
+                keep = _cross(ring - previous, following - ring) > 0
+            nodes.append(ring[keep])
+            neighbors.append(np.stack((previous[keep], following[keep]), axis=1))
+            owners.append(np.full(keep.sum(), number, dtype=np.int64))
+    if not nodes:
+        return np.empty((0, 2)), np.empty((0, 2, 2)), np.empty(0, dtype=np.int64)
+    return np.concatenate(nodes), np.concatenate(neighbors), np.concatenate(owners)
+
+
+def _cross(a, b):
+    return a[..., 0] * b[..., 1] - a[..., 1] * b[..., 0]
+
+
+def _node_pairs(num_nodes, chunk_size):
+    """Все пары узлов i < j в порядке np.triu_indices, блоками по строкам примерно по chunk_size пар."""
+    counts = np.arange(num_nodes - 1, -1, -1, dtype=np.int64)
+    ends = np.cumsum(counts)
+    row = 0
+    while row < num_nodes - 1:
+        last = max(int(np.searchsorted(ends, ends[row] - counts[row] + chunk_size, side='right')), row + 1)
+        rows = counts[row:last]
+        first = np.repeat(np.arange(row, last), rows)
+        second = first + 1 + np.arange(len(first)) - np.repeat(np.cumsum(rows) - rows, rows)
+        yield first, second
+        row = last
+
+
+def _tangent(origins, targets, ring_neighbors):
+    """Прямая origin-target касается контура в origin: обе соседние вершины по одну сторону."""
+    direction = targets - origins
+    before = _cross(direction, ring_neighbors[:, 0] - origins)
+    after = _cross(direction, ring_neighbors[:, 1] - origins)
+    return before * after >= 0